@@ -0,0 +1,31 @@
+from ingest import ingest_file, document_excerpt
+from retrieval import format_references
+
+FILE_EXCERPT_TOKENS = 3000
+DEFAULT_FILE_QUESTION = "请概述这份文档的主要内容"
+
+
+# 上传文件的读取和索引：边读边切块存入 upload_dir，并建立检索索引
+def prepare_document(path, retriever, name=None, progress=None):
+    """progress(stage) 用于报告当前阶段；返回 Document"""
+    if progress:
+        progress('正在读取文件')
+    document = ingest_file(path, name, upload_dir=retriever.upload_dir)
+    if progress:
+        progress(f'正在建立索引（{document.chunks} 个片段）')
+    retriever.index_document(document)
+    return document
+
+
+# 分析文档时发给模型的片段
+def document_references(document, question=None, retriever=None, excerpt_tokens=FILE_EXCERPT_TOKENS):
+    """没有具体问题（检索没有意义）或文档不超过 excerpt_tokens 时发送文档开头，否则检索与问题相关的片段"""
+    if question and retriever and document.tokens > excerpt_tokens:
+        return retriever.search([document.doc_id], question)
+    return [{'name': document.name, 'index': 0, 'text': document_excerpt(document, excerpt_tokens)}]
+
+
+# 不带对话历史的单次分析请求；没有问题时概述文档
+def analysis_messages(document, question=None, retriever=None, excerpt_tokens=FILE_EXCERPT_TOKENS):
+    references = document_references(document, question, retriever, excerpt_tokens)
+    return [{"role": "user", "content": format_references(references, question or DEFAULT_FILE_QUESTION)}]
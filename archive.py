@@ -0,0 +1,242 @@
+import argparse
+import gzip
+import json
+import os
+import shutil
+import time
+import zlib
+
+from conversation_store import LOG_SUFFIX, REASONING_SUFFIX, SUMMARY_SUFFIX
+
+ARCHIVE_SUFFIX = '.jsonl.gz'
+ARCHIVE_VERSION = 1
+BLOCK_MESSAGES = 64  # 每个 gzip 块的消息数；按范围读取时只解压需要的块
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 30))
+READ_SIZE = 64 * 1024
+
+
+# 冷对话归档格式
+#
+# 文件由多个独立的 gzip 块（member）首尾相接组成，整体仍是合法的 gzip，可以直接 zcat：
+#   第一个块只有一行索引 {"op": "archive", "version", "messages", "blocks": [[首条消息序号, 偏移], ...]}，
+#   偏移相对于索引块结束的位置；之后每个块是 BLOCK_MESSAGES 条紧凑的 JSON 行。
+# 推理过程文件整体压缩为 <name>.reasoning.jsonl.gz，恢复时原样解压。
+
+def archive_path_for(path):
+    return os.path.splitext(path)[0] + ARCHIVE_SUFFIX
+
+
+def is_archive(name):
+    return name.endswith(ARCHIVE_SUFFIX) and not name.endswith(REASONING_SUFFIX + '.gz')
+
+
+def _base(archive_path):
+    return archive_path[:-len(ARCHIVE_SUFFIX)]
+
+
+def _compress_lines(records):
+    return gzip.compress(''.join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+                                 for record in records).encode('utf-8'), mtime=0)
+
+
+# 从文件当前位置读取一个 gzip 块，读完后文件位置停在下一个块的开头
+def _read_member(file):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    parts = []
+    while not decompressor.eof:
+        data = file.read(READ_SIZE)
+        if not data:
+            if parts or decompressor.unconsumed_tail:
+                raise ValueError('归档文件不完整')
+            return None
+        parts.append(decompressor.decompress(data))
+    if decompressor.unused_data:
+        file.seek(-len(decompressor.unused_data), os.SEEK_CUR)
+    return b''.join(parts)
+
+
+def _parse_lines(data):
+    return [json.loads(line) for line in data.decode('utf-8').splitlines() if line.strip()]
+
+
+# 写入归档：先写临时文件再原子替换；返回索引
+def write_archive(path, messages, mtime=None):
+    blocks = [messages[i:i + BLOCK_MESSAGES] for i in range(0, len(messages), BLOCK_MESSAGES)]
+    compressed = [_compress_lines(block) for block in blocks]
+    offsets = []
+    offset = 0
+    for index, data in enumerate(compressed):
+        offsets.append([index * BLOCK_MESSAGES, offset])
+        offset += len(data)
+    header = {'op': 'archive', 'version': ARCHIVE_VERSION, 'messages': len(messages), 'blocks': offsets}
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(_compress_lines([header]))
+        for data in compressed:
+            file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return header
+
+
+# 读取索引；返回 (索引, 数据开始的位置)
+def read_index(path):
+    with open(path, 'rb') as file:
+        data = _read_member(file)
+        header = _parse_lines(data)[0] if data else None
+        if not header or header.get('op') != 'archive':
+            raise ValueError(f'不是对话归档文件：{path}')
+        return header, file.tell()
+
+
+# 依次返回 (块的绝对偏移, 块中的消息)
+def iter_blocks(path):
+    with open(path, 'rb') as file:
+        _read_member(file)
+        while True:
+            offset = file.tell()
+            data = _read_member(file)
+            if data is None:
+                return
+            yield offset, _parse_lines(data)
+
+
+def read_all(path):
+    return [message for _, block in iter_blocks(path) for message in block]
+
+
+# 按范围读取：offset 是某个块的绝对偏移，seq 是该块第一条消息的序号
+def read_range(path, offset, seq, start=0, count=20):
+    messages = []
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        while len(messages) < count:
+            data = _read_member(file)
+            if data is None:
+                break
+            for message in _parse_lines(data):
+                if seq >= start and len(messages) < count:
+                    messages.append(message)
+                seq += 1
+    return messages
+
+
+# 读取归档中的一段消息，用文件自带的索引定位块
+def read_messages(path, start=0, count=20):
+    header, data_start = read_index(path)
+    total = header['messages']
+    start = max(0, min(start, total))
+    seq, offset = 0, 0
+    for block_seq, block_offset in header['blocks']:
+        if block_seq > start:
+            break
+        seq, offset = block_seq, block_offset
+    return {'total': total, 'start': start, 'messages': read_range(path, data_start + offset, seq, start, count)}
+
+
+# 读取对话日志或旧的 JSON 文件中的有效消息
+def load_conversation(path):
+    if not path.endswith(LOG_SUFFIX):
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    conversation = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('op') == 'clear':
+                conversation = []
+            else:
+                conversation.append(record)
+    return conversation
+
+
+# 归档一个对话文件（.jsonl 日志或旧的 .json），成功后删除原文件；返回归档路径
+def archive_conversation(path):
+    base = os.path.splitext(path)[0]
+    target = base + ARCHIVE_SUFFIX
+    mtime = os.stat(path).st_mtime
+    write_archive(target, load_conversation(path), mtime=mtime)
+    reasoning_path = base + REASONING_SUFFIX
+    if os.path.exists(reasoning_path):
+        with open(reasoning_path, 'rb') as source, gzip.open(reasoning_path + '.gz.tmp', 'wb') as target_file:
+            shutil.copyfileobj(source, target_file)
+        os.replace(reasoning_path + '.gz.tmp', reasoning_path + '.gz')
+        os.remove(reasoning_path)
+    os.remove(path)
+    return target
+
+
+# 恢复为对话日志（会话被重新打开时调用）；返回日志路径
+def restore_conversation(archive_path):
+    base = _base(archive_path)
+    log_path = base + LOG_SUFFIX
+    messages = read_all(archive_path)
+    tmp_path = log_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        for message in messages:
+            file.write(json.dumps(message, ensure_ascii=False) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, log_path)
+    reasoning_archive = base + REASONING_SUFFIX + '.gz'
+    if os.path.exists(reasoning_archive):
+        with gzip.open(reasoning_archive, 'rb') as source, open(base + REASONING_SUFFIX + '.tmp', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.replace(base + REASONING_SUFFIX + '.tmp', base + REASONING_SUFFIX)
+        os.remove(reasoning_archive)
+    os.remove(archive_path)
+    return log_path
+
+
+# 日志不存在但有归档时先恢复
+def restore_if_archived(log_path):
+    archive_path = archive_path_for(log_path)
+    if not os.path.exists(log_path) and os.path.exists(archive_path):
+        restore_conversation(archive_path)
+        return True
+    return False
+
+
+# 目录中超过 max_idle_days 天没有更新的对话（不含已归档的）
+def idle_conversations(directory, max_idle_days=ARCHIVE_AFTER_DAYS):
+    cutoff = time.time() - max_idle_days * 24 * 3600
+    for entry in os.scandir(directory):
+        name = entry.name
+        if not entry.is_file() or name.endswith(('.docs.json', SUMMARY_SUFFIX, REASONING_SUFFIX)):
+            continue
+        if (name.endswith(LOG_SUFFIX) or name.endswith('.json')) and entry.stat().st_mtime < cutoff:
+            yield entry.path
+
+
+# 归档目录中所有空闲的对话；exclude 中的文件跳过（如正在使用的会话）
+def archive_idle(directory, max_idle_days=ARCHIVE_AFTER_DAYS, exclude=()):
+    archived = []
+    for path in idle_conversations(directory, max_idle_days):
+        if path in exclude:
+            continue
+        archived.append(archive_conversation(path))
+    return archived
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='把长时间未更新的对话压缩归档，或恢复归档的对话')
+    parser.add_argument('--dir', default='chat_histories')
+    parser.add_argument('--days', type=float, default=ARCHIVE_AFTER_DAYS, help='超过多少天未更新的对话归档')
+    parser.add_argument('--restore', metavar='FILE', help='恢复一个归档文件')
+    args = parser.parse_args()
+
+    if args.restore:
+        print(restore_conversation(args.restore))
+    else:
+        # 运行中的服务会自行定期归档；单独运行时请确保服务没有打开这些会话
+        before = sum(os.path.getsize(path) for path in idle_conversations(args.dir, args.days))
+        archived = archive_idle(args.dir, args.days)
+        after = sum(os.path.getsize(path) for path in archived)
+        print(f'归档 {len(archived)} 个对话：{before} -> {after} 字节')
@@ -0,0 +1,211 @@
+import json
+from contextlib import aclosing
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import metrics
+from async_pipeline import AsyncPipeline, FairScheduler, QueueFull
+from metrics import Trace
+from router import BackendRouter
+from session_manager import SessionManager
+from streaming import acoalesce_frames
+
+HTML = '''
+<!doctype html>
+<html lang="en">
+  <head>
+    <meta charset="utf-8">
+    <title>Chat</title>
+    <style>
+      body {
+        font-family: Arial, sans-serif;
+        background-color: #f4f4f9;
+        margin: 0;
+        padding: 0;
+        display: flex;
+        justify-content: center;
+        align-items: center;
+        height: 100vh;
+      }
+      .chat-container {
+        background-color: #fff;
+        padding: 20px;
+        border-radius: 8px;
+        box-shadow: 0 0 10px rgba(0, 0, 0, 0.1);
+        width: 80%;
+        max-width: 600px;
+      }
+      .chat-container h1 {
+        text-align: center;
+        color: #333;
+      }
+      .chat-container form {
+        display: flex;
+        margin-bottom: 20px;
+      }
+      .chat-container input[type="text"] {
+        flex: 1;
+        padding: 10px;
+        border: 1px solid #ccc;
+        border-radius: 4px;
+        font-size: 16px;
+      }
+      .chat-container input[type="submit"] {
+        padding: 10px 20px;
+        border: none;
+        border-radius: 4px;
+        background-color: #007bff;
+        color: #fff;
+        font-size: 16px;
+        cursor: pointer;
+        margin-left: 10px;
+      }
+      .chat-container input[type="submit"]:hover {
+        background-color: #0056b3;
+      }
+      .chat-container .response {
+        background-color: #f9f9f9;
+        padding: 15px;
+        border-radius: 8px;
+        margin-top: 20px;
+        font-size: 16px;
+        color: #333;
+        white-space: pre-wrap;
+      }
+    </style>
+  </head>
+  <body>
+    <div class="chat-container">
+      <h1>Chat</h1>
+      <form method="post" id="chatForm">
+        <input type="text" name="prompt" placeholder="输入你的消息" required>
+        <input type="submit" value="发送">
+      </form>
+      <div class="response" id="response"></div>
+    </div>
+    <script>
+      // 通过 /stream 接收流式回复，每收到一段就追加到页面上
+      document.getElementById('chatForm').addEventListener('submit', async (event) => {
+        event.preventDefault();
+        const form = event.target;
+        const output = document.getElementById('response');
+        const prompt = form.elements.prompt.value;
+        form.reset();
+        output.textContent = '';
+
+        const response = await fetch('/stream', {
+          method: 'POST',
+          headers: {'Content-Type': 'application/json'},
+          body: JSON.stringify({prompt: prompt})
+        });
+        if (!response.ok) {
+          output.textContent = (await response.json()).error;
+          return;
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+          const {value, done} = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, {stream: true});
+          const events = buffer.split('\\n\\n');
+          buffer = events.pop();
+          for (const event of events) {
+            const data = event.split('\\n').find(line => line.startsWith('data: '));
+            if (data) {
+              const payload = JSON.parse(data.slice(6));
+              if (payload.delta) output.textContent += payload.delta;
+            }
+          }
+        }
+      });
+    </script>
+  </body>
+</html>
+'''
+
+SESSION_COOKIE = 'session_id'
+
+# 对话历史按会话隔离：会话 ID 放在 cookie 中，每个会话一份日志
+sessions = SessionManager()
+
+# 异步生成管线：限制同时生成的数量，超出的请求按会话轮转排队，队列满时直接拒绝
+# 多个 Ollama 后端（OLLAMA_BACKENDS）之间负载均衡，同一会话固定在同一后端
+router = BackendRouter()
+pipeline = AsyncPipeline(sessions, client=router, scheduler=FairScheduler(max_in_flight=4, max_queue=64))
+
+
+async def index(request):
+    return with_session_cookie(request, HTMLResponse(HTML), current_session_id(request))
+
+
+# 流式接口：以 SSE 格式逐帧返回新增的文字（FRAME_INTERVAL 内的 token 合成一帧）
+async def stream(request):
+    prompt = (await request.json())['prompt']
+    session_id = current_session_id(request)
+    stats = pipeline.scheduler.stats()
+    if stats['queued'] >= stats['max_queue']:
+        # 提前拒绝，客户端可以按 Retry-After 重试
+        return JSONResponse({'error': '当前排队人数过多，请稍后再试'}, status_code=503, headers={'Retry-After': '5'})
+
+    trace = Trace('asgi.stream', request.headers.get('X-Request-ID'))
+
+    async def events():
+        with trace:
+            try:
+                async with aclosing(pipeline.stream_turn(session_id, prompt, trace=trace)) as deltas:
+                    async for delta in acoalesce_frames(deltas):
+                        yield f"data: {json.dumps({'delta': delta}, ensure_ascii=False)}\n\n"
+            except QueueFull as e:
+                trace.fail(e)
+                message = f"⚠️ {e}"
+                yield f"data: {json.dumps({'delta': message}, ensure_ascii=False)}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    resp = StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no',
+                                      'X-Request-ID': trace.request_id})
+    return with_session_cookie(request, resp, session_id)
+
+
+# 排队情况：正在生成的数量、排队深度
+async def queue(request):
+    return JSONResponse(pipeline.scheduler.stats())
+
+
+# Prometheus 指标：各阶段耗时、首 token 时间、token 数、错误数
+async def metrics_endpoint(request):
+    return Response(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+# 后端状态：健康、负载、首 token 延迟
+async def backends(request):
+    return JSONResponse(router.stats())
+
+
+def current_session_id(request):
+    return sessions.ensure_session_id(request.cookies.get(SESSION_COOKIE))
+
+
+def with_session_cookie(request, resp, session_id):
+    if request.cookies.get(SESSION_COOKIE) != session_id:
+        resp.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='lax')
+    return resp
+
+
+app = Starlette(routes=[
+    Route('/', index),
+    Route('/stream', stream, methods=['POST']),
+    Route('/queue', queue),
+    Route('/backends', backends),
+    Route('/metrics', metrics_endpoint),
+])
+
+if __name__ == '__main__':
+    # 超过 ARCHIVE_AFTER_DAYS 天未更新的会话定期压缩归档
+    sessions.start_archiver()
+    uvicorn.run(app, port=5000)
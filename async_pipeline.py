@@ -0,0 +1,459 @@
+import asyncio
+import functools
+import json
+import random
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager
+from typing import AsyncIterator, List
+
+import httpx
+
+from coalescing import AsyncSingleFlight
+from metrics import IN_FLIGHT, PREEMPTIONS, QUEUE_DEPTH, QUEUE_SECONDS, Trace
+from ollama_client import OLLAMA_URL, DEFAULT_MODEL, KEEP_ALIVE, RETRY_STATUS, BackendUnavailable, CircuitBreaker
+from reasoning import ReasoningSplitter
+from response_cache import ResponseCache, replay
+from retrieval import format_references
+from streaming import (PARTIAL_ANSWER_POLICY, context_builder, memory, record_turn_stats, response_cache, save_turn,
+                       logger)
+
+
+# 排队已满，拒绝新请求
+class QueueFull(Exception):
+    pass
+
+
+# 低优先级的生成被高优先级请求抢占，调用方可以稍后重试
+class Preempted(Exception):
+    pass
+
+
+# 优先级：数字越小越优先
+INTERACTIVE = 'interactive'      # 聊天
+FILE_ANALYSIS = 'file_analysis'  # 上传文件后的分析
+BATCH = 'batch'                  # 批量离线任务
+PRIORITIES = (INTERACTIVE, FILE_ANALYSIS, BATCH)
+
+
+# 一个已分配的生成名额
+class Slot:
+    def __init__(self, user_id, priority, stop=None):
+        self.user_id = user_id
+        self.priority = priority
+        self.stop = stop or asyncio.Event()  # 被抢占时置位，持有者应尽快结束生成
+        self.preempted = False
+        self.started = time.monotonic()
+
+
+# 公平调度器
+class FairScheduler:
+    """限制同时进行的生成数量；排队的请求按优先级放行，同一优先级内按用户轮转，
+    一个用户的大量请求不会饿死其他用户
+
+    limits 限制每个优先级同时进行的生成数；reserved 个名额只留给交互请求，
+    文件分析和批量任务再多也占不满后端。preempt 为 True 时，交互请求没有名额可用会
+    抢占最晚开始的低优先级生成（置位 Slot.stop）。只能在同一个事件循环中使用，内部状态不加锁。
+    """
+
+    def __init__(self, max_in_flight=4, max_queue=64, max_queue_per_user=4, limits=None, reserved=1,
+                 preempt=False):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.limits = {INTERACTIVE: max_in_flight, FILE_ANALYSIS: max(1, max_in_flight // 2), BATCH: 1}
+        self.limits.update(limits or {})
+        self.reserved = min(reserved, max_in_flight - 1)
+        self.preempt = preempt
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}  # user_id -> 等待中的 future，按轮转顺序排列
+        self._queued = {priority: 0 for priority in PRIORITIES}
+        self._running = {priority: [] for priority in PRIORITIES}  # 按开始时间排列的 Slot
+        self._in_flight = 0
+        self.preemptions = 0
+
+    # 当前的并发与排队情况
+    def stats(self):
+        return {
+            'in_flight': self._in_flight,
+            'max_in_flight': self.max_in_flight,
+            'queued': sum(self._queued.values()),
+            'max_queue': self.max_queue,
+            'reserved': self.reserved,
+            'preemptions': self.preemptions,
+            'classes': {priority: {'in_flight': len(self._running[priority]), 'limit': self.limits[priority],
+                                   'queued': self._queued[priority]} for priority in PRIORITIES},
+            'queued_by_user': {user_id: len(queue) for queues in self._queues.values()
+                               for user_id, queue in queues.items()},
+        }
+
+    def _can_start(self, priority):
+        if len(self._running[priority]) >= self.limits[priority]:
+            return False
+        capacity = self.max_in_flight if priority == INTERACTIVE else self.max_in_flight - self.reserved
+        return self._in_flight < capacity
+
+    # 同级或更高优先级有人排队时不插队
+    def _has_waiting(self, priority):
+        return any(self._queued[p] for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+
+    @asynccontextmanager
+    async def slot(self, user_id, priority=INTERACTIVE, stop=None):
+        """获取一个生成名额，返回 Slot；排队时间按优先级记入 chat_queue_seconds"""
+        if priority not in self.limits:
+            raise ValueError(f'未知的优先级：{priority}')
+        slot = Slot(user_id, priority, stop)
+        queued = time.perf_counter()
+        if self._can_start(priority) and not self._has_waiting(priority):
+            self._start(slot)
+        else:
+            await self._wait(slot)
+        QUEUE_SECONDS.observe(time.perf_counter() - queued, priority=priority)
+        try:
+            yield slot
+        finally:
+            self._finish(slot)
+            self._dispatch()
+
+    def _start(self, slot):
+        self._in_flight += 1
+        self._running[slot.priority].append(slot)
+        slot.started = time.monotonic()
+        self._update_gauges()
+
+    def _finish(self, slot):
+        self._in_flight -= 1
+        self._running[slot.priority].remove(slot)
+        self._update_gauges()
+
+    async def _wait(self, slot):
+        user_id, priority = slot.user_id, slot.priority
+        queues = self._queues[priority]
+        queue = queues.get(user_id)
+        queued = sum(self._queued.values())
+        if queued >= self.max_queue or (queue and len(queue) >= self.max_queue_per_user):
+            raise QueueFull(f'排队请求过多（{queued}/{self.max_queue}）')
+        if queue is None:
+            queue = queues[user_id] = deque()
+        future = asyncio.get_running_loop().create_future()
+        future.slot = slot
+        queue.append(future)
+        self._queued[priority] += 1
+        self._update_gauges()
+        if priority == INTERACTIVE and self.preempt:
+            self._preempt()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经分到名额但调用方被取消，归还名额
+                self._finish(slot)
+                self._dispatch()
+            else:
+                self._remove(priority, user_id, future)
+            raise
+
+    # 为排队的交互请求腾出名额：每个排队的请求最多对应一个正在结束的被抢占者
+    def _preempt(self):
+        stopping = sum(1 for priority in PRIORITIES[1:] for slot in self._running[priority] if slot.preempted)
+        if self._queued[INTERACTIVE] <= stopping:
+            return
+        for priority in reversed(PRIORITIES[1:]):
+            candidates = [slot for slot in self._running[priority] if not slot.preempted]
+            if candidates:
+                victim = candidates[-1]
+                victim.preempted = True
+                victim.stop.set()
+                self.preemptions += 1
+                PREEMPTIONS.inc(priority=priority)
+                return
+
+    def _remove(self, priority, user_id, future):
+        queues = self._queues[priority]
+        queue = queues.get(user_id)
+        if queue and future in queue:
+            queue.remove(future)
+            self._queued[priority] -= 1
+            if not queue:
+                del queues[user_id]
+            self._update_gauges()
+
+    # 按优先级、同级内按用户轮转放行排队的请求
+    def _dispatch(self):
+        for priority in PRIORITIES:
+            queues = self._queues[priority]
+            while queues and self._can_start(priority):
+                user_id, queue = next(iter(queues.items()))
+                future = queue.popleft()
+                self._queued[priority] -= 1
+                if queue:
+                    queues.move_to_end(user_id)
+                else:
+                    del queues[user_id]
+                if future.cancelled():
+                    continue
+                self._start(future.slot)
+                future.set_result(None)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        for priority in PRIORITIES:
+            QUEUE_DEPTH.set(self._queued[priority], priority=priority)
+            IN_FLIGHT.set(len(self._running[priority]), priority=priority)
+
+
+# 异步 Ollama 客户端
+class AsyncOllamaClient:
+    """基于 httpx.AsyncClient 的 Ollama 客户端，重试与熔断策略和 OllamaClient 一致"""
+
+    def __init__(self, base_url=OLLAMA_URL, max_connections=10, connect_timeout=3.05, read_timeout=300.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._http = None
+
+    # 连接池在首次使用时创建，保证绑定到运行中的事件循环
+    def _client(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(base_url=self.base_url, limits=self.limits, timeout=self.timeout)
+        return self._http
+
+    async def _open_stream(self, path, payload):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise BackendUnavailable(f'Ollama 后端暂不可用（熔断中）：{self.base_url}')
+            try:
+                request = self._client().build_request('POST', path, json=payload)
+                response = await self._client().send(request, stream=True)
+            except httpx.TransportError as e:
+                last_error = e
+            else:
+                if response.status_code not in RETRY_STATUS:
+                    self.breaker.record_success()
+                    if response.is_error:
+                        await response.aclose()
+                        response.raise_for_status()
+                    return response
+                last_error = httpx.HTTPStatusError(f'{response.status_code} {response.reason_phrase}',
+                                                   request=response.request, response=response)
+                await response.aclose()
+            self.breaker.record_failure()
+            if attempt < self.max_retries:
+                await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+        raise BackendUnavailable(f'请求 Ollama 失败：{last_error}') from last_error
+
+    async def stream_chat(self, messages: List[dict], model: str = DEFAULT_MODEL, options: dict = None,
+                          keep_alive: str = KEEP_ALIVE, on_done=None, affinity=None) -> AsyncIterator[str]:
+        """流式请求 /api/chat，逐块返回新生成的文本；affinity 供多后端路由使用，这里忽略"""
+        payload = {'model': model, 'messages': messages, 'stream': True, 'keep_alive': keep_alive}
+        if options:
+            payload['options'] = options
+        response = await self._open_stream('/api/chat', payload)
+        try:
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if 'error' in data:
+                    raise RuntimeError(data['error'])
+                content = data.get('message', {}).get('content')
+                if content:
+                    yield content
+                if data.get('done'):
+                    if on_done:
+                        on_done(data)
+                    break
+        finally:
+            await response.aclose()
+
+    # 后端已加载或可用的模型（/api/tags），用于健康检查
+    async def list_models(self, timeout=2.0) -> List[str]:
+        response = await self._client().get('/api/tags', timeout=timeout)
+        response.raise_for_status()
+        return [model['name'] for model in response.json().get('models', [])]
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+# 异步请求管线
+class AsyncPipeline:
+    """排队（公平调度）→ 检索文档 → 构造上下文 → 流式生成 → 写入会话日志
+
+    cancel(session_id) 停止会话中正在进行的生成，关闭到后端的流并释放名额；
+    部分回答按 partial_policy（drop / keep）处理。
+    """
+
+    def __init__(self, sessions, client=None, scheduler=None, retriever=None, cache=response_cache,
+                 partial_policy=PARTIAL_ANSWER_POLICY):
+        self.sessions = sessions
+        self.client = client or AsyncOllamaClient()
+        self.scheduler = scheduler or FairScheduler()
+        self.retriever = retriever
+        self.cache = cache
+        self.partial_policy = partial_policy
+        self.flights = AsyncSingleFlight()
+        self._session_locks = weakref.WeakValueDictionary()
+        self._session_waiting = {}  # session_id -> 在会话锁上等待的请求数
+        self._active = {}           # session_id -> (正在生成的一轮的取消标志, 优先级)
+
+    # 停止会话中正在进行的生成（priority 不为 None 时只停止该优先级的）；返回是否有需要停止的生成
+    def cancel(self, session_id, priority=None):
+        cancelled, active_priority = self._active.get(session_id, (None, None))
+        if cancelled is None or cancelled.is_set() or priority not in (None, active_priority):
+            return False
+        cancelled.set()
+        return True
+
+    def _session_lock(self, session_id):
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = self._session_locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def stream_turn(self, session_id, content: str, options: dict = None, references: List[dict] = None,
+                          model: str = DEFAULT_MODEL, trace: Trace = None, preempt: bool = False,
+                          priority: str = INTERACTIVE, documents: List[str] = None) -> AsyncIterator[str]:
+        """逐块返回回答文本（不含 <think> 推理过程）；排队已满时抛出 QueueFull
+
+        references 是随本轮提问发送的文档片段；为 None 时从会话已上传的文档中检索。
+        文档片段只发送给模型，不写入对话日志；documents 是本轮上传的文档 ID（内容哈希），记录在用户消息中。
+        trace 由调用方创建并结束。
+        preempt 为 True 时先停止该会话中还在进行的同优先级生成（用户不等上一个回答就发了新消息）。
+        priority 决定调度顺序（见 FairScheduler）；被更高优先级抢占时丢弃部分回答并抛出 Preempted。
+        """
+        trace = trace or Trace('pipeline')
+        if preempt:
+            self.cancel(session_id, priority)
+        queued = time.perf_counter()
+        # 同一会话的请求先在会话内排队，不占用全局名额；会话内排队同样受 max_queue_per_user 限制
+        lock = self._session_lock(session_id)
+        waiting = self._session_waiting.get(session_id, 0)
+        if lock.locked() and waiting >= self.scheduler.max_queue_per_user:
+            raise QueueFull('该会话排队的请求过多')
+        self._session_waiting[session_id] = waiting + 1
+        try:
+            await lock.acquire()
+        finally:
+            self._session_waiting[session_id] -= 1
+            if not self._session_waiting[session_id]:
+                del self._session_waiting[session_id]
+        cancelled = asyncio.Event()
+        self._active[session_id] = (cancelled, priority)
+        try:
+            async with self.scheduler.slot(session_id, priority, stop=cancelled) as slot:
+                trace.record_span('queue', time.perf_counter() - queued)
+                # 会话内已串行，这里的线程锁不会发生争用，只用来防止会话被 LRU 淘汰
+                if references is None and self.retriever is not None:
+                    with trace.span('retrieval'):
+                        references = await self._retrieve(session_id, content)
+                if cancelled.is_set():
+                    trace.cancel()
+                else:
+                    with self.sessions.session(session_id) as store:
+                        async with aclosing(self._generate(store, content, options, references, model, session_id,
+                                                           trace, slot, documents)) as stream:
+                            async for delta in stream:
+                                yield delta
+                if slot.preempted:
+                    raise Preempted('生成名额被交互请求抢占')
+        finally:
+            if self._active.get(session_id, (None,))[0] is cancelled:
+                del self._active[session_id]
+            lock.release()
+
+    # 带缓存的流式生成：命中时逐段回放，未命中时完整生成结束后写入缓存
+    # 相同请求正在生成时不再重复请求后端，直接订阅同一个流
+    async def _stream_chat(self, messages, options=None, on_done=None, model=DEFAULT_MODEL, affinity=None):
+        key = ResponseCache.key(model, messages, options)
+        cached = self.cache.get(key, options) if self.cache else None
+        if cached is not None:
+            for delta in replay(cached):
+                yield delta
+            return
+
+        async def upstream(finish):
+            parts = []
+            async for delta in self.client.stream_chat(messages, model=model, options=options, on_done=finish,
+                                                       affinity=affinity):
+                parts.append(delta)
+                yield delta
+            if self.cache:
+                self.cache.put(key, "".join(parts), options)
+
+        async with aclosing(self.flights.stream(key, upstream, on_done)) as stream:
+            async for delta in stream:
+                yield delta
+
+    async def _retrieve(self, session_id, content):
+        doc_ids = self.sessions.documents(session_id)
+        if not doc_ids:
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.retriever.search, doc_ids, content)
+
+    # 写入会话日志（含 fsync）和摘要调度在线程池中进行，磁盘慢时不阻塞事件循环中的其他流；
+    # shield 保证调用方再次被取消时这一轮仍然完整写入
+    async def _save_turn(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        await asyncio.shield(loop.run_in_executor(None, functools.partial(save_turn, *args, **kwargs)))
+
+    async def _generate(self, store, content, options, references=None, model=DEFAULT_MODEL, affinity=None,
+                        trace=None, slot=None, documents=None):
+        loop = asyncio.get_running_loop()
+        with trace.span('history'):
+            # 读取摘要文件在线程池中进行
+            conversation, offset, summary = await loop.run_in_executor(None, memory.apply, store, store.messages(),
+                                                                       store.offset())
+        user_message = {"role": "user", "content": content}
+        if documents:
+            user_message['documents'] = documents
+        if references:
+            conversation.append({"role": "user", "content": format_references(references, content)})
+        else:
+            conversation.append(user_message)
+        with trace.span('context'):
+            context = context_builder.build(conversation, offset=offset, summary=summary)
+        logger.info('[%s] 发送上下文：%d 条消息，约 %d tokens，丢弃 %d 条旧消息',
+                    trace.request_id, len(context.messages), context.tokens, context.dropped)
+
+        splitter = ReasoningSplitter()
+        stopped = failed = False
+        try:
+            with trace.span('generation'):
+                on_done = functools.partial(record_turn_stats, context, trace=trace, model=model)
+                async with aclosing(self._stream_chat(context.messages, options=options, on_done=on_done,
+                                                      model=model, affinity=affinity)) as stream:
+                    async for delta in stream:
+                        if slot is not None and slot.stop.is_set():
+                            stopped = True
+                            break
+                        _, answer = splitter.feed(delta)
+                        if answer:
+                            trace.first_token()
+                            yield answer
+                if not stopped:
+                    _, answer = splitter.finish()
+                    if answer:
+                        yield answer
+        except Exception as e:
+            # 错误提示只发给调用方，不写进回答（见 streaming.stream_turn）
+            trace.fail(e)
+            failed = True
+            yield f"⚠️ 请求出错: {str(e)}"
+        except (GeneratorExit, asyncio.CancelledError):
+            # 调用方关闭了生成器或任务被取消（页面关闭、Gradio 取消事件）
+            await self._save_turn(store, user_message, splitter, trace, cancelled=True, policy=self.partial_policy)
+            raise
+
+        # 被抢占的一轮稍后会整体重试，部分回答不保留
+        policy = 'drop' if slot is not None and slot.preempted else self.partial_policy
+        await self._save_turn(store, user_message, splitter, trace, cancelled=stopped, policy=policy, failed=failed)
@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import aclosing
+
+import httpx
+
+from analysis import DEFAULT_FILE_QUESTION, FILE_EXCERPT_TOKENS, prepare_document, analysis_messages
+from ingest import EXTRACTORS
+from ollama_client import DEFAULT_MODEL, BackendUnavailable
+from reasoning import split_reasoning
+from retrieval import Retriever
+from router import BackendRouter
+
+logger = logging.getLogger(__name__)
+
+WORKERS_PER_BACKEND = 2  # 每个后端同时处理的文件数：一个在生成时另一个可以读取文件，不会在后端堆积请求
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 2.0
+
+
+# 展开输入：目录递归查找支持的文件类型，其余按通配符匹配；去重并保持顺序
+def collect_files(inputs):
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, names in os.walk(item):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                             if os.path.splitext(name)[1].lower() in EXTRACTORS)
+        else:
+            files.extend(sorted(path for path in glob.glob(item, recursive=True) if os.path.isfile(path)))
+    return list(dict.fromkeys(os.path.abspath(path) for path in files))
+
+
+# 提问模板中可用的占位符：{name} 文件名、{stem} 不含扩展名的文件名、{path} 路径
+def render_question(template, path):
+    name = os.path.basename(path)
+    return template.format(name=name, stem=os.path.splitext(name)[0], path=path)
+
+
+# 检查提问模板：未知占位符、不成对的花括号在开始前就报错，而不是处理到一半抛出异常
+def check_template(template):
+    try:
+        render_question(template, 'example.txt')
+    except (KeyError, IndexError, ValueError, AttributeError) as e:
+        raise ValueError(f'提问模板无效（{type(e).__name__}: {e}）：可用的占位符为 {{name}} {{stem}} {{path}}，'
+                         f'字面的花括号（如 JSON）写成 {{{{ 和 }}}}') from None
+
+
+# 同一文件（路径、大小、修改时间）、同一提问和模型的结果可以复用
+def task_key(path, question, model):
+    stat = os.stat(path)
+    raw = json.dumps([path, stat.st_size, stat.st_mtime_ns, question, model], ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+# 读取输出文件中已成功的结果，断点续跑时跳过
+def load_checkpoint(output):
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中断时可能留下半行
+                continue
+            if record.get('status') == 'ok':
+                done.add(record['key'])
+    return done
+
+
+# 批量分析
+class BatchAnalyzer:
+    """对一批文件提同一个问题，结果逐行写入 JSONL
+
+    每个文件单独分析，不带对话历史；读取和索引与页面上传相同（analysis.py）。
+    同时处理的文件数由 workers 限制，后端不可用时退避重试；每条结果写入后立即落盘，
+    重新运行时跳过已成功的文件。
+    """
+
+    def __init__(self, client, retriever, output, template='', model=DEFAULT_MODEL,
+                 workers=4, excerpt_tokens=FILE_EXCERPT_TOKENS, options=None):
+        check_template(template)
+        self.client = client
+        self.retriever = retriever
+        self.output = output
+        self.template = template
+        self.model = model
+        self.workers = workers
+        self.excerpt_tokens = excerpt_tokens
+        self.options = options
+        self.counts = {'ok': 0, 'failed': 0, 'skipped': 0}
+        self._file = None
+
+    async def run(self, paths):
+        started = time.perf_counter()
+        done = load_checkpoint(self.output)
+        queue = asyncio.Queue()
+        for path in paths:
+            question = render_question(self.template, path)
+            key = task_key(path, question, self.model)
+            if key in done:
+                self.counts['skipped'] += 1
+            else:
+                queue.put_nowait((path, question, key))
+        total = queue.qsize()
+        logger.info('共 %d 个文件，已完成 %d 个，待处理 %d 个', len(paths), self.counts['skipped'], total)
+
+        self._open()
+        try:
+            workers = [asyncio.create_task(self._worker(queue, total)) for _ in range(min(self.workers, total))]
+            await asyncio.gather(*workers)
+        finally:
+            self._file.close()
+        elapsed = time.perf_counter() - started
+        processed = self.counts['ok'] + self.counts['failed']
+        return dict(self.counts, elapsed_s=round(elapsed, 1),
+                    files_per_min=round(processed / elapsed * 60, 1) if processed else 0.0)
+
+    def _open(self):
+        directory = os.path.dirname(self.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.output, 'a', encoding='utf-8')
+        # 上次中断在半行时先补上换行，避免与新记录拼在一起
+        if self._file.tell() > 0:
+            with open(self.output, 'rb') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    self._file.write('\n')
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def _worker(self, queue, total):
+        while not queue.empty():
+            path, question, key = queue.get_nowait()
+            record = await self.analyze(path, question, key)
+            self._write(record)
+            self.counts[record['status']] += 1
+            finished = self.counts['ok'] + self.counts['failed']
+            detail = f"{record['elapsed_s']}s" if record['status'] == 'ok' else record['error']
+            logger.info('[%d/%d] %s %s %s', finished, total, record['name'], record['status'], detail)
+
+    # 分析一个文件，返回结果记录；失败时记录错误而不中断整批
+    async def analyze(self, path, question, key):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        record = {'key': key, 'path': path, 'name': os.path.basename(path), 'question': question,
+                  'model': self.model, 'status': 'failed', 'answer': None, 'reasoning': None, 'error': None,
+                  'attempts': 0, 'prompt_tokens': None, 'completion_tokens': None}
+        try:
+            document = await loop.run_in_executor(None, prepare_document, path, self.retriever)
+            messages = await loop.run_in_executor(None, analysis_messages, document, question, self.retriever,
+                                                  self.excerpt_tokens)
+            while True:
+                record['attempts'] += 1
+                try:
+                    stats = {}
+                    text = await self._generate(messages, stats)
+                    break
+                except (BackendUnavailable, httpx.HTTPError) as e:
+                    if record['attempts'] >= MAX_ATTEMPTS:
+                        raise
+                    logger.warning('%s 生成失败，稍后重试：%s', record['name'], e)
+                    await asyncio.sleep(RETRY_DELAY * record['attempts'])
+            reasoning, answer = split_reasoning(text)
+            record.update(status='ok', answer=answer.strip(), reasoning=reasoning or None,
+                          prompt_tokens=stats.get('prompt_eval_count'), completion_tokens=stats.get('eval_count'))
+        except Exception as e:
+            logger.debug('分析 %s 失败', path, exc_info=True)
+            record['error'] = str(e) or type(e).__name__
+        record['elapsed_s'] = round(time.perf_counter() - started, 2)
+        record['finished'] = time.time()
+        return record
+
+    async def _generate(self, messages, stats):
+        parts = []
+        async with aclosing(self.client.stream_chat(messages, model=self.model, options=self.options,
+                                                    on_done=stats.update)) as stream:
+            async for delta in stream:
+                parts.append(delta)
+        return ''.join(parts)
+
+
+async def main(args):
+    paths = collect_files(args.inputs)
+    if not paths:
+        logger.error('没有找到要分析的文件')
+        return 1
+    router = BackendRouter()
+    workers = args.workers or WORKERS_PER_BACKEND * len(router.backends)
+    upload_dir = args.upload_dir or tempfile.mkdtemp(prefix='batch_uploads_')
+    options = {'temperature': args.temperature} if args.temperature is not None else None
+    analyzer = BatchAnalyzer(router, Retriever(upload_dir=upload_dir), args.output, template=args.prompt,
+                             model=args.model, workers=workers, excerpt_tokens=args.excerpt_tokens,
+                             options=options)
+    try:
+        result = await analyzer.run(paths)
+    finally:
+        await router.aclose()
+        if args.upload_dir is None:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+    print(json.dumps(result, ensure_ascii=False))
+    return 0 if result['failed'] == 0 else 2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='对一批文件提同一个问题，结果写入 JSONL；中断后重新运行会跳过已完成的文件')
+    parser.add_argument('inputs', nargs='+', help='目录（递归查找 .txt/.md/.pdf/.docx）或通配符，如 "docs/**/*.pdf"')
+    parser.add_argument('--prompt', default='', help=f'提问模板，可用 {{name}} {{stem}} {{path}}，字面的花括号写成 {{{{ }}}}；'
+                                                      f'默认「{DEFAULT_FILE_QUESTION}」')
+    parser.add_argument('--output', default='batch_results.jsonl')
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument('--workers', type=int, default=0,
+                        help=f'同时处理的文件数，默认每个后端 {WORKERS_PER_BACKEND} 个')
+    parser.add_argument('--excerpt-tokens', type=int, default=FILE_EXCERPT_TOKENS,
+                        help='不超过这么多 token 的文档整体发送，更长的文档检索与问题相关的片段')
+    parser.add_argument('--temperature', type=float)
+    parser.add_argument('--upload-dir', help='保留读取和索引结果的目录（如 uploads，已上传过的文件直接复用）；'
+                                             '默认使用临时目录，结束后删除')
+    args = parser.parse_args()
+    try:
+        check_template(args.prompt)
+    except ValueError as e:
+        parser.error(str(e))
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', stream=sys.stderr)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    try:
+        sys.exit(asyncio.run(main(args)))
+    except KeyboardInterrupt:
+        logger.info('已中断，已完成的结果保存在 %s，重新运行会从断点继续', args.output)
+        sys.exit(130)
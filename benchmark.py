@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_ollama import make_server
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MOCK_PORT = 11500
+APP_PORT = 5100
+
+
+# 百分位数（最近秩）
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def summarize(name, ttft, total, elapsed, turns, errors=0):
+    result = {'scenario': name, 'turns': turns, 'errors': errors, 'elapsed_s': elapsed,
+              'throughput_turns_s': turns / elapsed if elapsed else 0.0}
+    for label, values in (('ttft_ms', ttft), ('total_ms', total)):
+        for p in (50, 95, 99):
+            value = percentile(values, p)
+            result[f'{label}_p{p}'] = value * 1000 if value is not None else None
+    return result
+
+
+# 按文件路径加载入口模块（文件名中带点，不能直接 import）
+def load_app(filename):
+    spec = importlib.util.spec_from_file_location(os.path.splitext(filename)[0].replace('.', '_'),
+                                                  os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def prompt_for(args, user, turn):
+    if args.same_prompt:
+        return '请介绍一下你自己'
+    return f'用户 {user} 的第 {turn} 个问题：{random.random():.6f}'
+
+
+# Flask：每个用户一个 requests.Session（各自的会话 cookie），通过 /stream 读取 SSE
+def bench_flask(args):
+    from werkzeug.serving import make_server as make_wsgi_server
+
+    app = load_app('fl_version_0.2.py').app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_wsgi_server('127.0.0.1', APP_PORT, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{APP_PORT}/stream'
+
+    ttft, total, errors = [], [], [0]
+    lock = threading.Lock()
+
+    def user(index):
+        http = requests.Session()
+        for turn in range(args.turns):
+            started = time.perf_counter()
+            first = None
+            try:
+                with http.post(url, data={'prompt': prompt_for(args, index, turn)}, stream=True,
+                               timeout=300) as response:
+                    for line in response.iter_lines():
+                        if first is None and line.startswith(b'data: {"delta"'):
+                            first = time.perf_counter() - started
+            except requests.RequestException:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                ttft.append(first if first is not None else time.perf_counter() - started)
+                total.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.users) as pool:
+        list(pool.map(user, range(args.users)))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    return summarize('flask', ttft, total, elapsed, len(total), errors[0])
+
+
+# Gradio：直接驱动 gr_version_0.2.chat_with_ai（与界面事件调用的是同一个函数）
+def bench_gradio(args):
+    module = load_app('gr_version_0.2.py')
+    ttft, total = [], []
+
+    async def user(index):
+        chat_history, session_id, reasoning_ids = [], None, []
+        for turn in range(args.turns):
+            started = time.perf_counter()
+            first = None
+            async for _, chat_history, session_id, reasoning_ids in module.chat_with_ai(
+                    prompt_for(args, index, turn), chat_history, session_id, reasoning_ids, args.model):
+                if first is None and chat_history[-1][1] not in ('', module.THINKING_PLACEHOLDER):
+                    first = time.perf_counter() - started
+            ttft.append(first if first is not None else time.perf_counter() - started)
+            total.append(time.perf_counter() - started)
+
+    async def run():
+        await asyncio.gather(*(user(index) for index in range(args.users)))
+        await module.router.aclose()
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    return summarize('gradio', ttft, total, time.perf_counter() - started, len(total))
+
+
+# 对话存储：历史增长时每轮追加的耗时和文件大小
+def bench_store(args):
+    from conversation_store import ConversationStore
+
+    store = ConversationStore(os.path.join('chat_histories', 'bench.jsonl'))
+    answer = '这是一段用于测试的回答。' * 20
+    buckets = []
+    timings = []
+    for turn in range(1, args.store_turns + 1):
+        started = time.perf_counter()
+        store.append({'role': 'user', 'content': f'问题 {turn}'},
+                     {'role': 'assistant', 'content': answer, 'reasoning': '推理过程。' * 10})
+        timings.append(time.perf_counter() - started)
+        if turn % args.store_bucket == 0:
+            store.sync()
+            buckets.append({
+                'messages': len(store),
+                'append_ms_p50': percentile(timings, 50) * 1000,
+                'append_ms_p99': percentile(timings, 99) * 1000,
+                'log_bytes': os.path.getsize(store.path),
+                'memory_chars': store.memory_usage(),
+            })
+            timings = []
+    store.close()
+    return {'scenario': 'store', 'buckets': buckets}
+
+
+SCENARIOS = {'flask': bench_flask, 'gradio': bench_gradio, 'store': bench_store}
+
+
+def print_result(result):
+    if result['scenario'] == 'store':
+        print('\n[store]')
+        print(f"{'messages':>10} {'p50 ms':>10} {'p99 ms':>10} {'log bytes':>12} {'mem chars':>12}")
+        for bucket in result['buckets']:
+            print(f"{bucket['messages']:>10} {bucket['append_ms_p50']:>10.3f} {bucket['append_ms_p99']:>10.3f} "
+                  f"{bucket['log_bytes']:>12} {bucket['memory_chars']:>12}")
+        return
+    print(f"\n[{result['scenario']}] {result['turns']} turns, {result['errors']} errors, "
+          f"{result['throughput_turns_s']:.2f} turns/s")
+    for label in ('ttft_ms', 'total_ms'):
+        values = ' '.join(f"p{p}={result[f'{label}_p{p}']:.1f}" for p in (50, 95, 99)
+                          if result[f'{label}_p{p}'] is not None)
+        print(f'  {label:<9} {values}')
+
+
+# 与基线比较：p95 延迟变慢或吞吐下降超过 tolerance 视为回归
+def compare(results, baseline, tolerance):
+    regressions = []
+    previous = {result['scenario']: result for result in baseline}
+    for result in results:
+        old = previous.get(result['scenario'])
+        if not old or result['scenario'] == 'store':
+            continue
+        for key in ('ttft_ms_p95', 'total_ms_p95'):
+            if old.get(key) and result.get(key) and result[key] > old[key] * (1 + tolerance):
+                regressions.append(f"{result['scenario']} {key}: {old[key]:.1f} -> {result[key]:.1f}")
+        if old['throughput_turns_s'] and result['throughput_turns_s'] < old['throughput_turns_s'] * (1 - tolerance):
+            regressions.append(f"{result['scenario']} throughput: {old['throughput_turns_s']:.2f} -> "
+                               f"{result['throughput_turns_s']:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用模拟的 Ollama 服务压测各个入口，不需要 GPU 和网络')
+    parser.add_argument('scenarios', nargs='*', default=['flask', 'store'], choices=sorted(SCENARIOS))
+    parser.add_argument('--users', type=int, default=8, help='并发用户数')
+    parser.add_argument('--turns', type=int, default=5, help='每个用户的对话轮数')
+    parser.add_argument('--model', default='deepseek-r1:1.5b')
+    parser.add_argument('--latency', type=float, default=0.05, help='模拟的首 token 延迟（秒）')
+    parser.add_argument('--tokens-per-second', type=float, default=200.0, help='模拟的生成速度')
+    parser.add_argument('--reply-tokens', type=int, default=100, help='每个回答的 token 数')
+    parser.add_argument('--same-prompt', action='store_true', help='所有用户发送相同的问题（测试缓存和请求合并）')
+    parser.add_argument('--store-turns', type=int, default=5000)
+    parser.add_argument('--store-bucket', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    parser.add_argument('--baseline', help='与之前保存的 JSON 结果比较')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    # 运行期间会切换到临时目录，结果文件的相对路径按调用时的工作目录解析
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    reply = '<think>\n' + '思考' * (args.reply_tokens // 4) + '\n</think>\n\n' + '回答' * args.reply_tokens
+    mock = make_server(MOCK_PORT, models=[args.model], reply=reply, chunk_size=2,
+                       first_token_delay=args.latency, token_delay=1.0 / args.tokens_per_second)
+    threading.Thread(target=mock.serve_forever, daemon=True).start()
+    os.environ['OLLAMA_URL'] = os.environ['OLLAMA_BACKENDS'] = f'http://127.0.0.1:{MOCK_PORT}'
+
+    # 会话日志、上传文件等写到临时目录，不影响工作目录
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    results = []
+    try:
+        for name in args.scenarios:
+            result = SCENARIOS[name](args)
+            print_result(result)
+            results.append(result)
+    finally:
+        mock.shutdown()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if baseline:
+        with open(baseline, 'r', encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
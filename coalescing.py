@@ -0,0 +1,204 @@
+import asyncio
+import threading
+from typing import AsyncIterator, Iterator
+
+COALESCED_DATA = {'coalesced': True}  # 合并到已有请求上的订阅者结束时收到的数据，不含上游的 token 统计
+
+
+# 一次正在进行的上游生成：已生成的块、结束时的统计数据和错误
+class _Flight:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.done_data = None
+        self.error = None
+        self.subscribers = 0
+        self.cancelled = False
+        self.reported = False
+
+    def finish_data(self, data):
+        self.done_data = data
+
+    # 上游的统计只交给第一个取用的订阅者记录一次，其余订阅者只得到合并标记，
+    # 否则 N 个订阅者会把同一次生成的 token 数记 N 遍
+    def take_done_data(self):
+        if self.done_data is None:
+            return None
+        if self.reported:
+            return COALESCED_DATA
+        self.reported = True
+        return self.done_data
+
+
+# 同步的请求合并（线程）
+class SingleFlight:
+    """相同 key 的并发请求只向上游发起一次
+
+    stream：上游流在后台线程中读取，每个订阅者从头依次收到全部块（晚到的先补齐已生成的部分）；
+    所有订阅者都离开（客户端断开、用户停止）后关闭上游流，后端随之停止生成。
+    call：阻塞调用，其余请求等待第一个请求的结果。
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.upstream = 0  # 实际发往上游的请求数
+        self.joined = 0    # 合并到已有请求上的次数
+
+    def _join(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                flight.cond = threading.Condition()
+                self.upstream += 1
+            else:
+                self.joined += 1
+            flight.subscribers += 1
+            return flight, leader
+
+    # 订阅者离开；没有订阅者且还没生成完时取消上游，之后相同的请求重新发起
+    def _leave(self, key, flight):
+        with self._lock:
+            flight.subscribers -= 1
+            if flight.subscribers or flight.done:
+                return
+            flight.cancelled = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    # factory(on_done) 返回上游的文本块迭代器；on_done 在生成结束后以最后一条数据调用，
+    # 合并进来的订阅者收到的是 COALESCED_DATA
+    def stream(self, key, factory, on_done=None) -> Iterator[str]:
+        flight, leader = self._join(key)
+        if leader:
+            threading.Thread(target=self._produce, args=(key, flight, factory), daemon=True).start()
+        index = 0
+        try:
+            while True:
+                with flight.cond:
+                    while index >= len(flight.chunks) and not flight.done:
+                        flight.cond.wait()
+                    chunks = flight.chunks[index:]
+                    done = flight.done
+                index += len(chunks)
+                yield from chunks
+                if done and index >= len(flight.chunks):
+                    break
+        finally:
+            self._leave(key, flight)
+        if flight.error is not None:
+            raise flight.error
+        if on_done:
+            with flight.cond:
+                data = flight.take_done_data()
+            if data is not None:
+                on_done(data)
+
+    def _produce(self, key, flight, factory):
+        chunks = None
+        try:
+            # factory 本身也可能出错（call 在这里发出请求），同样记为本次请求的错误并结束，
+            # 否则等待中的订阅者和之后相同的请求会一直阻塞
+            chunks = factory(flight.finish_data)
+            for chunk in chunks:
+                if flight.cancelled:
+                    break
+                with flight.cond:
+                    flight.chunks.append(chunk)
+                    flight.cond.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            # 提前退出时关闭上游迭代器，连同 HTTP 连接一起释放
+            if chunks is not None and hasattr(chunks, 'close'):
+                chunks.close()
+            with self._lock:
+                # 结束后不再接受新的订阅者，之后相同的请求重新发起
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            with flight.cond:
+                flight.done = True
+                flight.cond.notify_all()
+
+    def call(self, key, fn):
+        flight, leader = self._join(key)
+        if leader:
+            self._produce(key, flight, lambda _: iter([fn()]))
+        else:
+            with flight.cond:
+                while not flight.done:
+                    flight.cond.wait()
+        with self._lock:
+            flight.subscribers -= 1
+        if flight.error is not None:
+            raise flight.error
+        return flight.chunks[0]
+
+    def stats(self):
+        with self._lock:
+            return {'upstream': self.upstream, 'joined': self.joined, 'in_flight': len(self._flights)}
+
+
+# 异步的请求合并（asyncio）
+class AsyncSingleFlight:
+    """与 SingleFlight.stream 相同，上游流在单独的任务中读取；所有订阅者离开后取消该任务"""
+
+    def __init__(self):
+        self._flights = {}
+        self.upstream = 0
+        self.joined = 0
+
+    async def stream(self, key, factory, on_done=None) -> AsyncIterator[str]:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.changed = asyncio.Event()
+            self.upstream += 1
+            flight.task = asyncio.get_running_loop().create_task(self._produce(key, flight, factory))
+        else:
+            self.joined += 1
+        flight.subscribers += 1
+
+        index = 0
+        try:
+            while True:
+                if index >= len(flight.chunks) and not flight.done:
+                    flight.changed.clear()
+                    await flight.changed.wait()
+                    continue
+                chunks = flight.chunks[index:]
+                index += len(chunks)
+                for chunk in chunks:
+                    yield chunk
+                if flight.done and index >= len(flight.chunks):
+                    break
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.done:
+                # 取消读取上游的任务，httpx 的响应随之关闭
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+        if flight.error is not None:
+            raise flight.error
+        data = flight.take_done_data() if on_done else None
+        if data is not None:
+            on_done(data)
+
+    async def _produce(self, key, flight, factory):
+        try:
+            async for chunk in factory(flight.finish_data):
+                flight.chunks.append(chunk)
+                flight.changed.set()
+        except Exception as e:
+            flight.error = e
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.done = True
+            flight.changed.set()
+
+    def stats(self):
+        return {'upstream': self.upstream, 'joined': self.joined, 'in_flight': len(self._flights)}
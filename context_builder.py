@@ -0,0 +1,92 @@
+import re
+from collections import namedtuple
+
+THINK_PATTERN = re.compile(r'<think>.*?(</think>|$)', re.S)
+CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+MESSAGE_OVERHEAD = 4  # 每条消息的角色标记、换行等额外开销
+TRUNCATED_MARK = "\n…（内容过长，已截断）"
+
+BuiltContext = namedtuple('BuiltContext', ['messages', 'tokens', 'dropped'])
+
+
+# 粗略估算 token 数：中日韩字符按 1 个 token 计，其余字符约 4 个算 1 个
+def estimate_tokens(text):
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+# 去掉回复中的 <think> 推理过程，只保留最终回答
+def strip_think(text):
+    return THINK_PATTERN.sub('', text).strip()
+
+
+# 按 token 预算构造上下文
+class ContextBuilder:
+    """保留系统提示词和最近的消息，历史中的推理过程被去掉，超出预算的旧消息被丢弃
+
+    丢弃旧消息时，窗口起点按 align 条消息对齐到对话中的绝对位置，
+    这样连续多轮发送的消息前缀逐字节相同，后端可以复用已缓存的 KV；
+    对齐后连上一轮都保留不了时不对齐。
+    """
+
+    def __init__(self, budget=4096, estimator=estimate_tokens, system_prompt=None, align=8):
+        self.budget = budget
+        self.estimator = estimator
+        self.system_prompt = system_prompt
+        self.align = align
+
+    def cost(self, message):
+        return self.estimator(message['content']) + MESSAGE_OVERHEAD
+
+    # 历史消息的发送形式：回答中去掉推理过程
+    @staticmethod
+    def prepare(message):
+        if message['role'] == 'assistant':
+            return {"role": "assistant", "content": strip_think(message['content'])}
+        return {"role": message['role'], "content": message['content']}
+
+    # 把文本截断到大约 tokens 个 token（按字符比例估算）
+    def truncate(self, text, tokens):
+        total = self.estimator(text)
+        if total <= tokens:
+            return text
+        keep = max(0, len(text) * tokens // total - len(TRUNCATED_MARK))
+        return text[:keep] + TRUNCATED_MARK
+
+    def build(self, conversation, system_prompt=None, offset=0, summary=None):
+        """conversation 的最后一条是本轮的用户消息，offset 是 conversation[0] 在完整对话中的位置
+
+        summary 是更早对话的摘要消息（见 memory.py），放在系统提示词之后。
+        返回 BuiltContext(messages, tokens, dropped)
+        """
+        system_prompt = system_prompt or self.system_prompt
+        head = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        if summary:
+            head.append(summary)
+        remaining = self.budget - sum(self.cost(message) for message in head)
+        messages = [self.prepare(message) for message in conversation]
+
+        start = len(messages)
+        while start > 0 and self.cost(messages[start - 1]) <= remaining:
+            start -= 1
+            remaining -= self.cost(messages[start])
+
+        if start == len(messages):
+            # 本轮消息本身就超出预算（例如上传的大文件），截断后单独发送
+            start -= 1
+            last = messages[start]
+            messages[start] = {"role": last['role'],
+                               "content": self.truncate(last['content'], max(0, remaining - MESSAGE_OVERHEAD))}
+        elif offset + start > 0 and self.align > 1:
+            aligned = -(-(offset + start) // self.align) * self.align - offset
+            # 对齐后还能保留上一轮问答时才对齐；否则不对齐，不能为了前缀稳定丢掉预算内的全部历史
+            if aligned <= len(messages) - 3:
+                start = aligned
+
+        # 按轮次丢弃：不保留缺少提问的孤立回答
+        while start < len(messages) - 1 and messages[start]['role'] == 'assistant':
+            start += 1
+
+        selected = head + messages[start:]
+        tokens = sum(self.cost(message) for message in selected)
+        return BuiltContext(selected, tokens, start)
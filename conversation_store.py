@@ -0,0 +1,286 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from reasoning import split_reasoning
+
+LOG_SUFFIX = '.jsonl'
+REASONING_SUFFIX = '.reasoning.jsonl'
+SUMMARY_SUFFIX = '.summary.json'
+
+
+# 截掉文件末尾不完整的一行（进程在写入中途崩溃时留下），否则下一条追加的记录会接在半行后面，两条一起无法解析
+def truncate_partial_line(path, block_size=64 * 1024):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as file:
+        end = file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            file.seek(start)
+            block = file.read(position - start)
+            index = block.rfind(b'\n')
+            if index >= 0:
+                position = start + index + 1
+                break
+            position = start
+        if position < end:
+            file.truncate(position)
+
+
+# 追加写入的对话存储
+class ConversationStore:
+    """对话日志：每条消息一行 JSON，只追加不重写，内存里只保留最近的消息
+
+    回答的推理过程（reasoning 字段）单独存放在 <name>.reasoning.jsonl，
+    日志中的消息只保留 reasoning_id，需要时再按 ID 读取。
+    较早轮次的摘要（见 memory.py）保存在 <name>.summary.json，清空对话时一并删除。
+    每条消息追加时记录写入时间（time 字段，Unix 时间戳），旧日志中的消息没有这个字段。
+    """
+
+    def __init__(self, path, tail_size=200, fsync_every=8, fsync_interval=1.0, compact_threshold=1000):
+        # 兼容旧的 conversation.json：日志文件放在同名的 .jsonl 中
+        base, ext = os.path.splitext(path)
+        self.legacy_path = path if ext == '.json' else None
+        self.path = base + LOG_SUFFIX
+        self.reasoning_path = base + REASONING_SUFFIX
+        self.summary_path = base + SUMMARY_SUFFIX
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+
+        self._lock = threading.RLock()
+        self._tail = deque(maxlen=tail_size)
+        self._count = 0     # 有效消息数
+        self._tail_chars = 0  # 内存尾部的消息字符数，用于估算占用
+        self._records = 0   # 日志中的总记录数（包括已被清空的）
+        self._pending = 0   # 尚未 fsync 的记录数
+        self._last_sync = time.monotonic()
+        self._file = None
+        self._reasoning_file = None
+        self._reasoning_offsets = None  # reasoning_id -> 字节位置，首次读取时建立
+        self._open()
+
+    def __len__(self):
+        return self._count
+
+    # 打开日志：首次使用时导入旧的 JSON 文件，然后扫描一遍填充内存尾部
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(self.path) and self.legacy_path and os.path.exists(self.legacy_path):
+            self._import_legacy()
+
+        truncate_partial_line(self.path)
+        for record in self._iter_records():
+            self._apply(record)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._records - self._count > self.compact_threshold:
+            self.compact()
+
+    def _import_legacy(self):
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as file:
+                conversation = json.load(file)
+        except (OSError, ValueError):
+            conversation = []
+        # 旧文件中回答里的 <think> 推理过程同样拆到单独的文件
+        for index, message in enumerate(conversation):
+            if message.get('role') == 'assistant':
+                reasoning, answer = split_reasoning(message.get('content', ''))
+                if reasoning:
+                    conversation[index] = self._store_reasoning(dict(message, content=answer, reasoning=reasoning))
+        self._write_atomic(conversation)
+
+    def _iter_records(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # 末尾的半行在打开时已截掉，这里只跳过其他无法解析的行
+                    continue
+
+    def _apply(self, record):
+        self._records += 1
+        if record.get('op') == 'clear':
+            self._tail.clear()
+            self._tail_chars = 0
+            self._count = 0
+        else:
+            if len(self._tail) == self._tail.maxlen:
+                self._tail_chars -= len(self._tail[0].get('content', ''))
+            self._tail.append(record)
+            self._tail_chars += len(record.get('content', ''))
+            self._count += 1
+
+    def _write_atomic(self, messages):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            for message in messages:
+                file.write(json.dumps(message, ensure_ascii=False) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _write(self, records):
+        # 一次 write 写入整轮对话，避免只落盘一半
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        self._file.write(data)
+        self._file.flush()
+        for record in records:
+            self._apply(record)
+        self._pending += len(records)
+        now = time.monotonic()
+        if self._pending >= self.fsync_every or now - self._last_sync >= self.fsync_interval:
+            self._sync()
+        if self._records - self._count > self.compact_threshold:
+            self.compact()
+
+    def _sync(self):
+        if self._reasoning_file is not None:
+            os.fsync(self._reasoning_file.fileno())
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    # 最近的消息（内存中的尾部），每轮对话不需要读盘
+    def messages(self):
+        with self._lock:
+            return list(self._tail)
+
+    # 内存尾部第一条消息在完整对话中的位置
+    def offset(self):
+        with self._lock:
+            return self._count - len(self._tail)
+
+    # 内存尾部占用的字符数
+    def memory_usage(self):
+        return self._tail_chars
+
+    # 追加一条或多条消息；没有 time 字段的消息记为当前时间。返回写入的记录（推理过程已换成 reasoning_id）
+    def append(self, *messages):
+        now = round(time.time(), 3)
+        with self._lock:
+            records = [self._store_reasoning(message if 'time' in message else dict(message, time=now))
+                       for message in messages]
+            self._write(records)
+            return records
+
+    # 把推理过程写入单独的文件，消息中换成 reasoning_id
+    def _store_reasoning(self, message):
+        if 'reasoning' not in message:
+            return message
+        message = dict(message)
+        reasoning = message.pop('reasoning')
+        if not reasoning:
+            return message
+        if self._reasoning_file is None:
+            truncate_partial_line(self.reasoning_path)
+            self._reasoning_file = open(self.reasoning_path, 'ab')
+        reasoning_id = uuid.uuid4().hex
+        offset = self._reasoning_file.tell()
+        self._reasoning_file.write((json.dumps({'id': reasoning_id, 'reasoning': reasoning},
+                                               ensure_ascii=False) + '\n').encode('utf-8'))
+        self._reasoning_file.flush()
+        if self._reasoning_offsets is not None:
+            self._reasoning_offsets[reasoning_id] = offset
+        message['reasoning_id'] = reasoning_id
+        return message
+
+    def _iter_reasoning(self):
+        if not os.path.exists(self.reasoning_path):
+            return
+        with open(self.reasoning_path, 'rb') as file:
+            offset = 0
+            for line in file:
+                try:
+                    yield offset, json.loads(line)
+                except ValueError:
+                    pass
+                offset += len(line)
+
+    # 按 ID 读取一条回答的推理过程，不存在时返回 None
+    def reasoning(self, reasoning_id):
+        with self._lock:
+            if self._reasoning_offsets is None:
+                self._reasoning_offsets = {record['id']: offset for offset, record in self._iter_reasoning()}
+            offset = self._reasoning_offsets.get(reasoning_id)
+            if offset is None:
+                return None
+            with open(self.reasoning_path, 'rb') as file:
+                file.seek(offset)
+                return json.loads(file.readline())['reasoning']
+
+    # 清空对话：只写入一条标记，旧记录在压缩时删除；之前的摘要随之作废
+    def clear(self):
+        with self._lock:
+            self._write([{'op': 'clear'}])
+            if os.path.exists(self.summary_path):
+                os.remove(self.summary_path)
+
+    # 从磁盘读取全部有效消息（历史查看、导出时使用）
+    def read_all(self):
+        with self._lock:
+            self._file.flush()
+            conversation = []
+            for record in self._iter_records():
+                if record.get('op') == 'clear':
+                    conversation = []
+                else:
+                    conversation.append(record)
+            return conversation
+
+    # 压缩：丢弃已清空的记录，原子替换日志文件
+    def compact(self):
+        with self._lock:
+            conversation = self.read_all()
+            self._file.close()
+            self._write_atomic(conversation)
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._records = self._count = len(conversation)
+            self._pending = 0
+            self._last_sync = time.monotonic()
+            self._compact_reasoning(conversation)
+
+    # 推理过程文件只保留仍被引用的记录
+    def _compact_reasoning(self, conversation):
+        if not os.path.exists(self.reasoning_path):
+            return
+        referenced = {message['reasoning_id'] for message in conversation if 'reasoning_id' in message}
+        if self._reasoning_file is not None:
+            self._reasoning_file.close()
+            self._reasoning_file = None
+        tmp_path = self.reasoning_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            for _, record in self._iter_reasoning():
+                if record['id'] in referenced:
+                    file.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.reasoning_path)
+        self._reasoning_offsets = None
+
+    def sync(self):
+        with self._lock:
+            self._file.flush()
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._file and not self._file.closed:
+                self.sync()
+                self._file.close()
+            if self._reasoning_file is not None:
+                self._reasoning_file.close()
+                self._reasoning_file = None
@@ -0,0 +1,117 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from ingest import UPLOAD_DIR
+
+logger = logging.getLogger(__name__)
+
+REFS_FILE = 'refs.json'
+GC_GRACE_SECONDS = 3600  # 刚入库、还没被会话引用的文档在这段时间内不回收
+
+
+# 上传文档的引用计数
+class DocumentStore:
+    """uploads/ 下按内容哈希存放的文档（见 ingest.ingest_file），记录哪些会话引用了哪些文档
+
+    引用保存在 uploads/refs.json（{doc_id: [会话 ID, ...]}），引用数即列表长度；
+    同一文档被多个会话引用时只存一份，最后一个引用解除后由 collect 回收。
+    """
+
+    def __init__(self, upload_dir=UPLOAD_DIR):
+        self.upload_dir = upload_dir
+        self.path = os.path.join(upload_dir, REFS_FILE)
+        self._lock = threading.Lock()
+        os.makedirs(upload_dir, exist_ok=True)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def _save(self, refs):
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(refs, file, separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
+
+    # 增加引用；返回引用数
+    def retain(self, doc_id, owner):
+        with self._lock:
+            refs = self._load()
+            owners = refs.setdefault(doc_id, [])
+            if owner not in owners:
+                owners.append(owner)
+                self._save(refs)
+            return len(owners)
+
+    # 解除引用；返回剩余的引用数
+    def release(self, doc_id, owner):
+        with self._lock:
+            refs = self._load()
+            owners = refs.get(doc_id, [])
+            if owner in owners:
+                owners.remove(owner)
+                if not owners:
+                    del refs[doc_id]
+                self._save(refs)
+            return len(owners)
+
+    def refcount(self, doc_id):
+        with self._lock:
+            return len(self._load().get(doc_id, []))
+
+    # 按会话目录中的 <session_id>.docs.json 重新统计引用（旧版本上传的文档、手动删除会话后修复计数）
+    def rebuild(self, session_dir):
+        refs = {}
+        for path in glob.glob(os.path.join(session_dir, '*.docs.json')):
+            owner = os.path.basename(path)[:-len('.docs.json')]
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    doc_ids = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for doc_id in doc_ids:
+                refs.setdefault(doc_id, []).append(owner)
+        with self._lock:
+            self._save(refs)
+        return refs
+
+    # 回收没有引用的文档和中断入库留下的临时目录；返回回收的目录数和字节数
+    def collect(self, grace_seconds=GC_GRACE_SECONDS):
+        cutoff = time.time() - grace_seconds
+        removed = freed = 0
+        with self._lock:
+            refs = self._load()
+            for entry in os.scandir(self.upload_dir):
+                if not entry.is_dir() or entry.name in refs or entry.stat().st_mtime >= cutoff:
+                    continue
+                size = sum(os.path.getsize(os.path.join(root, name))
+                           for root, _, names in os.walk(entry.path) for name in names)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+                freed += size
+        if removed:
+            logger.info('回收 %d 个未被引用的文档，释放 %d 字节', removed, freed)
+        return removed, freed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='回收没有会话引用的上传文档')
+    parser.add_argument('--dir', default=UPLOAD_DIR)
+    parser.add_argument('--sessions', default='chat_histories', help='会话目录，配合 --rebuild 使用')
+    parser.add_argument('--rebuild', action='store_true', help='先按会话目录重新统计引用')
+    parser.add_argument('--grace', type=float, default=GC_GRACE_SECONDS, help='不回收最近这么多秒内入库的文档')
+    args = parser.parse_args()
+
+    store = DocumentStore(args.dir)
+    if args.rebuild:
+        print(f'{len(store.rebuild(args.sessions))} 个文档被引用')
+    removed, freed = store.collect(args.grace)
+    print(f'回收 {removed} 个文档，释放 {freed} 字节')
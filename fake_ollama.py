@@ -0,0 +1,110 @@
+import argparse
+import json
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "<think>\n这是模拟的推理过程。\n</think>\n\n这是来自模拟 Ollama 服务的回答。"
+
+
+# 模拟的 Ollama 服务：实现 /api/tags、/api/chat、/api/generate、/api/embed，用于本地测试路由和压测
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    models = ['deepseek-r1:1.5b']
+    reply = DEFAULT_REPLY
+    first_token_delay = 0.05  # 首 token 前的等待（秒），模拟 prompt 计算
+    token_delay = 0.01        # 每个 token 之间的等待（秒）
+    chunk_size = 4            # 每个流式块的字符数
+    fail = False              # 为 True 时所有请求返回 503，模拟故障节点
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.fail:
+            return self._send_json({'error': 'unavailable'}, 503)
+        if self.path == '/api/tags':
+            return self._send_json({'models': [{'name': name} for name in self.models]})
+        self._send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if self.fail:
+            return self._send_json({'error': 'unavailable'}, 503)
+        if payload.get('model') not in self.models:
+            return self._send_json({'error': f"model '{payload.get('model')}' not found"}, 404)
+        if self.path == '/api/embed':
+            texts = payload['input'] if isinstance(payload['input'], list) else [payload['input']]
+            return self._send_json({'embeddings': [[float(len(text)), 1.0, 0.5] for text in texts]})
+        if self.path not in ('/api/chat', '/api/generate'):
+            return self._send_json({'error': 'not found'}, 404)
+
+        chat = self.path == '/api/chat'
+        prompt = json.dumps(payload.get('messages') or payload.get('prompt'), ensure_ascii=False)
+        chunks = [self.reply[i:i + self.chunk_size] for i in range(0, len(self.reply), self.chunk_size)]
+        final = {
+            'model': payload['model'], 'done': True,
+            'prompt_eval_count': len(prompt) // 4, 'prompt_eval_duration': int(self.first_token_delay * 1e9),
+            'eval_count': len(chunks), 'eval_duration': int(self.token_delay * len(chunks) * 1e9),
+        }
+        time.sleep(self.first_token_delay)
+        if not payload.get('stream', True):
+            time.sleep(self.token_delay * len(chunks))
+            final.update({'message': {'role': 'assistant', 'content': self.reply}} if chat else
+                         {'response': self.reply})
+            return self._send_json(final)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks:
+            data = {'model': payload['model'], 'done': False}
+            data.update({'message': {'role': 'assistant', 'content': chunk}} if chat else {'response': chunk})
+            self._write_chunk(data)
+            time.sleep(self.token_delay)
+        self._write_chunk(final)
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, data):
+        line = (json.dumps(data, ensure_ascii=False) + '\n').encode('utf-8')
+        self.wfile.write(f'{len(line):x}\r\n'.encode('ascii') + line + b'\r\n')
+        self.wfile.flush()
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # 客户端断开连接（压测结束、连接池关闭）是正常情况，不打印堆栈
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+# 创建模拟服务；参数覆盖 FakeOllamaHandler 上的同名属性
+def make_server(port=11434, host='127.0.0.1', **settings):
+    handler = type('Handler', (FakeOllamaHandler,), settings)
+    return FakeOllamaServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='模拟的 Ollama 服务')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--models', default='deepseek-r1:1.5b', help='逗号分隔的模型名')
+    parser.add_argument('--first-token-delay', type=float, default=0.05)
+    parser.add_argument('--token-delay', type=float, default=0.01)
+    args = parser.parse_args()
+
+    server = make_server(args.port, models=args.models.split(','), first_token_delay=args.first_token_delay,
+                         token_delay=args.token_delay)
+    print(f'Fake Ollama listening on http://127.0.0.1:{args.port}')
+    server.serve_forever()
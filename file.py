@@ -1,47 +1,39 @@
 import gradio as gr
-import requests
-import json
-import os
-
-CONVERSATION_FILE = 'conversation.json'
 
+from conversation_store import ConversationStore
+from ollama_client import client
+from reasoning import split_reasoning
+from streaming import context_builder
 
-def load_conversation():
-    if os.path.exists(CONVERSATION_FILE):
-        with open(CONVERSATION_FILE, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    return []
+CONVERSATION_FILE = 'conversation.json'
 
 
-def save_conversation(conversation):
-    with open(CONVERSATION_FILE, 'w', encoding='utf-8') as file:
-        json.dump(conversation, file, ensure_ascii=False, indent=4)
+# 对话历史：追加写入的日志，每轮只写新增的两条消息
+store = ConversationStore(CONVERSATION_FILE)
 
 
 def chat_with_ai(message, chat_history):
     # 加载对话历史
-    conversation = load_conversation()
+    conversation = store.messages()
 
     # 添加用户消息
-    conversation.append({"role": "user", "content": message})
+    user_message = {"role": "user", "content": message}
+    conversation.append(user_message)
 
-    # 构造上下文
-    context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation])
+    # 按 token 预算构造上下文（窗口起点对齐，连续多轮的消息前缀保持不变）
+    context = context_builder.build(conversation, offset=store.offset())
 
     # 调用 Ollama API
     try:
-        response = requests.post(
-            'http://localhost:11434/api/generate',
-            json={'model': 'deepseek-r1:1.5b', 'prompt': context, 'stream': False}
-        )
-        response.raise_for_status()
-        ai_response = response.json()['response']
+        ai_response = client.chat(context.messages)['message']['content']
     except Exception as e:
-        ai_response = f"请求出错: {str(e)}"
+        # 错误提示只显示在页面上，这一轮不写入对话历史，否则之后会作为上下文发给模型
+        chat_history.append((message, f"请求出错: {str(e)}"))
+        return "", chat_history
 
-    # 添加 AI 回复并保存
-    conversation.append({"role": "assistant", "content": ai_response})
-    save_conversation(conversation)
+    # 添加 AI 回复并保存（推理过程单独保存，不显示也不再作为上下文发送）
+    reasoning, ai_response = split_reasoning(ai_response)
+    store.append(user_message, {"role": "assistant", "content": ai_response, "reasoning": reasoning})
 
     # 更新聊天历史（用于 Gradio 显示）
     chat_history.append((message, ai_response))
@@ -101,10 +93,6 @@ with gr.Blocks(css=custom_css, theme=gr.themes.Soft()) as demo:
     )
 
 if __name__ == "__main__":
-    # 初始化对话文件
-    if not os.path.exists(CONVERSATION_FILE):
-        save_conversation([])
-
     demo.launch(
         server_port=5000,
         show_error=True,
@@ -1,5 +1,6 @@
 from flask import Flask, request, render_template_string
-import requests
+
+from ollama_client import client
 
 app = Flask(__name__)
 
@@ -16,11 +17,7 @@ def chat():
     response = ""
     if request.method == 'POST':
         prompt = request.form['prompt']
-        resp = requests.post(
-            'http://localhost:11434/api/generate',
-            json={'model': 'deepseek-r1:1.5b', 'prompt': prompt, 'stream': False}
-        )
-        response = resp.json()['response']
+        response = client.generate(prompt)['response']
     return render_template_string(HTML, response=response)
 
 if __name__ == '__main__':
@@ -1,10 +1,19 @@
-from flask import Flask, request, render_template_string
-import requests
+from flask import Flask, request, render_template_string, make_response, Response, stream_with_context, jsonify
 import json
-import os
+import time
+from contextlib import closing
+
+import metrics
+from metrics import Trace
+from ollama_client import client
+from session_manager import SessionManager
+from streaming import stream_turn, coalesce_frames, summarize_turn_stats, response_cache
 
 app = Flask(__name__)
 
+# 模型推理（<think>）期间不返回内容，按这个间隔写出 SSE 注释作为心跳，以便及时发现客户端断开
+HEARTBEAT_INTERVAL = 1.0
+
 HTML = '''
 <!doctype html>
 <html lang="en">
@@ -65,54 +74,135 @@ HTML = '''
         margin-top: 20px;
         font-size: 16px;
         color: #333;
+        white-space: pre-wrap;
       }
     </style>
   </head>
   <body>
     <div class="chat-container">
       <h1>Chat</h1>
-      <form method="post">
+      <form method="post" id="chatForm">
         <input type="text" name="prompt" placeholder="输入你的消息" required>
         <input type="submit" value="发送">
       </form>
-      <div class="response">{{ response }}</div>
+      <div class="response" id="response">{{ response }}</div>
     </div>
+    <script>
+      // 通过 /stream 接收流式回复，每收到一段就追加到页面上
+      // 上一个回复还没结束时发送新消息会断开上一个请求，服务端随之停止生成
+      let controller = null;
+      document.getElementById('chatForm').addEventListener('submit', async (event) => {
+        event.preventDefault();
+        const form = event.target;
+        const output = document.getElementById('response');
+        const body = new FormData(form);
+        form.reset();
+        output.textContent = '';
+
+        if (controller) controller.abort();
+        controller = new AbortController();
+        let response, reader;
+        try {
+          response = await fetch('/stream', {method: 'POST', body: body, signal: controller.signal});
+          reader = response.body.getReader();
+        } catch (error) {
+          return;
+        }
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+          let value, done;
+          try {
+            ({value, done} = await reader.read());
+          } catch (error) {
+            break;
+          }
+          if (done) break;
+          buffer += decoder.decode(value, {stream: true});
+          const events = buffer.split('\\n\\n');
+          buffer = events.pop();
+          for (const event of events) {
+            const data = event.split('\\n').find(line => line.startsWith('data: '));
+            if (data) {
+              const payload = JSON.parse(data.slice(6));
+              if (payload.delta) output.textContent += payload.delta;
+            }
+          }
+        }
+      });
+    </script>
   </body>
 </html>
 '''
 
-CONVERSATION_FILE = 'conversation.json'
+SESSION_COOKIE = 'session_id'
 
-def load_conversation():
-    if os.path.exists(CONVERSATION_FILE):
-        with open(CONVERSATION_FILE, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    return []
-
-def save_conversation(conversation):
-    with open(CONVERSATION_FILE, 'w', encoding='utf-8') as file:
-        json.dump(conversation, file, ensure_ascii=False, indent=4)
+# 对话历史按会话隔离：会话 ID 放在 cookie 中，每个会话一份日志
+sessions = SessionManager()
 
 @app.route('/', methods=['GET', 'POST'])
 def chat():
     response = ""
+    session_id = sessions.ensure_session_id(request.cookies.get(SESSION_COOKIE))
+    trace = None
     if request.method == 'POST':
         prompt = request.form['prompt']
-        conversation = load_conversation()
-        conversation.append({"role": "user", "content": prompt})
-
-        # 将对话历史作为上下文发送给模型
-        context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation])
-        resp = requests.post(
-            'http://localhost:11434/api/generate',
-            json={'model': 'deepseek-r1:1.5b', 'prompt': context, 'stream': False}
-        )
-        model_response = resp.json()['response']
-        conversation.append({"role": "assistant", "content": model_response})
-        save_conversation(conversation)
-
-        response = model_response
-    return render_template_string(HTML, response=response)
+        with Trace('flask.chat', request.headers.get('X-Request-ID')) as trace:
+            with sessions.session(session_id) as store:
+                response = "".join(stream_turn(store, prompt, trace=trace))
+
+    resp = make_response(render_template_string(HTML, response=response))
+    if trace is not None:
+        resp.headers['X-Request-ID'] = trace.request_id
+    return with_session_cookie(resp, session_id)
+
+# 流式接口：以 SSE 格式逐帧返回新增的文字（FRAME_INTERVAL 内的 token 合成一帧），整轮对话在生成结束后写入日志
+# 客户端断开后服务器关闭这个生成器，到 Ollama 的连接随之关闭，部分回答按 PARTIAL_ANSWER_POLICY 处理
+@app.route('/stream', methods=['POST'])
+def stream():
+    prompt = request.form['prompt']
+    session_id = sessions.ensure_session_id(request.cookies.get(SESSION_COOKIE))
+    trace = Trace('flask.stream', request.headers.get('X-Request-ID'))
+
+    def events():
+        with trace:
+            with sessions.session(session_id) as store:
+                heartbeat = time.monotonic()
+                with closing(stream_turn(store, prompt, trace=trace, keepalive=True)) as deltas:
+                    for delta in coalesce_frames(deltas):
+                        if delta:
+                            heartbeat = time.monotonic()
+                            yield f"data: {json.dumps({'delta': delta}, ensure_ascii=False)}\n\n"
+                        elif time.monotonic() - heartbeat >= HEARTBEAT_INTERVAL:
+                            heartbeat = time.monotonic()
+                            yield ": keepalive\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    resp = Response(stream_with_context(events()), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    resp.headers['X-Request-ID'] = trace.request_id
+    return with_session_cookie(resp, session_id)
+
+# 最近各轮的 prompt eval / 生成 token 统计，回答缓存的命中情况，以及合并的并发请求数
+@app.route('/stats')
+def stats():
+    summary = summarize_turn_stats()
+    summary['response_cache'] = response_cache.stats()
+    summary['coalescing'] = client.flights.stats()
+    return jsonify(summary)
+
+# Prometheus 指标：各阶段耗时、首 token 时间、token 数、错误数
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def with_session_cookie(resp, session_id):
+    if request.cookies.get(SESSION_COOKIE) != session_id:
+        resp.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+    return resp
 
 if __name__ == '__main__':
-    app.run(port=5000)
+    # 超过 ARCHIVE_AFTER_DAYS 天未更新的会话定期压缩归档
+    sessions.start_archiver()
+    app.run(port=5000, threaded=True)
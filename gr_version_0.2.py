@@ -1,80 +1,228 @@
-import gradio as gr
-import requests
-import json
+import asyncio
+import functools
 import os
+from contextlib import aclosing
 
-CONVERSATION_FILE = 'conversation.json'
-
-
-# 加载对话历史
-def load_conversation():
-    if os.path.exists(CONVERSATION_FILE):
-        with open(CONVERSATION_FILE, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    return []
-
-
-# 保存对话历史
-def save_conversation(conversation):
-    with open(CONVERSATION_FILE, 'w', encoding='utf-8') as file:
-        json.dump(conversation, file, ensure_ascii=False, indent=4)
-
+import gradio as gr
 
-# 上传文件并分析
-def upload_and_analyze(file, message, chat_history):
+from analysis import DEFAULT_FILE_QUESTION, prepare_document, document_references
+from async_pipeline import AsyncPipeline, FairScheduler, QueueFull, FILE_ANALYSIS, BATCH
+from history_catalog import HistoryCatalog
+from jobs import JobManager
+from metrics import Trace, start_http_server
+from ollama_client import DEFAULT_MODEL
+from retrieval import Retriever
+from router import BackendRouter
+from session_manager import SessionManager
+from streaming import acoalesce_frames
+
+# 对话历史按会话隔离，每个会话一份日志，保存在 chat_histories/ 下
+sessions = SessionManager()
+
+# 上传文档的检索索引：每轮只注入最相关的 4 个片段
+retriever = Retriever(top_k=4)
+
+# 多个 Ollama 后端（OLLAMA_BACKENDS）之间按正在处理的请求数分配，同一会话固定在同一后端
+router = BackendRouter(strategy='least_outstanding')
+
+# 异步生成管线：最多同时生成 4 个回复，其余按优先级、同级按会话轮转排队；
+# 文件分析最多占 2 个名额、批量任务 1 个，1 个名额只留给聊天，聊天没有名额时抢占低优先级的生成
+pipeline = AsyncPipeline(sessions, client=router,
+                         scheduler=FairScheduler(max_in_flight=4, max_queue=64, limits={FILE_ANALYSIS: 2, BATCH: 1},
+                                                 reserved=1, preempt=True),
+                         retriever=retriever)
+
+# 较早的对话按范围读取，页面只加载最近的若干轮
+catalog = HistoryCatalog(sessions.directory)
+
+# 上传文件的分析在后台运行
+jobs = JobManager()
+PROGRESS_INTERVAL = 0.5  # 刷新后台任务进度的间隔（秒）
+QUEUE_FULL_MESSAGE = "⚠️ 当前排队人数过多，请稍后再试"
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))  # Gradio 没有自定义路由，/metrics 在单独的端口上提供
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')  # 监控系统在其他机器上时设为 0.0.0.0
+THINKING_PLACEHOLDER = "💭 思考中…"
+NO_REASONING_MESSAGE = "（这条回答没有推理过程）"
+STOPPED_MARK = "\n\n⏹ 已停止"
+HISTORY_TURNS = 20  # 打开页面时加载的轮数，每次点击「加载更早的对话」再加载这么多
+# 浏览器的 localStorage 记住会话 ID，刷新或重新打开页面时继续之前的会话；
+# 不放进地址栏，会话 ID 就是访问凭据，链接被分享、截图或出现在 Referer 中都会泄露整个对话
+REMEMBER_SESSION_JS = "(session_id) => { if (session_id) localStorage.setItem('chat_session_id', session_id); }"
+RECALL_SESSION_JS = "() => localStorage.getItem('chat_session_id')"
+FORGET_SESSION_JS = "() => { localStorage.removeItem('chat_session_id'); }"
+
+
+# 刷新模型列表：可用后端上的模型
+async def refresh_models(model):
+    await router.check_all()
+    choices = router.models() or [DEFAULT_MODEL]
+    return gr.Dropdown(choices=choices, value=model if model in choices else choices[0])
+
+
+# 读取会话中第 before 条消息之前的最多 HISTORY_TURNS 轮；返回 (对话记录, 推理过程 ID, 第一轮的位置)
+def load_turns(session_id, before=None):
+    store = sessions.get(session_id)
+    before = len(store) if before is None else before
+    start = max(0, before - HISTORY_TURNS * 2)
+    offset = store.offset()
+    if start >= offset:
+        # 最近的消息在内存中，不用读盘
+        messages = store.messages()[start - offset:before - offset]
+    else:
+        data = catalog.read_messages(os.path.basename(store.path), count=before - start, before=before)
+        messages = data['messages'] if data else []
+        start = data['start'] if data else before
+    # 从一轮的开头开始，之前剩下的回答归入更早的一页
+    while messages and messages[0]['role'] != 'user':
+        messages = messages[1:]
+        start += 1
+
+    chat_history, reasoning_ids = [], []
+    for message in messages:
+        if message['role'] == 'user':
+            chat_history.append([message['content'], None])
+            reasoning_ids.append(None)
+        elif chat_history:
+            chat_history[-1][1] = message['content']
+            reasoning_ids[-1] = message.get('reasoning_id')
+    return chat_history, reasoning_ids, start
+
+
+# 打开页面：浏览器记住了会话 ID 时只加载最近的几轮，更早的按需加载
+def restore_session(session_id):
+    if not session_id or sessions.ensure_session_id(session_id) != session_id or not sessions.exists(session_id):
+        return [], None, [], 0, gr.Button(visible=False)
+    chat_history, reasoning_ids, start = load_turns(session_id)
+    return chat_history, session_id, reasoning_ids, start, gr.Button(visible=start > 0)
+
+
+# 加载更早的一页，插在对话记录前面
+def load_older(chat_history, session_id, reasoning_ids, history_start):
+    if not session_id or history_start <= 0:
+        return chat_history, reasoning_ids, history_start, gr.Button(visible=False)
+    older, older_ids, start = load_turns(session_id, before=history_start)
+    reasoning_ids = older_ids + aligned(reasoning_ids, chat_history)
+    return older + chat_history, reasoning_ids, start, gr.Button(visible=start > 0)
+
+
+# 上一轮被新消息打断时没有写回 reasoning_ids，补齐后才能与对话记录逐行对应
+def aligned(reasoning_ids, chat_history):
+    return reasoning_ids + [None] * (len(chat_history) - len(reasoning_ids))
+
+
+# 停止按钮：停止会话中正在进行的生成和文件分析，后端随之停止，名额让给其他用户
+# （任务和生成都属于事件循环，取消必须在事件循环中进行，所以是协程而不是在工作线程中运行的普通函数）
+async def stop_generation(chat_history, session_id):
+    stopped = [jobs.cancel(job.id) for job in jobs.for_session(session_id)] if session_id else []
+    if session_id and (pipeline.cancel(session_id) or any(stopped)) and chat_history:
+        chat_history[-1][1] = (chat_history[-1][1] or "").replace(THINKING_PLACEHOLDER, "") + STOPPED_MARK
+    return chat_history
+
+
+# 删除对话：停止进行中的生成和文件分析，删除对话日志并解除上传文档的引用（无人引用的文档随后被回收），
+# 页面回到新的空会话
+async def delete_session(session_id):
+    if session_id:
+        for job in jobs.for_session(session_id):
+            jobs.cancel(job.id)
+        pipeline.cancel(session_id)
+        # delete 要等会话锁，被取消的生成在事件循环中结束后才释放，所以在线程池中等待
+        await asyncio.get_running_loop().run_in_executor(None, sessions.delete, session_id)
+    return [], None, [], 0, gr.Button(visible=False)
+
+
+# 点击对话中的一条回答时加载它的推理过程
+def show_reasoning(reasoning_ids, session_id, evt: gr.SelectData):
+    row = evt.index[0] if isinstance(evt.index, (list, tuple)) else evt.index
+    reasoning_id = reasoning_ids[row] if row < len(reasoning_ids) else None
+    reasoning = sessions.get(session_id).reasoning(reasoning_id) if reasoning_id and session_id else None
+    return reasoning or NO_REASONING_MESSAGE, gr.Accordion(open=True)
+
+
+# 上传文件并分析：分析作为后台任务运行（文件分析优先级），这里只轮询进度并刷新页面；
+# 页面关闭后任务继续，结果写入会话历史
+async def upload_and_analyze(file, message, chat_history, session_id, reasoning_ids, model):
+    session_id = sessions.ensure_session_id(session_id)
     if file is None:
-        return "⚠️ 未选择文件", chat_history
-
-    try:
-        with open(file.name, 'r', encoding='utf-8') as f:
-            file_content = f.read()
-    except Exception as e:
-        return f"⚠️ 读取文件失败：{str(e)}", chat_history
-
-    conversation = load_conversation()
-    conversation.append({"role": "user", "content": message + "\n\n" + file_content})
-
-    context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation])
-
-    try:
-        response = requests.post(
-            'http://localhost:11434/api/generate',
-            json={'model': 'deepseek-r1:1.5b', 'prompt': context, 'stream': False}
-        )
-        response.raise_for_status()
-        ai_response = response.json()['response']
-    except Exception as e:
-        ai_response = f"⚠️ 请求出错: {str(e)}"
-
-    conversation.append({"role": "assistant", "content": ai_response})
-    save_conversation(conversation)
-
-    chat_history.append((message, ai_response))
-    return "✅ 文件已上传并分析完成", chat_history
-
-
-# 聊天功能
-def chat_with_ai(message, chat_history):
-    conversation = load_conversation()
-    conversation.append({"role": "user", "content": message})
-
-    context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation])
-
-    try:
-        response = requests.post(
-            'http://localhost:11434/api/generate',
-            json={'model': 'deepseek-r1:1.5b', 'prompt': context, 'stream': False}
-        )
-        response.raise_for_status()
-        ai_response = response.json()['response']
-    except Exception as e:
-        ai_response = f"⚠️ 请求出错: {str(e)}"
-
-    conversation.append({"role": "assistant", "content": ai_response})
-    save_conversation(conversation)
-
-    chat_history.append((message, ai_response))
-    return "", chat_history
+        yield "⚠️ 未选择文件", chat_history, session_id, reasoning_ids
+        return
+
+    path = getattr(file, 'name', file)
+    name = os.path.basename(path)
+    content = f"📎 {name}\n{message or DEFAULT_FILE_QUESTION}"
+    job = jobs.submit(session_id, name, functools.partial(analyze_file, path, message, content, session_id, model))
+    reasoning_ids = aligned(reasoning_ids, chat_history)
+    chat_history.append([content, THINKING_PLACEHOLDER])
+    while not job.done:
+        chat_history[-1][1] = job.output or THINKING_PLACEHOLDER
+        yield f"⏳ {name}：{job.stage}", chat_history, session_id, reasoning_ids
+        await jobs.wait(job, PROGRESS_INTERVAL)
+
+    if job.state == 'cancelled':
+        # 已被停止，页面由停止按钮更新
+        return
+    if job.state == 'failed':
+        chat_history[-1][1] = f"⚠️ {job.error}"
+        yield f"⚠️ 分析失败：{job.error}", chat_history, session_id, reasoning_ids + [None]
+        return
+    chat_history[-1][1] = job.output
+    yield "✅ 文件已上传并分析完成", chat_history, session_id, reasoning_ids + [getattr(job, 'reasoning_id', None)]
+
+
+# 后台分析任务；被聊天请求抢占后由 JobManager 重新执行，已完成的读取和索引不再重复
+async def analyze_file(path, message, content, session_id, model, job):
+    loop = asyncio.get_running_loop()
+    with Trace('gradio.upload') as trace:
+        document = getattr(job, 'document', None)
+        if document is None:
+            # 文件按内容哈希存入 uploads/ 并建立检索索引，重复上传直接复用；之后每轮只发送与问题相关的片段
+            with trace.span('ingest'):
+                document = await loop.run_in_executor(
+                    None, functools.partial(prepare_document, path, retriever, progress=job.update))
+            sessions.attach_document(session_id, document.doc_id)
+            job.document = document
+
+        references = None
+        if not message:
+            # 没有具体问题时检索没有意义，直接发送文档开头
+            references = await loop.run_in_executor(None, document_references, document)
+
+        job.update(stage='排队等待生成')
+        answer = ""
+        async for delta in pipeline.stream_turn(session_id, content, references=references, model=model,
+                                                trace=trace, priority=FILE_ANALYSIS, documents=[document.doc_id]):
+            answer += delta
+            job.update(stage=f'正在生成（{len(answer)} 字）', output=answer)
+        job.reasoning_id = trace.fields.get('reasoning_id')
+
+
+# 聊天功能：逐帧刷新回复，首个 token 到达即可显示；上一轮还没结束时发送新消息会停止上一轮
+# 间隔 FRAME_INTERVAL 内的 token 合成一帧，每帧只改最后一条回复，Gradio 只把新追加的文字发给页面
+async def chat_with_ai(message, chat_history, session_id, reasoning_ids, model):
+    session_id = sessions.ensure_session_id(session_id)
+    reasoning_ids = aligned(reasoning_ids, chat_history)
+    chat_history.append([message, THINKING_PLACEHOLDER])
+    yield "", chat_history, session_id, reasoning_ids
+
+    answer = ""
+    with Trace('gradio.chat') as trace:
+        try:
+            async with aclosing(pipeline.stream_turn(session_id, message, model=model, trace=trace,
+                                                     preempt=True)) as deltas:
+                async for frame in acoalesce_frames(deltas):
+                    answer += frame
+                    chat_history[-1][1] = answer
+                    yield "", chat_history, session_id, reasoning_ids
+        except QueueFull as e:
+            trace.fail(e)
+            chat_history[-1][1] = QUEUE_FULL_MESSAGE
+            yield "", chat_history, session_id, reasoning_ids + [None]
+            return
+    if trace.cancelled:
+        return
+
+    # 推理过程不随回答发送到页面，点击回答时再按 ID 加载；出错或被丢弃、没有写入的一轮没有 ID
+    yield "", chat_history, session_id, reasoning_ids + [trace.fields.get('reasoning_id')]
 
 
 # 自定义 CSS 样式
@@ -204,7 +352,17 @@ with gr.Blocks(css=custom_css, theme=theme) as demo:
     </div>
     """)
 
+    session_id = gr.State()
+    reasoning_ids = gr.State([])  # 与对话记录逐行对应的推理过程 ID
+    history_start = gr.State(0)   # 页面上第一轮在对话日志中的位置，之前的还没有加载
+
     with gr.Row():
+        model_selector = gr.Dropdown(
+            choices=[DEFAULT_MODEL],
+            value=DEFAULT_MODEL,
+            label="🧠 模型",
+            scale=1
+        )
         file_upload = gr.File(
             label="📁 上传文档（支持 TXT/PDF/DOCX）",
             file_types=[".txt", ".pdf", ".docx"],
@@ -212,6 +370,8 @@ with gr.Blocks(css=custom_css, theme=theme) as demo:
             # info="📌 请上传需要分析的文件"
         )
 
+    older_btn = gr.Button("⬆ 加载更早的对话", size="sm", visible=False)
+
     chatbot = gr.Chatbot(
         elem_id="chatbot",
         bubble_full_width=False,
@@ -222,6 +382,10 @@ with gr.Blocks(css=custom_css, theme=theme) as demo:
         )
     )
 
+    # 推理过程默认折叠，点击某条回答时才加载
+    with gr.Accordion("💭 思考过程（点击回答查看）", open=False) as reasoning_panel:
+        reasoning_view = gr.Markdown()
+
     with gr.Row():
         msg = gr.Textbox(
             scale=5,
@@ -236,29 +400,62 @@ with gr.Blocks(css=custom_css, theme=theme) as demo:
             elem_classes="send-btn",
             scale=1
         )
+        stop_btn = gr.Button(
+            "⏹ 停止",
+            variant="stop",
+            scale=1
+        )
+        delete_btn = gr.Button(
+            "🗑 删除对话",
+            scale=1
+        )
 
     # 交互逻辑
     msg.submit(
-        fn=lambda x: ("",),
-        inputs=msg,
-        outputs=msg,
-        queue=False
-    ).then(
         fn=chat_with_ai,
-        inputs=[msg, chatbot],
-        outputs=[msg, chatbot]
-    )
+        inputs=[msg, chatbot, session_id, reasoning_ids, model_selector],
+        outputs=[msg, chatbot, session_id, reasoning_ids]
+    ).then(fn=None, inputs=session_id, js=REMEMBER_SESSION_JS)
 
     file_upload.upload(
         fn=upload_and_analyze,
-        inputs=[file_upload, msg, chatbot],
-        outputs=[gr.Textbox(label="📤 上传结果", elem_classes="upload-success"), chatbot]
-    )
+        inputs=[file_upload, msg, chatbot, session_id, reasoning_ids, model_selector],
+        outputs=[gr.Textbox(label="📤 上传结果", elem_classes="upload-success"), chatbot, session_id, reasoning_ids]
+    ).then(fn=None, inputs=session_id, js=REMEMBER_SESSION_JS)
 
     submit_btn.click(
         fn=chat_with_ai,
-        inputs=[msg, chatbot],
-        outputs=[msg, chatbot]
+        inputs=[msg, chatbot, session_id, reasoning_ids, model_selector],
+        outputs=[msg, chatbot, session_id, reasoning_ids]
+    ).then(fn=None, inputs=session_id, js=REMEMBER_SESSION_JS)
+
+    delete_btn.click(
+        fn=delete_session,
+        inputs=session_id,
+        outputs=[chatbot, session_id, reasoning_ids, history_start, older_btn]
+    ).then(fn=None, js=FORGET_SESSION_JS)
+
+    older_btn.click(
+        fn=load_older,
+        inputs=[chatbot, session_id, reasoning_ids, history_start],
+        outputs=[chatbot, reasoning_ids, history_start, older_btn]
+    )
+
+    stop_btn.click(
+        fn=stop_generation,
+        inputs=[chatbot, session_id],
+        outputs=chatbot,
+        queue=False
+    )
+
+    demo.load(fn=refresh_models, inputs=model_selector, outputs=model_selector)
+    demo.load(fn=restore_session, inputs=session_id, outputs=[chatbot, session_id, reasoning_ids, history_start, older_btn],
+              js=RECALL_SESSION_JS)
+
+    chatbot.select(
+        fn=show_reasoning,
+        inputs=[reasoning_ids, session_id],
+        outputs=[reasoning_view, reasoning_panel]
     )
 
     # 底部提示
@@ -272,10 +469,11 @@ with gr.Blocks(css=custom_css, theme=theme) as demo:
     """)
 
 if __name__ == "__main__":
-    # 初始化对话文件
-    if not os.path.exists(CONVERSATION_FILE):
-        save_conversation([])
-
+    # 并发由 pipeline 的调度器控制，Gradio 队列本身不再限制为一次一个
+    demo.queue(default_concurrency_limit=64)
+    start_http_server(METRICS_PORT, METRICS_HOST)
+    # 超过 ARCHIVE_AFTER_DAYS 天未更新的会话定期压缩归档
+    sessions.start_archiver()
     demo.launch(
         server_port=5000,
         show_error=True,
@@ -1,41 +1,72 @@
+import sys
+from datetime import datetime
+
 from flask import Flask, request, render_template_string, jsonify
-import os
-import json
+
+from history_catalog import HistoryCatalog
 
 app = Flask(__name__)
 
 # 历史记录文件夹路径
-HISTORY_DIR = 'history'
-
-# 获取历史记录文件列表
-def get_history_files():
-    if os.path.exists(HISTORY_DIR):
-        return [f for f in os.listdir(HISTORY_DIR) if f.endswith('.json')]
-    return []
-
-# 加载指定的历史记录文件
-def load_history_file(file_name):
-    file_path = os.path.join(HISTORY_DIR, file_name)
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    return None
+HISTORY_DIR = 'chat_histories'
+PAGE_SIZE = 50
+MESSAGE_PAGE_SIZE = 20
+# 目录之外的旧对话文件，一并列出和检索
+EXTRA_HISTORY_FILES = ('conversation.json', 'histories/conversation.json')
+
+# 历史记录目录：分页列出对话、按范围读取消息、全文检索，不再每次遍历和整体读取文件
+catalog = HistoryCatalog(HISTORY_DIR, extra_files=EXTRA_HISTORY_FILES)
 
 @app.route('/')
 def index():
-    history_files = get_history_files()
-    return render_template_string(HTML, history_files=history_files)
+    return render_template_string(HTML, page_size=PAGE_SIZE, message_page_size=MESSAGE_PAGE_SIZE)
+
+# 分页获取对话列表
+@app.route('/conversations', methods=['GET'])
+def conversations():
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', PAGE_SIZE, type=int), 200)
+    return jsonify(catalog.list(page, per_page))
 
+# 按范围读取对话中的消息：start 向后翻页，before 向前翻页，都不传时返回最后一页
 @app.route('/load_history', methods=['GET'])
 def load_history():
     file_name = request.args.get('file')
     if not file_name:
         return jsonify({'error': 'Missing file parameter'}), 400
-    data = load_history_file(file_name)
+    count = min(request.args.get('count', MESSAGE_PAGE_SIZE, type=int), 200)
+    if 'start' in request.args:
+        data = catalog.read_messages(file_name, request.args.get('start', 0, type=int), count)
+    else:
+        data = catalog.read_messages(file_name, count=count, before=request.args.get('before', sys.maxsize, type=int))
     if data is None:
         return jsonify({'error': 'File not found'}), 404
     return jsonify(data)
 
+# 日期参数（YYYY-MM-DD）转时间戳
+def parse_date(value):
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').timestamp()
+
+# 全文检索消息，可按角色、日期范围和对话过滤
+@app.route('/search', methods=['GET'])
+def search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing q parameter'}), 400
+    try:
+        since = parse_date(request.args.get('from'))
+        until = parse_date(request.args.get('to'))
+    except ValueError:
+        return jsonify({'error': 'Invalid date, expected YYYY-MM-DD'}), 400
+    if until is not None:
+        until += 24 * 3600  # 包含结束日期当天
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    results = catalog.search(query, role=request.args.get('role') or None, since=since, until=until,
+                             name=request.args.get('file') or None, limit=limit)
+    return jsonify({'query': query, 'results': results})
+
 # HTML模板代码
 HTML = '''
 <!DOCTYPE html>
@@ -51,10 +82,11 @@ HTML = '''
             margin: 0;
         }
         .sidebar {
-            width: 200px;
+            width: 240px;
             background-color: #f4f4f9;
             padding: 20px;
             border-right: 1px solid #ccc;
+            overflow-y: auto;
         }
         .sidebar h2 {
             text-align: center;
@@ -69,10 +101,26 @@ HTML = '''
             border-bottom: 1px dashed #ccc;
             cursor: pointer;
         }
+        .sidebar li small {
+            display: block;
+            color: #888;
+        }
+        .search input, .search select {
+            width: 100%;
+            box-sizing: border-box;
+            margin-bottom: 6px;
+        }
+        .pager {
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+        }
         .chat-container {
             flex: 1;
+            position: relative;
             padding: 20px;
             background-color: #fff;
+            overflow-y: auto;
         }
         .chat-container h1 {
             text-align: center;
@@ -82,40 +130,315 @@ HTML = '''
             margin-top: 20px;
             white-space: pre-wrap;
         }
+        .row {
+            padding-bottom: 12px;
+        }
+        .message {
+            padding: 10px;
+            border-radius: 6px;
+            background-color: #f9f9f9;
+        }
+        .message.user {
+            background-color: #eef2ff;
+        }
+        .message b {
+            display: block;
+            margin-bottom: 4px;
+        }
+        .message details {
+            margin-bottom: 6px;
+            color: #666;
+        }
+        .status {
+            text-align: center;
+            color: #888;
+        }
     </style>
 </head>
 <body>
     <div class="sidebar">
         <h2>历史记录</h2>
-        <ul id="historyList">
-            {% for file in history_files %}
-            <li onclick="loadHistory('{{ file }}')">{{ file }}</li>
-            {% endfor %}
-        </ul>
+        <form class="search" onsubmit="searchHistory(); return false;">
+            <input id="searchQuery" placeholder="搜索消息">
+            <select id="searchRole">
+                <option value="">全部角色</option>
+                <option value="user">user</option>
+                <option value="assistant">assistant</option>
+            </select>
+            <input id="searchFrom" type="date">
+            <input id="searchTo" type="date">
+        </form>
+        <ul id="historyList"></ul>
+        <div class="pager" id="pager">
+            <button id="prevPage" onclick="loadPage(currentPage - 1)">上一页</button>
+            <span id="pageInfo"></span>
+            <button id="nextPage" onclick="loadPage(currentPage + 1)">下一页</button>
+        </div>
     </div>
     <div class="chat-container">
         <h1>聊天内容</h1>
-        <div class="response" id="response"></div>
+        <div class="status" id="status"></div>
+        <div class="response" id="response">
+            <div id="topSpacer"></div>
+            <div id="rows"></div>
+            <div id="bottomSpacer"></div>
+        </div>
     </div>
     <script>
-        function loadHistory(file) {
-            fetch(`/load_history?file=${file}`)
+        const pageSize = {{ page_size }};
+        const messagePageSize = {{ message_page_size }};
+        let currentPage = 1;
+        let currentFile = null;
+
+        // 分页加载对话列表
+        function loadPage(page) {
+            if (page < 1) return;
+            fetch(`/conversations?page=${page}&per_page=${pageSize}`)
                 .then(response => response.json())
                 .then(data => {
+                    const pages = Math.max(1, Math.ceil(data.total / pageSize));
+                    if (page > pages) return;
+                    currentPage = page;
+                    const list = document.getElementById('historyList');
+                    list.innerHTML = '';
+                    document.getElementById('pager').style.display = 'flex';
+                    data.items.forEach(item => {
+                        const li = document.createElement('li');
+                        li.textContent = (item.archived ? '📦 ' : '') + item.title;
+                        const meta = document.createElement('small');
+                        meta.textContent = `${new Date(item.updated * 1000).toLocaleString()} · ${item.turns} 轮`;
+                        li.appendChild(meta);
+                        li.onclick = () => loadHistory(item.name);
+                        list.appendChild(li);
+                    });
+                    document.getElementById('pageInfo').innerText = `${currentPage} / ${pages}`;
+                });
+        }
+
+        // 全文检索，结果替换对话列表；搜索框为空时回到列表
+        function searchHistory() {
+            const query = document.getElementById('searchQuery').value.trim();
+            if (!query) {
+                loadPage(currentPage);
+                return;
+            }
+            const params = new URLSearchParams({
+                q: query,
+                role: document.getElementById('searchRole').value,
+                from: document.getElementById('searchFrom').value,
+                to: document.getElementById('searchTo').value,
+            });
+            fetch(`/search?${params}`)
+                .then(response => response.json())
+                .then(data => {
+                    const list = document.getElementById('historyList');
+                    list.innerHTML = '';
+                    document.getElementById('pager').style.display = 'none';
+                    if (data.error) {
+                        list.innerText = data.error;
+                        return;
+                    }
+                    data.results.forEach(result => {
+                        const li = document.createElement('li');
+                        li.textContent = result.snippet;
+                        const meta = document.createElement('small');
+                        meta.textContent = `${result.title} · ${result.role}`;
+                        li.appendChild(meta);
+                        li.onclick = () => loadHistory(result.name, result.seq);
+                        list.appendChild(li);
+                    });
+                });
+        }
+
+        // 对话内容按需加载、虚拟滚动：打开时只取最后一页，滚到顶部（或底部）时再取相邻的一页；
+        // 页面上只保留可见范围附近的消息节点，其余用占位高度代替，节点数与对话长度无关
+        const OVERSCAN = 800;          // 可见范围上下多渲染的像素
+        const ESTIMATED_HEIGHT = 90;   // 还没渲染过的消息的估计高度
+        const LOAD_THRESHOLD = 300;    // 距顶部或底部不足这么多像素时加载相邻的一页
+        const scroller = document.querySelector('.chat-container');
+        const output = document.getElementById('response');
+        let messages = [];             // 已加载的连续一段消息，messages[i] 的序号是 firstSeq + i
+        let firstSeq = 0;
+        let total = 0;
+        let heights = new Map();       // 序号 -> 实际高度
+        let rowCache = new Map();      // 序号 -> 当前渲染的节点
+        let loading = false;
+        let generation = 0;            // 切换对话后丢弃之前的请求结果
+        let frame = null;
+
+        function heightOf(index) {
+            return heights.get(firstSeq + index) || ESTIMATED_HEIGHT;
+        }
+
+        function fetchMessages(params) {
+            const query = new URLSearchParams(Object.assign({file: currentFile, count: messagePageSize}, params));
+            return fetch(`/load_history?${query}`).then(response => response.json());
+        }
+
+        // 打开对话：默认定位到末尾，从检索结果进入时定位到命中的消息
+        function loadHistory(file, start = null) {
+            currentFile = file;
+            generation += 1;
+            messages = [];
+            firstSeq = total = 0;
+            heights = new Map();
+            rowCache = new Map();
+            loading = true;
+            render();
+            const current = generation;
+            fetchMessages(start === null ? {} : {start: start})
+                .then(data => {
+                    if (current !== generation) return;
                     if (data.error) {
-                        document.getElementById('response').innerText = data.error;
-                    } else {
-                        document.getElementById('response').innerText = JSON.stringify(data, null, 2);
+                        loading = false;
+                        setStatus(data.error);
+                        return;
                     }
+                    messages = data.messages;
+                    firstSeq = data.start;
+                    total = data.total;
+                    setStatus(total ? '' : '（空对话）');
+                    render();
+                    scroller.scrollTop = start === null ? scroller.scrollHeight : output.offsetTop;
+                    render();
+                    if (start === null) scroller.scrollTop = scroller.scrollHeight;
+                    // 定位完成后才开始按滚动位置加载相邻的页
+                    loading = false;
+                    scheduleRender();
                 })
-                .catch(error => {
-                    document.getElementById('response').innerText = '加载失败';
+                .catch(() => {
+                    loading = false;
+                    setStatus('加载失败');
                 });
         }
+
+        function setStatus(text) {
+            document.getElementById('status').innerText = text;
+        }
+
+        // 加载更早的一页，插入后保持当前看到的内容不动
+        function loadOlder() {
+            loading = true;
+            const current = generation;
+            setStatus('加载中…');
+            fetchMessages({before: firstSeq}).then(data => {
+                if (current !== generation) return;
+                loading = false;
+                setStatus('');
+                if (data.error || !data.messages.length) return;
+                messages = data.messages.concat(messages);
+                firstSeq = data.start;
+                total = data.total;
+                let added = 0;
+                for (let i = 0; i < data.messages.length; i++) added += heightOf(i);
+                scroller.scrollTop += added;
+                render();
+            }).catch(() => { loading = false; setStatus('加载失败'); });
+        }
+
+        function loadNewer() {
+            loading = true;
+            const current = generation;
+            fetchMessages({start: firstSeq + messages.length}).then(data => {
+                if (current !== generation) return;
+                loading = false;
+                if (data.error || !data.messages.length) return;
+                messages = messages.concat(data.messages);
+                total = data.total;
+                render();
+            }).catch(() => { loading = false; });
+        }
+
+        // 一条消息的节点；<think> 推理过程折叠显示，展开时才填入内容
+        function buildRow(message) {
+            const row = document.createElement('div');
+            row.className = 'row';
+            const div = document.createElement('div');
+            div.className = `message ${message.role}`;
+            const role = document.createElement('b');
+            role.textContent = message.role;
+            div.appendChild(role);
+            let content = message.content || '';
+            const think = /<think>([\\s\\S]*?)(<\\/think>|$)/.exec(content);
+            if (think) {
+                content = content.replace(think[0], '').trim();
+                const details = document.createElement('details');
+                const summary = document.createElement('summary');
+                summary.textContent = '💭 思考过程';
+                details.appendChild(summary);
+                details.addEventListener('toggle', () => {
+                    if (details.open && details.childNodes.length === 1) {
+                        details.appendChild(document.createTextNode(think[1].trim()));
+                    }
+                    scheduleRender();
+                });
+                div.appendChild(details);
+            }
+            div.appendChild(document.createTextNode(content));
+            row.appendChild(div);
+            return row;
+        }
+
+        // 只渲染可见范围附近的消息，上下用占位元素撑开滚动高度
+        function render() {
+            frame = null;
+            const viewTop = scroller.scrollTop - output.offsetTop;
+            const viewBottom = viewTop + scroller.clientHeight;
+            let y = 0;
+            let first = 0;
+            while (first < messages.length && y + heightOf(first) < viewTop - OVERSCAN) y += heightOf(first++);
+            const above = y;
+            let last = first;
+            while (last < messages.length && y < viewBottom + OVERSCAN) y += heightOf(last++);
+            let below = 0;
+            for (let i = last; i < messages.length; i++) below += heightOf(i);
+
+            const rows = [];
+            const cache = new Map();
+            for (let i = first; i < last; i++) {
+                const seq = firstSeq + i;
+                const row = rowCache.get(seq) || buildRow(messages[i]);
+                cache.set(seq, row);
+                rows.push(row);
+            }
+            rowCache = cache;
+            document.getElementById('topSpacer').style.height = `${above}px`;
+            document.getElementById('bottomSpacer').style.height = `${below}px`;
+            document.getElementById('rows').replaceChildren(...rows);
+
+            // 记录实际高度；可见范围之上的消息高度变化时调整滚动位置，避免内容跳动
+            let shift = 0;
+            let top = above;
+            rows.forEach((row, k) => {
+                const index = first + k;
+                const estimated = heightOf(index);
+                const actual = row.offsetHeight;
+                if (top + estimated <= viewTop) shift += actual - estimated;
+                heights.set(firstSeq + index, actual);
+                top += estimated;
+            });
+            if (shift) scroller.scrollTop += shift;
+
+            if (loading || !currentFile) return;
+            if (firstSeq > 0 && viewTop < LOAD_THRESHOLD) {
+                loadOlder();
+            } else if (firstSeq + messages.length < total && viewBottom > y + below - LOAD_THRESHOLD) {
+                loadNewer();
+            }
+        }
+
+        function scheduleRender() {
+            if (frame === null) frame = requestAnimationFrame(render);
+        }
+
+        scroller.addEventListener('scroll', scheduleRender);
+        window.addEventListener('resize', scheduleRender);
+
+        loadPage(1);
     </script>
 </body>
 </html>
 '''
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
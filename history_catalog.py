@@ -0,0 +1,299 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import archive
+from conversation_store import REASONING_SUFFIX, SUMMARY_SUFFIX
+from retrieval import CJK_RUN, tokenize
+from session_manager import SESSION_DIR
+
+CATALOG_FILE = '.catalog.sqlite'
+CATALOG_VERSION = 2  # 索引格式变化时加一，旧的目录清空后重新索引
+CHECKPOINT_EVERY = 32  # 每 32 条消息记录一次字节位置，用于按范围读取
+TITLE_LENGTH = 40
+SNIPPET_CHARS = 80
+NAME_TIME_PATTERN = re.compile(r'(\d{8}_\d{6})')
+
+
+# 历史记录目录
+class HistoryCatalog:
+    """用 SQLite 保存每个对话的标题、时间、消息数和大小，支持分页列出、按范围读取和全文检索消息
+
+    .jsonl 对话日志按追加的部分增量索引；旧的 .json 文件整体解析一次；
+    .jsonl.gz 归档按块索引，读取时只解压需要的块。
+    extra_files 是目录之外的单个对话文件（如 conversation.json），按路径命名。
+    """
+
+    def __init__(self, directory=SESSION_DIR, extra_files=(), min_refresh_interval=2.0):
+        self.directory = directory
+        self.extra_files = extra_files
+        self._extra_names = set()
+        self.min_refresh_interval = min_refresh_interval
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, CATALOG_FILE), check_same_thread=False)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != CATALOG_VERSION:
+            # 旧版目录没有全文索引或索引中没有中文单字，清空后全部重新索引
+            self._db.executescript('DROP TABLE IF EXISTS conversations; DROP TABLE IF EXISTS checkpoints; '
+                                   'DROP TABLE IF EXISTS message_index; PRAGMA user_version = %d;' % CATALOG_VERSION)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                name TEXT PRIMARY KEY, title TEXT, created REAL, updated REAL,
+                messages INTEGER, size INTEGER, inode INTEGER, base INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                name TEXT, seq INTEGER, offset INTEGER, PRIMARY KEY (name, seq)
+            );
+            CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_index USING fts5 (
+                terms, content UNINDEXED, name UNINDEXED, seq UNINDEXED, role UNINDEXED, time UNINDEXED
+            );
+        ''')
+
+    @staticmethod
+    def is_history_file(name):
+        return archive.is_archive(name) or ((name.endswith('.jsonl') or name.endswith('.json'))
+                                            and not name.endswith(('.docs.json', SUMMARY_SUFFIX, REASONING_SUFFIX)))
+
+    def _path(self, name):
+        return name if name in self._extra_names else os.path.join(self.directory, name)
+
+    # 目录下的对话文件，加上额外的单个文件（已迁移为 .jsonl 日志的用日志）
+    def _scan(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and self.is_history_file(entry.name):
+                yield entry.name, entry.stat()
+        for path in self.extra_files:
+            log_path = os.path.splitext(path)[0] + '.jsonl'
+            for name in (log_path, path):
+                if os.path.isfile(name):
+                    self._extra_names.add(name)
+                    yield name, os.stat(name)
+                    break
+
+    # 同步目录变化：只重新索引大小或 inode 变化的文件
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_refresh < self.min_refresh_interval:
+                return
+            self._last_refresh = now
+
+            indexed = {row[0]: row for row in self._db.execute(
+                'SELECT name, title, created, updated, messages, size, inode, base FROM conversations')}
+            seen = set()
+            for name, stat in self._scan():
+                seen.add(name)
+                row = indexed.get(name)
+                if row and row[5] == stat.st_size and row[6] == stat.st_ino:
+                    continue
+                if archive.is_archive(name):
+                    self._index_archive(name, stat)
+                elif name.endswith('.jsonl'):
+                    self._index_log(name, stat, row)
+                else:
+                    self._index_json(name, stat)
+            for name in set(indexed) - seen:
+                self._delete(name)
+            self._db.commit()
+
+    def _delete(self, name):
+        self._db.execute('DELETE FROM conversations WHERE name = ?', (name,))
+        self._db.execute('DELETE FROM checkpoints WHERE name = ?', (name,))
+        self._db.execute('DELETE FROM message_index WHERE name = ?', (name,))
+
+    # 全文索引：存分词结果（中文按相邻两字，另加单字，单字查询也能命中），FTS5 按空格切分；
+    # 消息时间取消息自己的 time 字段，旧消息没有时用文件的修改时间
+    def _index_messages(self, rows):
+        self._db.executemany('INSERT INTO message_index VALUES (?, ?, ?, ?, ?, ?)',
+                             [(' '.join(index_terms(record.get('content', ''))), record.get('content', ''),
+                               name, seq, record.get('role'), record.get('time', mtime))
+                              for name, seq, record, mtime in rows])
+
+    @staticmethod
+    def _created(name, stat):
+        match = NAME_TIME_PATTERN.search(name)
+        if match:
+            return datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').timestamp()
+        return stat.st_mtime
+
+    @staticmethod
+    def _title(message):
+        return message.get('content', '').strip().replace('\n', ' ')[:TITLE_LENGTH]
+
+    # 旧格式：整个文件是一个 JSON 数组
+    def _index_json(self, name, stat):
+        try:
+            with open(self._path(name), 'r', encoding='utf-8') as file:
+                conversation = json.load(file)
+        except (OSError, ValueError):
+            conversation = []
+        title = next((self._title(m) for m in conversation if m.get('role') == 'user'), '')
+        self._delete(name)
+        self._index_messages((name, seq, message, stat.st_mtime) for seq, message in enumerate(conversation))
+        self._db.execute('INSERT INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (name, title, self._created(name, stat), stat.st_mtime, len(conversation),
+                          stat.st_size, stat.st_ino, 0))
+
+    # 归档：每个压缩块记录一个检查点
+    def _index_archive(self, name, stat):
+        self._delete(name)
+        title, messages = '', 0
+        for offset, block in archive.iter_blocks(self._path(name)):
+            self._db.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)', (name, messages, offset))
+            if not title:
+                title = next((self._title(m) for m in block if m.get('role') == 'user'), '')
+            self._index_messages((name, messages + seq, message, stat.st_mtime) for seq, message in enumerate(block))
+            messages += len(block)
+        self._db.execute('INSERT INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (name, title, self._created(name, stat), stat.st_mtime, messages,
+                          stat.st_size, stat.st_ino, 0))
+
+    # 对话日志：从上次索引到的位置继续读取新追加的行，只为新消息建全文索引
+    def _index_log(self, name, stat, row):
+        if row and row[6] == stat.st_ino and row[5] < stat.st_size:
+            _, title, created, _, messages, start, _, base = row
+        else:
+            # 新文件，或被压缩替换过，从头索引
+            self._delete(name)
+            title, created, messages, start, base = '', self._created(name, stat), 0, 0, 0
+
+        checkpoints = []
+        added = []
+        end = start
+        with open(self._path(name), 'rb') as file:
+            file.seek(start)
+            for line in file:
+                if not line.endswith(b'\n'):
+                    break  # 写入中的半行，下次再索引
+                offset = end
+                end += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('op') == 'clear':
+                    self._db.execute('DELETE FROM checkpoints WHERE name = ?', (name,))
+                    self._db.execute('DELETE FROM message_index WHERE name = ?', (name,))
+                    checkpoints = []
+                    added = []
+                    title, messages, base = '', 0, end
+                    continue
+                if messages % CHECKPOINT_EVERY == 0:
+                    checkpoints.append((name, messages, offset))
+                if not title and record.get('role') == 'user':
+                    title = self._title(record)
+                added.append((name, messages, record, stat.st_mtime))
+                messages += 1
+
+        self._db.executemany('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)', checkpoints)
+        self._index_messages(added)
+        self._db.execute('INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (name, title, created, stat.st_mtime, messages, end, stat.st_ino, base))
+
+    # 分页列出对话，按最近更新排序
+    def list(self, page=1, per_page=50):
+        self.refresh()
+        page = max(1, page)
+        with self._lock:
+            total = self._db.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+            rows = self._db.execute(
+                'SELECT name, title, created, updated, messages, size FROM conversations '
+                'ORDER BY updated DESC LIMIT ? OFFSET ?', (per_page, (page - 1) * per_page)).fetchall()
+        items = [{'name': name, 'title': title or name, 'created': created, 'updated': updated,
+                  'messages': messages, 'turns': (messages + 1) // 2, 'size': size,
+                  'archived': archive.is_archive(name)}
+                 for name, title, created, updated, messages, size in rows]
+        return {'total': total, 'page': page, 'per_page': per_page, 'items': items}
+
+    # 按范围读取消息：从最近的检查点开始读，只解析需要的行
+    def read_messages(self, name, start=0, count=20, before=None):
+        """返回 {'total', 'start', 'messages'}；对话不存在时返回 None
+
+        before 不为 None 时读取第 before 条之前的 count 条（向上翻页），before 超过总数时即最后 count 条。
+        """
+        self.refresh()
+        with self._lock:
+            row = self._db.execute('SELECT messages, base FROM conversations WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return None
+            total, base = row
+            if before is not None:
+                end = max(0, min(before, total))
+                start = max(0, end - count)
+                count = end - start
+            start = max(0, min(start, total))
+            checkpoint = self._db.execute(
+                'SELECT seq, offset FROM checkpoints WHERE name = ? AND seq <= ? ORDER BY seq DESC LIMIT 1',
+                (name, start)).fetchone()
+
+        path = self._path(name)
+        if archive.is_archive(name):
+            messages = archive.read_range(path, checkpoint[1], checkpoint[0], start, count) if checkpoint else []
+            return {'total': total, 'start': start, 'messages': messages}
+        if not name.endswith('.jsonl'):
+            with open(path, 'r', encoding='utf-8') as file:
+                conversation = json.load(file)
+            return {'total': len(conversation), 'start': start, 'messages': conversation[start:start + count]}
+
+        seq, offset = checkpoint if checkpoint else (0, base)
+        messages = []
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            for line in file:
+                if len(messages) >= count or seq >= total:
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('op') == 'clear':
+                    continue
+                if seq >= start:
+                    messages.append(record)
+                seq += 1
+        return {'total': total, 'start': start, 'messages': messages}
+
+    # 全文检索，按 BM25 相关度排序；可按角色、时间范围和对话过滤
+    def search(self, query, role=None, since=None, until=None, name=None, limit=20):
+        """返回 [{'name', 'title', 'seq', 'role', 'time', 'snippet'}]，seq 可直接传给 read_messages"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        self.refresh()
+        sql = ('SELECT m.name, c.title, m.seq, m.role, m.time, m.content FROM message_index m '
+               'JOIN conversations c ON c.name = m.name WHERE message_index MATCH ?')
+        params = [' '.join('"%s"' % term for term in terms)]
+        for column, operator, value in (('m.role', '=', role), ('m.time', '>=', since),
+                                        ('m.time', '<', until), ('m.name', '=', name)):
+            if value is not None:
+                sql += ' AND %s %s ?' % (column, operator)
+                params.append(value)
+        sql += ' ORDER BY rank LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [{'name': name, 'title': title or name, 'seq': seq, 'role': role, 'time': time,
+                 'snippet': snippet(content, terms)}
+                for name, title, seq, role, time, content in rows]
+
+
+# 消息的索引词：检索用的分词结果，加上连续中文中的每个单字（单字的词 tokenize 已保留）
+def index_terms(text):
+    return tokenize(text) + [char for run in CJK_RUN.findall(text) if len(run) > 1 for char in run]
+
+
+# 截取第一个命中词附近的一段文字
+def snippet(content, terms, width=SNIPPET_CHARS):
+    lowered = content.lower()
+    positions = [position for position in (lowered.find(term) for term in terms) if position >= 0]
+    center = min(positions) if positions else 0
+    start = max(0, center - width // 2)
+    end = min(len(content), start + width)
+    text = content[start:end].replace('\n', ' ')
+    return ('…' if start > 0 else '') + text + ('…' if end < len(content) else '')
@@ -0,0 +1,237 @@
+import codecs
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+import zipfile
+from collections import namedtuple
+from typing import Iterator
+from xml.etree import ElementTree
+
+from context_builder import estimate_tokens
+
+try:
+    from charset_normalizer import from_bytes
+except ImportError:  # 可选依赖，缺失时按常见编码依次尝试
+    from_bytes = None
+
+try:
+    import pypdf
+except ImportError:  # 可选依赖，缺失时不支持 PDF
+    pypdf = None
+
+UPLOAD_DIR = 'uploads'
+READ_BLOCK = 64 * 1024
+SAMPLE_SIZE = 64 * 1024
+FALLBACK_ENCODINGS = ('utf-8', 'gb18030', 'big5', 'utf-16')
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+BREAK_CHARS = '\n。！？.!?；;'
+
+Document = namedtuple('Document', ['doc_id', 'name', 'chunks', 'tokens', 'directory'])
+
+
+# 不支持的文件类型或缺少解析依赖
+class UnsupportedFile(Exception):
+    pass
+
+
+# 检测文本编码：优先识别 BOM，其次用 charset_normalizer，最后按常见编码试解码
+def detect_encoding(sample):
+    for bom, encoding in ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+                          (codecs.BOM_UTF16_BE, 'utf-16')):
+        if sample.startswith(bom):
+            return encoding
+    if from_bytes is not None:
+        best = from_bytes(sample).best()
+        if best is not None:
+            return best.encoding
+    for encoding in FALLBACK_ENCODINGS:
+        try:
+            # 采样可能在多字节字符中间截断，忽略末尾几个字节
+            sample[:len(sample) - 4].decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return 'utf-8'
+
+
+# 文本文件：按块增量解码
+def extract_txt(path) -> Iterator[str]:
+    with open(path, 'rb') as file:
+        encoding = detect_encoding(file.read(SAMPLE_SIZE))
+        file.seek(0)
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        while True:
+            block = file.read(READ_BLOCK)
+            if not block:
+                break
+            yield decoder.decode(block)
+        yield decoder.decode(b'', final=True)
+
+
+# PDF：逐页提取文本
+def extract_pdf(path) -> Iterator[str]:
+    if pypdf is None:
+        raise UnsupportedFile('解析 PDF 需要安装 pypdf')
+    reader = pypdf.PdfReader(path)
+    for page in reader.pages:
+        yield (page.extract_text() or '') + '\n'
+
+
+# DOCX：流式解析 word/document.xml，逐段返回
+def extract_docx(path) -> Iterator[str]:
+    with zipfile.ZipFile(path) as archive:
+        with archive.open('word/document.xml') as document:
+            texts = []
+            for event, element in ElementTree.iterparse(document, events=('end',)):
+                if element.tag == WORD_NS + 't':
+                    texts.append(element.text or '')
+                elif element.tag == WORD_NS + 'tab':
+                    texts.append('\t')
+                elif element.tag == WORD_NS + 'p':
+                    yield ''.join(texts) + '\n'
+                    texts = []
+                    element.clear()
+
+
+EXTRACTORS = {
+    '.txt': extract_txt,
+    '.md': extract_txt,
+    '.pdf': extract_pdf,
+    '.docx': extract_docx,
+}
+
+
+# 注册新的文件类型解析器
+def register_extractor(extension, extractor):
+    EXTRACTORS[extension.lower()] = extractor
+
+
+def extract_text(path, name=None) -> Iterator[str]:
+    extension = os.path.splitext(name or path)[1].lower()
+    extractor = EXTRACTORS.get(extension)
+    if extractor is None:
+        raise UnsupportedFile(f'不支持的文件类型：{extension or "未知"}')
+    return extractor(path)
+
+
+# 切分位置：尽量落在句末或换行处
+def find_cut(text, limit):
+    window = text[limit * 4 // 5:limit]
+    for index in range(len(window) - 1, -1, -1):
+        if window[index] in BREAK_CHARS:
+            return limit * 4 // 5 + index + 1
+    return limit
+
+
+# 流式切分文本
+def chunk_text(pieces, chunk_tokens=512, overlap_tokens=64, estimator=estimate_tokens):
+    """把文本片段切成约 chunk_tokens 大小的块，相邻块重叠约 overlap_tokens；缓冲区大小与文件大小无关
+
+    逐个返回 (text, overlap)，overlap 是 text 开头与上一块重复的字符数。
+    过长的片段先按 chunk_tokens * 4 个字符分段加入缓冲区，token 数按新加入的部分累加，
+    只在切出一块后对剩余的缓冲区重新估算，切分耗时与文本长度成线性。
+    """
+    window = chunk_tokens * 4
+    buffer = ''
+    tokens = 0
+    overlap = 0
+    for piece in pieces:
+        for offset in range(0, len(piece), window):
+            part = piece[offset:offset + window]
+            buffer += part
+            tokens += estimator(part)
+            while tokens >= chunk_tokens:
+                # 按字符比例估算切分位置；中英文混排时比例不准，再逐步收缩
+                limit = max(1, len(buffer) * chunk_tokens // tokens)
+                head_tokens = estimator(buffer[:limit])
+                while head_tokens > chunk_tokens and limit > 1:
+                    limit = max(1, limit * chunk_tokens // head_tokens)
+                    head_tokens = estimator(buffer[:limit])
+                cut = find_cut(buffer, limit)
+                yield buffer[:cut], overlap
+                overlap = min(cut - 1, cut * overlap_tokens // chunk_tokens)
+                buffer = buffer[cut - overlap:]
+                tokens = estimator(buffer)
+    if buffer[overlap:].strip():
+        yield buffer, overlap
+
+
+# 读取已入库文档的元数据
+def load_document(doc_id, upload_dir=UPLOAD_DIR):
+    directory = os.path.join(upload_dir, doc_id)
+    with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as file:
+        meta = json.load(file)
+    return Document(doc_id, meta['name'], meta['chunks'], meta['tokens'], directory)
+
+
+# 逐块读取已入库的文档
+def iter_chunks(document) -> Iterator[dict]:
+    with open(os.path.join(document.directory, 'chunks.jsonl'), 'r', encoding='utf-8') as file:
+        for line in file:
+            yield json.loads(line)
+
+
+# 文件内容的 SHA-256，用作文档 ID
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(READ_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# 文档入库
+def ingest_file(path, name=None, upload_dir=UPLOAD_DIR, chunk_tokens=512, overlap_tokens=64):
+    """按内容寻址：文档 ID 是文件内容的哈希，块写入 uploads/<sha256>/chunks.jsonl，元数据写入 meta.json
+
+    同样内容的文件（重复上传、不同用户上传）只读取、切分一次，之后直接返回已入库的文档。
+    """
+    name = name or os.path.basename(path)
+    doc_id = file_digest(path)
+    directory = os.path.join(upload_dir, doc_id)
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        # 更新修改时间，避免在被会话引用之前被当作无用文档回收
+        os.utime(directory)
+        return load_document(doc_id, upload_dir)._replace(name=name)
+
+    # 先写到临时目录再改名，并发上传同一文件时只保留先完成的一份
+    tmp_directory = os.path.join(upload_dir, f'.tmp-{uuid.uuid4().hex}')
+    os.makedirs(tmp_directory)
+    try:
+        count = tokens = 0
+        with open(os.path.join(tmp_directory, 'chunks.jsonl'), 'w', encoding='utf-8') as file:
+            for text, overlap in chunk_text(extract_text(path, name), chunk_tokens, overlap_tokens):
+                used = estimate_tokens(text)
+                file.write(json.dumps({'index': count, 'text': text, 'tokens': used, 'overlap': overlap},
+                                      ensure_ascii=False) + '\n')
+                count += 1
+                tokens += used
+
+        meta = {'name': name, 'size': os.path.getsize(path), 'chunks': count, 'tokens': tokens,
+                'sha256': doc_id, 'created': time.time()}
+        with open(os.path.join(tmp_directory, 'meta.json'), 'w', encoding='utf-8') as file:
+            json.dump(meta, file, ensure_ascii=False, indent=4)
+        try:
+            os.rename(tmp_directory, directory)
+        except OSError:
+            if not os.path.exists(os.path.join(directory, 'meta.json')):
+                raise
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    return Document(doc_id, name, count, tokens, directory)
+
+
+# 取文档开头不超过 budget 个 token 的内容
+def document_excerpt(document, budget=3000):
+    parts = []
+    for chunk in iter_chunks(document):
+        if budget < chunk['tokens']:
+            parts.append('\n…（文档过长，以下内容已省略）')
+            break
+        # 相邻块有重叠，拼接时去掉重复的开头
+        parts.append(chunk['text'][chunk['overlap']:])
+        budget -= chunk['tokens']
+    return ''.join(parts)
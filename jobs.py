@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+
+from async_pipeline import Preempted
+
+logger = logging.getLogger(__name__)
+
+
+# 一个后台任务的状态
+class Job:
+    def __init__(self, session_id, name):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.name = name
+        self.state = 'queued'   # queued / running / done / failed / cancelled
+        self.stage = '排队中'    # 给用户看的当前阶段
+        self.output = ''        # 已生成的回答
+        self.error = None
+        self.attempts = 0
+        self.created = time.time()
+        self.finished = None
+        self.task = None
+
+    @property
+    def done(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    def update(self, stage=None, output=None):
+        if stage is not None:
+            self.stage = stage
+        if output is not None:
+            self.output = output
+
+    def to_dict(self):
+        return {'id': self.id, 'session_id': self.session_id, 'name': self.name, 'state': self.state,
+                'stage': self.stage, 'output_chars': len(self.output), 'error': self.error,
+                'attempts': self.attempts, 'created': self.created, 'finished': self.finished}
+
+
+# 后台任务管理
+class JobManager:
+    """在事件循环中运行后台任务（如上传文件的分析），与发起请求的页面事件无关：
+    页面关闭或刷新后任务继续，结果写入会话历史；被交互请求抢占时自动重新排队
+
+    只能在同一个事件循环中使用。
+    """
+
+    def __init__(self, max_jobs=1000, max_attempts=3, retry_delay=2.0):
+        self.max_jobs = max_jobs
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._jobs = OrderedDict()  # job_id -> Job，按创建顺序，超出 max_jobs 时丢弃最早结束的
+
+    # 提交任务：fn(job) 是协程函数，通过 job.update 报告进度
+    def submit(self, session_id, name, fn):
+        job = Job(session_id, name)
+        self._jobs[job.id] = job
+        job.task = asyncio.get_running_loop().create_task(self._run(job, fn))
+        self._trim()
+        return job
+
+    async def _run(self, job, fn):
+        while True:
+            job.attempts += 1
+            job.state = 'running'
+            try:
+                await fn(job)
+            except Preempted:
+                if job.attempts < self.max_attempts:
+                    job.update(stage=f'被聊天请求让出名额，稍后重试（第 {job.attempts} 次）', output='')
+                    job.state = 'queued'
+                    await asyncio.sleep(self.retry_delay * job.attempts)
+                    continue
+                job.state, job.error = 'failed', '多次被抢占，请稍后重试'
+            except asyncio.CancelledError:
+                job.state = 'cancelled'
+                raise
+            except Exception as e:
+                logger.exception('后台任务 %s 失败', job.name)
+                job.state, job.error = 'failed', str(e)
+            else:
+                job.state = 'done'
+            finally:
+                if job.done:
+                    job.finished = time.time()
+            return
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def for_session(self, session_id):
+        return [job for job in self._jobs.values() if job.session_id == session_id]
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None or job.done:
+            return False
+        job.task.cancel()
+        return True
+
+    # 等待任务状态变化，用于轮询进度
+    async def wait(self, job, interval=0.5):
+        if not job.done:
+            await asyncio.wait({job.task}, timeout=interval)
+
+    def _trim(self):
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.done]:
+            if len(self._jobs) <= self.max_jobs:
+                break
+            del self._jobs[job_id]
+
+    def stats(self):
+        states = {}
+        for job in self._jobs.values():
+            states[job.state] = states.get(job.state, 0) + 1
+        return states
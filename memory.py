@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from archive import load_conversation
+from ollama_client import client, DEFAULT_MODEL
+from reasoning import split_reasoning
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_MODEL = os.environ.get('SUMMARY_MODEL', DEFAULT_MODEL)
+SUMMARY_PROMPT = ("你负责维护一段对话的摘要。根据已有摘要和新的对话内容，输出更新后的摘要："
+                  "保留用户的身份、偏好、目标、已确认的事实和结论、未解决的问题，省略寒暄和重复内容。"
+                  "只输出摘要本身，不超过 {limit} 字。")
+SUMMARY_PREFIX = "以下是之前对话的摘要，回答时可以参考：\n"
+
+
+# 对话摘要记忆
+class SummaryMemory:
+    """对话超过 token 阈值后，在后台把较早的轮次用本地模型压缩成滚动摘要
+
+    摘要保存在 <name>.summary.json（{"upto", "summary", "updated"}），upto 是摘要覆盖到的消息位置；
+    构造上下文时发送「摘要 + upto 之后的消息」。生成摘要在单独的线程中进行，不占用请求路径，
+    摘要生成之前照常按 token 预算丢弃旧消息。
+    """
+
+    def __init__(self, builder, threshold=None, keep_recent=None, max_input_tokens=6000, summary_chars=800,
+                 model=SUMMARY_MODEL, client=client, workers=1):
+        self.builder = builder
+        self.threshold = threshold or builder.budget * 3 // 4  # 未摘要的消息超过这么多 token 时开始摘要
+        self.keep_recent = keep_recent or builder.budget // 2   # 最近这么多 token 的消息保留原文
+        self.max_input_tokens = max_input_tokens
+        self.summary_chars = summary_chars
+        self.model = model
+        self.client = client
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='summary')
+        self._pending = set()  # 正在摘要的对话路径，避免重复提交
+        self._cache = {}       # 摘要文件路径 -> (mtime_ns, 摘要记录)
+        self._lock = threading.Lock()
+
+    # 读取对话当前的摘要，没有时返回 None；按文件修改时间缓存
+    def get(self, store):
+        path = store.summary_path
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                record = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if record.get('upto', 0) > len(store):
+            return None  # 对话已被清空，摘要作废
+        with self._lock:
+            self._cache[path] = (mtime, record)
+        return record
+
+    # 套用摘要：去掉已被摘要覆盖的消息，返回 (消息, 起始位置, 摘要消息)
+    def apply(self, store, conversation, offset):
+        record = self.get(store)
+        if not record or not record.get('summary'):
+            return conversation, offset, None
+        upto = record['upto']
+        if upto > offset:
+            conversation = conversation[upto - offset:]
+            offset = upto
+        return conversation, offset, {"role": "system", "content": SUMMARY_PREFIX + record['summary']}
+
+    # 一轮结束后调用：未摘要的消息超过阈值时提交后台任务，立即返回
+    def schedule(self, store):
+        messages = store.messages()
+        offset = store.offset()
+        record = self.get(store)
+        upto = record['upto'] if record else 0
+        start = max(upto - offset, 0)
+        costs = [self.builder.cost(self.builder.prepare(message)) for message in messages[start:]]
+        if sum(costs) <= self.threshold:
+            return False
+
+        # 从末尾保留 keep_recent 个 token 的消息，切分点对齐到用户消息（整轮摘要）
+        cut = len(messages)
+        recent = 0
+        while cut > start and recent + costs[cut - 1 - start] <= self.keep_recent:
+            cut -= 1
+            recent += costs[cut - start]
+        while cut > start and messages[cut - 1]['role'] == 'user':
+            cut -= 1
+        while cut < len(messages) and messages[cut]['role'] != 'user':
+            cut += 1
+        cut += offset
+        # 切分点对齐到 ContextBuilder 的窗口对齐位置，否则构造上下文时会多丢掉几条未摘要的消息
+        if self.builder.align > 1:
+            cut -= cut % self.builder.align
+        if cut <= upto:
+            return False
+
+        path = store.path
+        with self._lock:
+            if path in self._pending:
+                return False
+            self._pending.add(path)
+        self._executor.submit(self._summarize, store, record, upto, cut)
+        return True
+
+    def _summarize(self, store, record, upto, cut):
+        started = time.perf_counter()
+        try:
+            # 直接读文件，不持有会话锁；被摘要的部分已经落盘，不会再改变
+            segment = load_conversation(store.path)[upto:cut]
+            summary = self.summarize(record.get('summary') if record else None, segment)
+            if not summary or len(store) < cut:
+                return
+            tmp_path = store.summary_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump({'upto': cut, 'summary': summary, 'updated': time.time()}, file, ensure_ascii=False)
+            os.replace(tmp_path, store.summary_path)
+            logger.info('已摘要 %s 的第 %d-%d 条消息（%.1f 秒）', store.path, upto, cut,
+                        time.perf_counter() - started)
+        except Exception:
+            logger.exception('生成对话摘要失败：%s', store.path)
+        finally:
+            with self._lock:
+                self._pending.discard(store.path)
+
+    # 用模型把已有摘要和新的一段对话合并成新的摘要
+    def summarize(self, previous, messages):
+        lines = []
+        for message in messages:
+            message = self.builder.prepare(message)
+            role = '用户' if message['role'] == 'user' else '助手'
+            lines.append(f"{role}：{message['content']}")
+        dialogue = self.builder.truncate('\n'.join(lines), self.max_input_tokens)
+        content = (f"已有摘要：\n{previous}\n\n" if previous else "") + f"新的对话：\n{dialogue}"
+        response = self.client.chat([
+            {"role": "system", "content": SUMMARY_PROMPT.format(limit=self.summary_chars)},
+            {"role": "user", "content": content},
+        ], model=self.model, options={'temperature': 0.2})
+        _, summary = split_reasoning(response.get('message', {}).get('content', ''))
+        return summary.strip()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,264 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 为 1 时每个请求结束后输出一行 JSON 日志（按 request_id 关联各阶段耗时）
+JSON_LOGS = os.environ.get('CHAT_JSON_LOGS') == '1'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+trace_logger = logging.getLogger('chat.trace')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+
+# 只增不减的计数
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{self._format_labels(key)} {value}']
+
+
+# 分桶统计的分布（延迟、token 数等）
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[0][index] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    def _render_value(self, key, value):
+        buckets, count, total = value
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, buckets):
+            cumulative += bucket
+            lines.append(f'{self.name}_bucket{self._format_labels(key, [("le", bound)])} {cumulative}')
+        lines.append(f'{self.name}_bucket{self._format_labels(key, [("le", "+Inf")])} {count}')
+        lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+        lines.append(f'{self.name}_count{self._format_labels(key)} {count}')
+        return lines
+
+
+# 可增可减的当前值（排队深度、正在进行的请求数）
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{self._format_labels(key)} {value}']
+
+
+registry = []
+
+REQUESTS = Counter('chat_requests_total', '处理的请求数', ('handler', 'status'))
+REQUEST_SECONDS = Histogram('chat_request_seconds', '请求总耗时', ('handler',))
+STAGE_SECONDS = Histogram('chat_stage_seconds', '各阶段耗时（history、context、queue、retrieval、generation、save 等）',
+                          ('stage',))
+FIRST_TOKEN_SECONDS = Histogram('chat_time_to_first_token_seconds', '从收到请求到第一个回答 token 的时间', ('handler',))
+ERRORS = Counter('chat_errors_total', '按类型统计的错误数', ('handler', 'type'))
+CANCELLED = Counter('chat_cancelled_total', '用户中途放弃（停止、断开连接、被新消息抢占）的请求数', ('handler',))
+QUEUE_SECONDS = Histogram('chat_queue_seconds', '在调度器中等待生成名额的时间', ('priority',))
+QUEUE_DEPTH = Gauge('chat_queue_depth', '正在排队的请求数', ('priority',))
+IN_FLIGHT = Gauge('chat_in_flight', '正在生成的请求数', ('priority',))
+PREEMPTIONS = Counter('chat_preemptions_total', '被交互请求抢占的低优先级生成数', ('priority',))
+PROMPT_TOKENS = Counter('chat_prompt_tokens_total', '后端实际计算的 prompt token 数（prompt_eval_count）', ('model',))
+COMPLETION_TOKENS = Counter('chat_completion_tokens_total', '生成的 token 数（eval_count）', ('model',))
+PROMPT_EVAL_SECONDS = Histogram('chat_prompt_eval_seconds', '后端 prompt 计算耗时（prompt_eval_duration）', ('model',))
+EVAL_SECONDS = Histogram('chat_eval_seconds', '后端生成耗时（eval_duration）', ('model',))
+COALESCED = Counter('chat_coalesced_total', '合并到相同的进行中请求、没有单独请求后端的生成数', ('model',))
+
+
+# 导出为 Prometheus 文本格式
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# 一次请求的追踪：记录各阶段耗时、token 统计和错误，结束时写入指标和 JSON 日志
+class Trace:
+    def __init__(self, handler, request_id=None):
+        self.handler = handler
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.fields = {}
+        self.error = None
+        self.cancelled = False
+        self._first_token = False
+        self._finished = False
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(stage, time.perf_counter() - started)
+
+    # 不方便用 with 包住的阶段（如跨越多个 await 的排队）直接记录耗时
+    def record_span(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+    def first_token(self):
+        if not self._first_token:
+            self._first_token = True
+            elapsed = time.perf_counter() - self.started
+            self.fields['ttft_ms'] = round(elapsed * 1000, 1)
+            FIRST_TOKEN_SECONDS.observe(elapsed, handler=self.handler)
+
+    # 记录 Ollama 最后一条数据中的 token 统计；合并到其他请求上的生成只记一次合并
+    def record_generation(self, model, data):
+        if data.get('coalesced'):
+            COALESCED.inc(model=model)
+            self.fields.update(model=model, coalesced=True)
+            return
+        prompt_tokens = data.get('prompt_eval_count', 0)
+        completion_tokens = data.get('eval_count', 0)
+        PROMPT_TOKENS.inc(prompt_tokens, model=model)
+        COMPLETION_TOKENS.inc(completion_tokens, model=model)
+        PROMPT_EVAL_SECONDS.observe(data.get('prompt_eval_duration', 0) / 1e9, model=model)
+        EVAL_SECONDS.observe(data.get('eval_duration', 0) / 1e9, model=model)
+        self.fields.update(model=model, prompt_eval_count=prompt_tokens, eval_count=completion_tokens,
+                           prompt_eval_ms=data.get('prompt_eval_duration', 0) / 1e6,
+                           eval_ms=data.get('eval_duration', 0) / 1e6)
+
+    def fail(self, error):
+        self.error = type(error).__name__
+        ERRORS.inc(handler=self.handler, type=self.error)
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            CANCELLED.inc(handler=self.handler)
+
+    @property
+    def status(self):
+        return 'error' if self.error else 'cancelled' if self.cancelled else 'ok'
+
+    def finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        duration = time.perf_counter() - self.started
+        REQUEST_SECONDS.observe(duration, handler=self.handler)
+        REQUESTS.inc(handler=self.handler, status=self.status)
+        if JSON_LOGS:
+            record = {'request_id': self.request_id, 'handler': self.handler, 'duration_ms': round(duration * 1000, 1),
+                      'spans_ms': {stage: round(seconds * 1000, 1) for stage, seconds in self.spans.items()},
+                      'status': self.status, 'error': self.error}
+            record.update(self.fields)
+            trace_logger.info(json.dumps(record, ensure_ascii=False))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 生成器被关闭、任务被取消都是客户端放弃了请求，不算错误
+        if isinstance(exc, (GeneratorExit, asyncio.CancelledError)):
+            self.cancel()
+        elif exc is not None:
+            self.fail(exc)
+        self.finish()
+
+
+# JSON 日志每行一条，直接输出到标准错误
+def configure_json_logs():
+    if trace_logger.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+
+if JSON_LOGS:
+    configure_json_logs()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# 没有自己的 HTTP 路由时（如 Gradio），在单独的端口上提供 /metrics；
+# 默认只监听本机，需要让其他机器抓取时再显式传入 host
+def start_http_server(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,8 +1,10 @@
 import gradio as gr
-import requests
-import json
+from contextlib import closing
 from typing import Iterator, List
 
+from reasoning import ReasoningSplitter
+from streaming import cached_stream_chat, coalesce_frames
+
 # 自定义颜色主题
 theme = gr.themes.Default(
     primary_hue="emerald",  # 主色调为绿色
@@ -15,29 +17,31 @@ theme = gr.themes.Default(
 
 # 流式响应生成函数
 def stream_response(prompt: str, history: List[List[str]], temperature: float, max_tokens: int) -> Iterator[List[List[str]]]:
-    """流式响应生成函数，逐步生成模型的回复"""
+    """流式响应生成函数，逐步生成模型的回复
+
+    token 按 FRAME_INTERVAL 合并成帧后再刷新页面；每帧只更新最后一条回复，之前的对话不重新构造，
+    Gradio 对生成器的连续输出只发送与上一帧的差异（即新追加的文字）。
+    """
     messages = [{"role": "user", "content": prompt}]
-    response = requests.post(
-        'http://localhost:11434/api/chat',
-        json={
-            'model': 'deepseek-r1:1.5b',
-            'messages': messages,
-            'stream': True,
-            'options': {
-                'temperature': temperature,
-                'num_predict': max_tokens
-            }
-        },
-        stream=True
-    )
+    options = {
+        'temperature': temperature,
+        'num_predict': max_tokens
+    }
+    # <think> 推理过程不显示，推理阶段先显示占位文字
+    splitter = ReasoningSplitter()
     partial_response = ""
-    for chunk in response.iter_lines():
-        if chunk:
-            data = json.loads(chunk.decode("utf-8"))
-            if "message" in data and "content" in data["message"]:
-                partial_response += data["message"]["content"]
-                # 返回符合 Chatbot 组件要求的格式
-                yield history + [[prompt, partial_response]]
+    history.append([prompt, "💭 思考中…"])
+    yield history
+    with closing(cached_stream_chat(messages, options=options)) as chunks:
+        for frame in coalesce_frames(chunks):
+            _, answer = splitter.feed(frame)
+            if answer:
+                partial_response += answer
+                history[-1][1] = partial_response
+                yield history
+    partial_response += splitter.finish()[1]
+    history[-1][1] = partial_response
+    yield history
 
 # 创建 Gradio 界面
 def create_ui():
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from typing import Iterator, List
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from coalescing import SingleFlight
+
+OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://localhost:11434')
+DEFAULT_MODEL = 'deepseek-r1:1.5b'
+KEEP_ALIVE = '30m'  # 模型在后端常驻的时间，避免空闲后重新加载、丢失已缓存的前缀
+RETRY_STATUS = (500, 502, 503, 504)
+POOL_TIMEOUT = 30.0  # 从连接池取连接最多等待的秒数；连接泄漏时抛出 EmptyPoolError，而不是一直阻塞
+
+
+# 后端不可用：熔断器打开或重试次数用尽
+class BackendUnavailable(Exception):
+    pass
+
+
+# 熔断器
+class CircuitBreaker:
+    """连续失败达到阈值后打开，打开期间直接失败；冷却结束后放行一个探测请求"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half_open'
+            return 'open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+# 从连接池取连接有等待上限的 HTTPAdapter
+class PoolTimeoutAdapter(HTTPAdapter):
+    """requests 不向 urllib3 传 pool_timeout，pool_block=True 时连接池耗尽会永久阻塞；这里给连接池设默认值"""
+
+    def __init__(self, pool_timeout=POOL_TIMEOUT, **kwargs):
+        self.pool_timeout = pool_timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': self._with_pool_timeout(HTTPConnectionPool),
+            'https': self._with_pool_timeout(HTTPSConnectionPool),
+        }
+
+    def _with_pool_timeout(self, pool_class):
+        pool_timeout = self.pool_timeout
+
+        class Pool(pool_class):
+            def urlopen(self, *args, **kwargs):
+                if kwargs.get('pool_timeout') is None:
+                    kwargs['pool_timeout'] = pool_timeout
+                return super().urlopen(*args, **kwargs)
+
+        return Pool
+
+
+# Ollama 客户端
+class OllamaClient:
+    """复用连接池的 Ollama 客户端：带超时、抖动指数退避重试和熔断
+
+    参数完全相同的并发请求只向后端发起一次，流式结果分发给所有调用方。
+    """
+
+    def __init__(self, base_url=OLLAMA_URL, pool_size=10, connect_timeout=3.05, read_timeout=300.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0, breaker=None, pool_timeout=POOL_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.flights = SingleFlight()
+
+        self.session = requests.Session()
+        adapter = PoolTimeoutAdapter(pool_timeout=pool_timeout, pool_connections=1, pool_maxsize=pool_size,
+                                     pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _backoff(self, attempt):
+        # full jitter：在 [0, base * 2^attempt] 之间随机等待
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    # 发送请求：连接错误和 5xx 会重试；流式请求只在收到响应头之前重试
+    def post(self, path, payload, stream=False):
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                raise BackendUnavailable(f'Ollama 后端暂不可用（熔断中）：{self.base_url}')
+            try:
+                response = self.session.post(self.base_url + path, json=payload, stream=stream, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = e
+            else:
+                if response.status_code not in RETRY_STATUS:
+                    self.breaker.record_success()
+                    if not response.ok:
+                        # 流式响应不读完不会归还连接，先关闭再抛出
+                        response.close()
+                        response.raise_for_status()
+                    return response
+                last_error = requests.HTTPError(f'{response.status_code} {response.reason}', response=response)
+                response.close()
+            self.breaker.record_failure()
+            if attempt < self.max_retries:
+                self._backoff(attempt)
+        raise BackendUnavailable(f'请求 Ollama 失败：{last_error}') from last_error
+
+    # on_done 会收到最后一条数据，其中包含 prompt_eval_count、eval_count 等统计字段
+    def _iter_stream(self, path, payload, on_done=None):
+        with self.post(path, payload, stream=True) as response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line.decode('utf-8'))
+                if 'error' in data:
+                    raise RuntimeError(data['error'])
+                yield data
+                if data.get('done'):
+                    if on_done:
+                        on_done(data)
+                    break
+
+    # 流式请求的文本块；相同请求正在进行时直接订阅它的输出
+    def _iter_text(self, path, payload, on_done=None):
+        def upstream(finish):
+            for data in self._iter_stream(path, payload, finish):
+                # /api/generate 返回 response，/api/chat 返回 message.content
+                text = data.get('response') or data.get('message', {}).get('content')
+                if text:
+                    yield text
+        return self.flights.stream(self.flight_key(path, payload), upstream, on_done)
+
+    # 阻塞请求：相同请求正在进行时等待它的结果
+    def _call(self, path, payload):
+        return dict(self.flights.call(self.flight_key(path, payload), lambda: self.post(path, payload).json()))
+
+    @staticmethod
+    def flight_key(path, payload):
+        data = json.dumps([path, payload], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _payload(model, options, keep_alive, **fields):
+        payload = {'model': model, 'keep_alive': keep_alive}
+        payload.update(fields)
+        if options:
+            payload['options'] = options
+        return payload
+
+    def generate(self, prompt: str, model: str = DEFAULT_MODEL, options: dict = None,
+                 context: List[int] = None, keep_alive: str = KEEP_ALIVE) -> dict:
+        """非流式请求 /api/generate，返回完整的响应 JSON；传入上一轮返回的 context 可以接着生成"""
+        payload = self._payload(model, options, keep_alive, prompt=prompt, stream=False)
+        if context:
+            payload['context'] = context
+        return self._call('/api/generate', payload)
+
+    def stream_generate(self, prompt: str, model: str = DEFAULT_MODEL, options: dict = None,
+                        keep_alive: str = KEEP_ALIVE, on_done=None) -> Iterator[str]:
+        """流式请求 /api/generate，逐块返回新生成的文本"""
+        payload = self._payload(model, options, keep_alive, prompt=prompt, stream=True)
+        return self._iter_text('/api/generate', payload, on_done)
+
+    def chat(self, messages: List[dict], model: str = DEFAULT_MODEL, options: dict = None,
+             keep_alive: str = KEEP_ALIVE) -> dict:
+        """非流式请求 /api/chat，返回完整的响应 JSON"""
+        payload = self._payload(model, options, keep_alive, messages=messages, stream=False)
+        return self._call('/api/chat', payload)
+
+    def stream_chat(self, messages: List[dict], model: str = DEFAULT_MODEL, options: dict = None,
+                    keep_alive: str = KEEP_ALIVE, on_done=None) -> Iterator[str]:
+        """流式请求 /api/chat，逐块返回新生成的文本"""
+        payload = self._payload(model, options, keep_alive, messages=messages, stream=True)
+        return self._iter_text('/api/chat', payload, on_done)
+
+    def embed(self, texts: List[str], model: str, keep_alive: str = KEEP_ALIVE) -> List[List[float]]:
+        """请求 /api/embed，返回每段文本的向量"""
+        payload = {'model': model, 'input': texts, 'keep_alive': keep_alive}
+        return self.post('/api/embed', payload).json()['embeddings']
+
+
+# 所有入口共用的客户端
+client = OllamaClient()
@@ -0,0 +1,84 @@
+THINK_OPEN = '<think>'
+THINK_CLOSE = '</think>'
+
+
+# 把完整回复拆成推理过程和最终回答
+def split_reasoning(text):
+    """返回 (reasoning, answer)；回复不以 <think> 开头时推理过程为空"""
+    stripped = text.lstrip()
+    if not stripped.startswith(THINK_OPEN):
+        return '', text
+    reasoning, _, answer = stripped[len(THINK_OPEN):].partition(THINK_CLOSE)
+    return reasoning.strip(), answer.lstrip()
+
+
+# 流式拆分推理过程和回答
+class ReasoningSplitter:
+    """逐块输入模型输出，返回 (推理片段, 回答片段)
+
+    标签可能被拆在两个块之间，疑似标签开头的尾部会暂存到下一块再判断。
+    """
+
+    def __init__(self):
+        self.reasoning = []
+        self.answer = []
+        self._state = 'start'  # start: 等待 <think>；think: 推理中；answer: 回答中
+        self._pending = ''
+
+    def feed(self, delta):
+        text = self._pending + delta
+        self._pending = ''
+        reasoning = answer = ''
+
+        if self._state == 'start':
+            stripped = text.lstrip()
+            if stripped.startswith(THINK_OPEN):
+                self._state = 'think'
+                text = stripped[len(THINK_OPEN):]
+            elif THINK_OPEN.startswith(stripped):
+                self._pending = text  # 还不能确定是否以 <think> 开头
+                return '', ''
+            else:
+                self._state = 'answer'
+
+        if self._state == 'think':
+            reasoning, found, rest = text.partition(THINK_CLOSE)
+            if found:
+                self._state = 'answer'
+                text = rest.lstrip()
+                if not text:
+                    self._state = 'answer_start'  # 去掉回答开头的空行
+            else:
+                reasoning, self._pending = self._hold_back(reasoning, THINK_CLOSE)
+                text = ''
+
+        if self._state == 'answer_start' and text:
+            text = text.lstrip()
+            if text:
+                self._state = 'answer'
+        if self._state == 'answer':
+            answer = text
+
+        self.reasoning.append(reasoning)
+        self.answer.append(answer)
+        return reasoning, answer
+
+    # 结束时输出暂存的内容
+    def finish(self):
+        pending, self._pending = self._pending, ''
+        if self._state == 'think':
+            self.reasoning.append(pending)
+            return pending, ''
+        self.answer.append(pending)
+        return '', pending
+
+    @staticmethod
+    def _hold_back(text, tag):
+        for size in range(min(len(tag) - 1, len(text)), 0, -1):
+            if tag.startswith(text[-size:]):
+                return text[:-size], text[-size:]
+        return text, ''
+
+    def result(self):
+        """返回 (reasoning, answer)"""
+        return ''.join(self.reasoning).strip(), ''.join(self.answer)
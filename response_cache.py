@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator
+
+WHITESPACE = re.compile(r'\s+')
+BACKEND_DEFAULT_TEMPERATURE = 0.8  # 请求不带 temperature 时 Ollama 使用的默认值
+
+
+# 逐段回放缓存的回答，前端看到的仍是流式输出
+def replay(text, chunk_size=16) -> Iterator[str]:
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size]
+
+
+# 相同请求的回答缓存
+class ResponseCache:
+    """内存 LRU + 可选的 SQLite 磁盘层，按 TTL 过期；temperature 高于阈值的请求不缓存
+
+    没有指定 temperature 的请求按后端默认值（0.8，随机采样）处理，不缓存，
+    只有调用方明确指定较低 temperature 的请求才缓存。
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl=3600, max_temperature=0.7,
+                 disk_path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.max_disk_entries = max_disk_entries
+        self.hits = self.misses = self.bypasses = 0
+        self._memory = OrderedDict()  # key -> (过期时间, 回答)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if disk_path:
+            directory = os.path.dirname(disk_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses '
+                             '(key TEXT PRIMARY KEY, response TEXT, expires REAL)')
+            self._db.commit()
+
+    # 缓存键：模型、采样参数和规范化后的消息
+    @staticmethod
+    def key(model, messages, options=None):
+        normalized = [[message['role'], WHITESPACE.sub(' ', message['content']).strip()] for message in messages]
+        payload = json.dumps([model, options or {}, normalized], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def cacheable(self, options=None):
+        temperature = (options or {}).get('temperature', BACKEND_DEFAULT_TEMPERATURE)
+        return temperature <= self.max_temperature
+
+    def get(self, key, options=None):
+        """命中时返回缓存的回答；未命中或不可缓存时返回 None"""
+        if not self.cacheable(options):
+            with self._lock:
+                self.bypasses += 1
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._pop(key)
+            if self._db is not None:
+                row = self._db.execute('SELECT response, expires FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None and row[1] > now:
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, response, options=None):
+        if not self.cacheable(options):
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, response, expires)
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, response, expires))
+                self._db.execute('DELETE FROM responses WHERE expires <= ?', (time.time(),))
+                self._db.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses '
+                                 'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.max_disk_entries,))
+                self._db.commit()
+
+    def _remember(self, key, response, expires):
+        if key in self._memory:
+            self._pop(key)
+        self._memory[key] = (expires, response)
+        self._bytes += len(response)
+        while self._memory and (len(self._memory) > self.max_entries or self._bytes > self.max_bytes):
+            self._pop(next(iter(self._memory)))
+
+    def _pop(self, key):
+        _, response = self._memory.pop(key)
+        self._bytes -= len(response)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypasses': self.bypasses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': len(self._memory),
+                'bytes': self._bytes,
+            }
@@ -0,0 +1,215 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+from ingest import UPLOAD_DIR, iter_chunks, load_document
+from ollama_client import client
+
+try:
+    import numpy as np
+except ImportError:  # 可选依赖，缺失时只使用 BM25
+    np = None
+
+EMBED_MODEL = os.environ.get('OLLAMA_EMBED_MODEL')  # 例如 nomic-embed-text；未设置时不建向量索引
+EMBED_BATCH = 32
+BM25_FILE = 'bm25.json'
+EMBEDDINGS_FILE = 'embeddings.npy'
+RRF_K = 60
+
+CJK_RUN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+WORD = re.compile(r'[0-9a-zA-Z_]+')
+
+
+# 分词：英文和数字按单词，中文按相邻两字（单字的词保留单字）
+def tokenize(text):
+    tokens = [word.lower() for word in WORD.findall(text)]
+    for run in CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+# 单个文档的 BM25 倒排索引
+class BM25Index:
+    """postings: 词 -> [[块序号, 词频], ...]；lengths: 每块的词数；offsets: 每块在 chunks.jsonl 中的字节位置"""
+
+    def __init__(self, postings, lengths, offsets):
+        self.postings = postings
+        self.lengths = lengths
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, chunks_path):
+        postings = defaultdict(list)
+        lengths = []
+        offsets = []
+        with open(chunks_path, 'rb') as file:
+            while True:
+                offset = file.tell()
+                line = file.readline()
+                if not line:
+                    break
+                chunk = json.loads(line)
+                terms = tokenize(chunk['text'])
+                for term, count in Counter(terms).items():
+                    postings[term].append([chunk['index'], count])
+                lengths.append(len(terms))
+                offsets.append(offset)
+        return cls(dict(postings), lengths, offsets)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        return cls(data['postings'], data['lengths'], data['offsets'])
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'postings': self.postings, 'lengths': self.lengths, 'offsets': self.offsets},
+                      file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+
+# 在多个文档上做 BM25 检索，统计量（文档数、平均长度、df）按所有文档合并计算
+def bm25_search(indexes, query, top_k, k1=1.5, b=0.75):
+    """indexes: [(doc_id, BM25Index)]，返回 [(score, doc_id, chunk_index)]"""
+    total = sum(len(index.lengths) for _, index in indexes)
+    if not total:
+        return []
+    avgdl = sum(sum(index.lengths) for _, index in indexes) / total or 1
+
+    scores = defaultdict(float)
+    for term in set(tokenize(query)):
+        df = sum(len(index.postings.get(term, ())) for _, index in indexes)
+        if not df:
+            continue
+        idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+        for doc_id, index in indexes:
+            for chunk_index, tf in index.postings.get(term, ()):
+                length = index.lengths[chunk_index]
+                scores[(doc_id, chunk_index)] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avgdl))
+    best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [(score, doc_id, chunk_index) for (doc_id, chunk_index), score in best]
+
+
+# 向量检索：所有文档的块向量已归一化，点积即余弦相似度
+def embedding_search(matrices, query_vector, top_k):
+    """matrices: [(doc_id, ndarray[n, dim])]，返回 [(score, doc_id, chunk_index)]"""
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= np.linalg.norm(query) or 1.0
+    results = []
+    for doc_id, matrix in matrices:
+        if not len(matrix):
+            continue
+        scores = matrix @ query
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        results.extend((float(scores[i]), doc_id, int(i)) for i in top)
+    results.sort(reverse=True)
+    return results[:top_k]
+
+
+# 检索器
+class Retriever:
+    """为上传的文档建立索引（保存在 uploads/<doc_id>/ 下），按问题取最相关的 top_k 个块"""
+
+    def __init__(self, upload_dir=UPLOAD_DIR, top_k=4, embed_model=EMBED_MODEL, cache_size=32):
+        self.upload_dir = upload_dir
+        self.top_k = top_k
+        self.embed_model = embed_model if np is not None else None
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (doc_id, 文件名) -> 已加载的索引
+        self._lock = threading.Lock()
+
+    # 为文档建立 BM25 索引（配置了向量模型时同时建立向量索引）；同样内容的文档已有索引时跳过
+    def index_document(self, document):
+        bm25_path = os.path.join(document.directory, BM25_FILE)
+        if not os.path.exists(bm25_path):
+            BM25Index.build(os.path.join(document.directory, 'chunks.jsonl')).save(bm25_path)
+        if self.embed_model and not os.path.exists(os.path.join(document.directory, EMBEDDINGS_FILE)):
+            self._embed_document(document)
+
+    def _embed_document(self, document):
+        vectors = []
+        batch = []
+        for chunk in iter_chunks(document):
+            batch.append(chunk['text'])
+            if len(batch) == EMBED_BATCH:
+                vectors.extend(client.embed(batch, model=self.embed_model))
+                batch = []
+        if batch:
+            vectors.extend(client.embed(batch, model=self.embed_model))
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if len(matrix):
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        path = os.path.join(document.directory, EMBEDDINGS_FILE)
+        with open(path + '.tmp', 'wb') as file:
+            np.save(file, matrix)
+        os.replace(path + '.tmp', path)
+
+    def _load(self, doc_id, filename):
+        key = (doc_id, filename)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        path = os.path.join(self.upload_dir, doc_id, filename)
+        if not os.path.exists(path):
+            return None
+        value = BM25Index.load(path) if filename == BM25_FILE else np.load(path)
+        with self._lock:
+            self._cache[key] = value
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def _read_chunk(self, doc_id, chunk_index):
+        index = self._load(doc_id, BM25_FILE)
+        with open(os.path.join(self.upload_dir, doc_id, 'chunks.jsonl'), 'rb') as file:
+            file.seek(index.offsets[chunk_index])
+            return json.loads(file.readline())
+
+    def search(self, doc_ids, query, top_k=None):
+        """返回最相关的块：[{'doc_id', 'name', 'index', 'text', 'score'}]"""
+        top_k = top_k or self.top_k
+        indexes = [(doc_id, index) for doc_id, index in ((d, self._load(d, BM25_FILE)) for d in doc_ids) if index]
+        results = bm25_search(indexes, query, top_k)
+
+        if self.embed_model:
+            matrices = [(doc_id, matrix) for doc_id, matrix in
+                        ((d, self._load(d, EMBEDDINGS_FILE)) for d in doc_ids) if matrix is not None]
+            if matrices:
+                dense = embedding_search(matrices, client.embed([query], model=self.embed_model)[0], top_k)
+                results = reciprocal_rank_fusion([results, dense], top_k)
+
+        chunks = []
+        for score, doc_id, chunk_index in results:
+            chunk = self._read_chunk(doc_id, chunk_index)
+            chunks.append({'doc_id': doc_id, 'name': load_document(doc_id, self.upload_dir).name,
+                           'index': chunk_index, 'text': chunk['text'], 'score': score})
+        return chunks
+
+
+# 合并多路检索结果（RRF）
+def reciprocal_rank_fusion(result_lists, top_k):
+    scores = defaultdict(float)
+    for results in result_lists:
+        for rank, (_, doc_id, chunk_index) in enumerate(results):
+            scores[(doc_id, chunk_index)] += 1.0 / (RRF_K + rank + 1)
+    best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [(score, doc_id, chunk_index) for (doc_id, chunk_index), score in best]
+
+
+# 把检索到的块拼进本轮提问
+def format_references(chunks, question):
+    parts = ["以下是从已上传文档中检索到的相关内容：\n"]
+    for chunk in chunks:
+        parts.append(f"【{chunk['name']} · 第 {chunk['index'] + 1} 段】\n{chunk['text'].strip()}\n")
+    parts.append(f"请参考以上内容回答：{question}")
+    return "\n".join(parts)
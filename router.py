@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import AsyncIterator, List
+
+from async_pipeline import AsyncOllamaClient
+from ollama_client import OLLAMA_URL, DEFAULT_MODEL, KEEP_ALIVE, BackendUnavailable
+
+logger = logging.getLogger(__name__)
+
+# 后端列表，逗号分隔，例如 http://gpu1:11434,http://gpu2:11434；未设置时只用 OLLAMA_URL
+OLLAMA_BACKENDS = [url.strip() for url in os.environ.get('OLLAMA_BACKENDS', OLLAMA_URL).split(',') if url.strip()]
+LATENCY_ALPHA = 0.3  # 首 token 延迟的指数移动平均系数
+
+
+# 单个 Ollama 后端的状态
+class Backend:
+    def __init__(self, url, client=None):
+        self.url = url.rstrip('/')
+        self.client = client or AsyncOllamaClient(self.url)
+        self.healthy = True
+        self.models = None       # 健康检查时从 /api/tags 获取；None 表示未知，视为都支持
+        self.outstanding = 0     # 正在处理的请求数
+        self.latency = None      # 首 token 延迟（秒）的移动平均
+        self.requests = 0
+        self.failures = 0
+
+    # 熔断打开的后端同样不再分配新请求
+    @property
+    def available(self):
+        return self.healthy and self.client.breaker.state != 'open'
+
+    def serves(self, model):
+        return self.models is None or model in self.models
+
+    def record_latency(self, seconds):
+        self.latency = seconds if self.latency is None else \
+            LATENCY_ALPHA * seconds + (1 - LATENCY_ALPHA) * self.latency
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'breaker': self.client.breaker.state,
+            'models': self.models,
+            'outstanding': self.outstanding,
+            'latency_ms': self.latency * 1000 if self.latency is not None else None,
+            'requests': self.requests,
+            'failures': self.failures,
+        }
+
+
+# 多后端路由
+class BackendRouter:
+    """在多个 Ollama 后端之间分配请求，接口与 AsyncOllamaClient.stream_chat 相同
+
+    strategy 为 least_outstanding 时选正在处理请求最少的后端，为 latency 时按
+    首 token 延迟 ×（请求数 + 1）选择。同一会话尽量固定在同一个后端，保持
+    前缀缓存有效；粘滞的后端比最空闲的后端多出 sticky_slack 个以上请求时才迁移。
+    定期健康检查，失败的后端不再分配新请求（已在处理的请求继续完成），恢复后重新加入。
+    """
+
+    def __init__(self, urls=None, backends=None, strategy='least_outstanding', sticky_slack=2,
+                 max_sticky=10000, health_interval=10.0, health_timeout=2.0):
+        if strategy not in ('least_outstanding', 'latency'):
+            raise ValueError(f'未知的负载均衡策略：{strategy}')
+        self.backends = backends or [Backend(url) for url in (urls or OLLAMA_BACKENDS)]
+        self.strategy = strategy
+        self.sticky_slack = sticky_slack
+        self.max_sticky = max_sticky
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._sticky = OrderedDict()  # (affinity, model) -> Backend，按最近使用排序
+        self._health_task = None
+
+    def _score(self, backend):
+        if self.strategy == 'latency':
+            # 还没有延迟数据的后端优先尝试
+            return (backend.latency or 0.0) * (backend.outstanding + 1), backend.outstanding
+        return backend.outstanding, backend.latency or 0.0
+
+    # 选择后端：优先粘滞的后端，其次按策略选择负载最低的
+    def pick(self, model, affinity=None, exclude=()):
+        candidates = [b for b in self.backends if b.available and b.serves(model) and b not in exclude]
+        if not candidates:
+            raise BackendUnavailable(f'没有可用的后端提供模型 {model}')
+        best = min(candidates, key=self._score)
+        if affinity is None:
+            return best
+        key = (affinity, model)
+        sticky = self._sticky.get(key)
+        if sticky in candidates and sticky.outstanding - best.outstanding <= self.sticky_slack:
+            best = sticky
+        self._sticky[key] = best
+        self._sticky.move_to_end(key)
+        while len(self._sticky) > self.max_sticky:
+            self._sticky.popitem(last=False)
+        return best
+
+    async def stream_chat(self, messages: List[dict], model: str = DEFAULT_MODEL, options: dict = None,
+                          keep_alive: str = KEEP_ALIVE, on_done=None, affinity=None) -> AsyncIterator[str]:
+        """流式请求 /api/chat；收到第一个 token 之前失败会换一个后端重试"""
+        self._start_health_checks()
+        tried = []
+        while True:
+            backend = self.pick(model, affinity, exclude=tried)
+            tried.append(backend)
+            backend.outstanding += 1
+            backend.requests += 1
+            started = time.monotonic()
+            first = True
+            try:
+                async with aclosing(backend.client.stream_chat(messages, model=model, options=options,
+                                                               keep_alive=keep_alive, on_done=on_done)) as stream:
+                    async for delta in stream:
+                        if first:
+                            backend.record_latency(time.monotonic() - started)
+                            first = False
+                        yield delta
+                return
+            except BackendUnavailable:
+                backend.failures += 1
+                if not first:
+                    raise
+                logger.warning('后端 %s 不可用，切换到其他后端', backend.url)
+            finally:
+                backend.outstanding -= 1
+
+    # 所有可用后端提供的模型
+    def models(self):
+        names = set()
+        for backend in self.backends:
+            if backend.available and backend.models:
+                names.update(backend.models)
+        return sorted(names)
+
+    async def check(self, backend):
+        try:
+            backend.models = await backend.client.list_models(timeout=self.health_timeout)
+        except Exception as e:
+            if backend.healthy:
+                logger.warning('后端 %s 健康检查失败，暂停分配请求：%s', backend.url, e)
+            backend.healthy = False
+        else:
+            if not backend.healthy:
+                logger.info('后端 %s 已恢复', backend.url)
+            backend.healthy = True
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(backend) for backend in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await self.check_all()
+            await asyncio.sleep(self.health_interval)
+
+    # 健康检查在首次使用时启动，保证运行在当前事件循环中
+    def _start_health_checks(self):
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+
+    def stats(self):
+        return {'strategy': self.strategy, 'backends': [backend.stats() for backend in self.backends]}
+
+    async def aclose(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for backend in self.backends:
+            await backend.client.aclose()
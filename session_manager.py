@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import archive
+from conversation_store import ConversationStore, REASONING_SUFFIX, SUMMARY_SUFFIX
+from document_store import DocumentStore
+
+logger = logging.getLogger(__name__)
+
+SESSION_DIR = 'chat_histories'
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+# 按会话隔离的对话管理器
+class SessionManager:
+    """每个会话一份对话日志；热会话缓存在 LRU 中，超出数量或内存上限时落盘并释放
+
+    长时间未更新的会话压缩归档（见 archive.py），再次打开时自动恢复为日志。
+    会话上传的文档按内容哈希引用，引用计数由 document_store 维护。
+    """
+
+    def __init__(self, directory=SESSION_DIR, max_sessions=64, max_memory_chars=8 * 1024 * 1024, tail_size=200,
+                 document_store=None):
+        self.directory = directory
+        self.document_store = document_store or DocumentStore()
+        self.max_sessions = max_sessions
+        self.max_memory_chars = max_memory_chars
+        self.tail_size = tail_size
+        self._stores = OrderedDict()  # session_id -> ConversationStore，按最近使用排序
+        self._locks = {}              # session_id -> 会话锁
+        self._lock = threading.Lock()
+        self._archiving = set()       # 正在归档的会话
+        self._archive_done = threading.Condition(self._lock)
+        os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(self.document_store.path):
+            # 还没有引用记录（旧版本上传的文档）：按会话的文档列表统计一次，否则会被当作无用文档回收
+            self.document_store.rebuild(directory)
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    # 校验会话 ID，非法或为空时分配新的（同时防止拼接路径时越界）
+    def ensure_session_id(self, session_id):
+        if session_id and SESSION_ID_PATTERN.match(session_id):
+            return session_id
+        return self.new_session_id()
+
+    def path_for(self, session_id):
+        return os.path.join(self.directory, session_id + '.jsonl')
+
+    # 会话是否已有对话日志（含已归档的）
+    def exists(self, session_id):
+        path = self.path_for(session_id)
+        return os.path.exists(path) or os.path.exists(archive.archive_path_for(path))
+
+    # 会话已上传的文档 ID（内容哈希）列表，保存在 <session_id>.docs.json
+    def documents(self, session_id):
+        path = os.path.join(self.directory, session_id + '.docs.json')
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def attach_document(self, session_id, doc_id):
+        with self._lock:
+            doc_ids = self.documents(session_id)
+            if doc_id in doc_ids:
+                return
+            doc_ids.append(doc_id)
+            path = os.path.join(self.directory, session_id + '.docs.json')
+            with open(path + '.tmp', 'w', encoding='utf-8') as file:
+                json.dump(doc_ids, file)
+            os.replace(path + '.tmp', path)
+            self.document_store.retain(doc_id, session_id)
+
+    # 解除会话对所有文档的引用
+    def detach_documents(self, session_id):
+        with self._lock:
+            for doc_id in self.documents(session_id):
+                self.document_store.release(doc_id, session_id)
+            path = os.path.join(self.directory, session_id + '.docs.json')
+            if os.path.exists(path):
+                os.remove(path)
+
+    # 删除会话：对话日志（或归档）及附属文件，并解除文档引用；正在进行的一轮结束后才删除
+    def delete(self, session_id):
+        with self._lock:
+            lock = self._locks.setdefault(session_id, threading.Lock())
+        with lock:
+            with self._lock:
+                store = self._stores.pop(session_id, None)
+                if store is not None:
+                    store.close()
+                self._locks.pop(session_id, None)
+                base = os.path.join(self.directory, session_id)
+                for suffix in ('.jsonl', '.json', archive.ARCHIVE_SUFFIX, REASONING_SUFFIX,
+                               REASONING_SUFFIX + '.gz', SUMMARY_SUFFIX):
+                    if os.path.exists(base + suffix):
+                        os.remove(base + suffix)
+        self.detach_documents(session_id)
+
+    # 获取会话的对话存储，不在缓存中时从磁盘打开
+    def get(self, session_id):
+        with self._lock:
+            # 正在归档的会话等归档完成后再打开（随后从归档恢复）
+            while session_id in self._archiving:
+                self._archive_done.wait()
+            store = self._stores.get(session_id)
+            if store is not None:
+                self._stores.move_to_end(session_id)
+                return store
+            path = self.path_for(session_id)
+            archive.restore_if_archived(path)
+            store = ConversationStore(path, tail_size=self.tail_size)
+            self._stores[session_id] = store
+            self._evict()
+            return store
+
+    # 淘汰最久未用的会话；正在处理请求（持有会话锁）的会话不淘汰
+    def _evict(self):
+        memory = sum(store.memory_usage() for store in self._stores.values())
+        for session_id in list(self._stores):
+            if len(self._stores) <= self.max_sessions and memory <= self.max_memory_chars:
+                break
+            lock = self._locks.get(session_id)
+            if lock is not None and lock.locked():
+                continue
+            store = self._stores.pop(session_id)
+            memory -= store.memory_usage()
+            store.close()
+            self._locks.pop(session_id, None)
+
+    # 会话锁：同一会话的一轮对话串行执行，不同会话互不影响
+    @contextmanager
+    def session(self, session_id):
+        with self._lock:
+            lock = self._locks.setdefault(session_id, threading.Lock())
+        with lock:
+            yield self.get(session_id)
+
+    # 归档空闲的会话；正在处理请求的会话跳过，缓存中的先关闭
+    def archive_idle(self, max_idle_days=archive.ARCHIVE_AFTER_DAYS):
+        """全局锁内只挑出会话并从缓存摘下，压缩在锁外进行：归档期间只有这个会话的请求等待，
+        其他会话（以及在事件循环中取会话的 AsyncPipeline）不受影响
+        """
+        archived = []
+        cutoff = time.time() - max_idle_days * 24 * 3600
+        for path in list(archive.idle_conversations(self.directory, max_idle_days)):
+            session_id = os.path.splitext(os.path.basename(path))[0]
+            with self._lock:
+                lock = self._locks.setdefault(session_id, threading.Lock())
+                if not lock.acquire(blocking=False):
+                    continue
+                self._archiving.add(session_id)
+                store = self._stores.pop(session_id, None)
+            try:
+                if store is not None:
+                    store.close()
+                # 挑选之后可能又有新消息写入，确认仍然空闲再归档
+                if os.path.exists(path) and os.stat(path).st_mtime < cutoff:
+                    archived.append(archive.archive_conversation(path))
+            finally:
+                with self._lock:
+                    self._archiving.discard(session_id)
+                    self._archive_done.notify_all()
+                lock.release()
+        return archived
+
+    # 后台线程定期归档，并回收没有会话引用的上传文档
+    def start_archiver(self, max_idle_days=archive.ARCHIVE_AFTER_DAYS, interval=3600):
+        def run():
+            while True:
+                try:
+                    self.archive_idle(max_idle_days)
+                except Exception:
+                    logger.exception('归档空闲会话失败')
+                try:
+                    self.document_store.collect()
+                except Exception:
+                    logger.exception('回收上传文档失败')
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores.clear()
+            self._locks.clear()
@@ -0,0 +1,201 @@
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import closing
+from typing import AsyncIterator, Iterator
+
+from context_builder import ContextBuilder
+from memory import SummaryMemory
+from metrics import Trace
+from ollama_client import client, DEFAULT_MODEL
+from reasoning import ReasoningSplitter
+from response_cache import ResponseCache, replay
+
+logger = logging.getLogger(__name__)
+
+# 每轮发送给模型的上下文 token 预算
+context_builder = ContextBuilder(budget=4096)
+
+# 长对话的较早轮次在后台压缩成摘要，之后每轮发送「摘要 + 最近的消息」
+memory = SummaryMemory(context_builder)
+
+# 相同请求（模型、参数、上下文都相同）直接回放缓存的回答
+response_cache = ResponseCache(max_entries=1024, ttl=3600)
+
+
+# 用户中途放弃（停止、断开连接、发送新消息）或生成出错时已生成的部分回答如何处理：
+# drop 不写入对话日志（连同这轮提问），keep 写入并标记 cancelled / failed；错误提示只发给页面，不写入日志
+PARTIAL_ANSWER_POLICY = os.environ.get('PARTIAL_ANSWER_POLICY', 'drop')
+
+# 推送到页面的最小间隔（秒）：间隔内到达的 token 合并成一帧发送
+FRAME_INTERVAL = float(os.environ.get('FRAME_INTERVAL_MS', 40)) / 1000
+
+
+# 把逐 token 的增量合并成帧
+def coalesce_frames(deltas: Iterator[str], interval: float = FRAME_INTERVAL) -> Iterator[str]:
+    """第一个 token 立即发送；距上一帧不足 interval 时先缓存，之后到达的 token 连同缓存一起发送
+
+    空字符串（心跳）原样传递，有缓存时连同缓存一起发送；结束时发送剩余的内容。
+    不负责关闭 deltas，由调用方关闭。
+    """
+    pending = []
+    last = 0.0
+    for delta in deltas:
+        if not delta:
+            # 心跳不算一帧，不推迟下一个 token
+            yield ''.join(pending)
+            pending.clear()
+            continue
+        pending.append(delta)
+        now = time.monotonic()
+        if now - last >= interval:
+            last = now
+            yield ''.join(pending)
+            pending.clear()
+    if pending:
+        yield ''.join(pending)
+
+
+# coalesce_frames 的异步版本
+async def acoalesce_frames(deltas: AsyncIterator[str], interval: float = FRAME_INTERVAL) -> AsyncIterator[str]:
+    pending = []
+    last = 0.0
+    async for delta in deltas:
+        if not delta:
+            # 心跳不算一帧，不推迟下一个 token
+            yield ''.join(pending)
+            pending.clear()
+            continue
+        pending.append(delta)
+        now = time.monotonic()
+        if now - last >= interval:
+            last = now
+            yield ''.join(pending)
+            pending.clear()
+    if pending:
+        yield ''.join(pending)
+
+
+# 最近若干轮的 token 统计
+turn_stats = deque(maxlen=1000)
+turn_stats_lock = threading.Lock()
+
+
+# 记录一轮的 token 统计
+def record_turn_stats(context, data, trace=None, model=DEFAULT_MODEL):
+    """prompt_eval_count 只包含后端实际重新计算的 token，命中前缀缓存的部分不计入；
+    合并到相同进行中请求的轮次（data 带 coalesced）token 数记为 0，避免同一次生成被重复统计
+    """
+    if trace is not None:
+        trace.record_generation(model, data)
+    stats = {
+        'messages': len(context.messages),
+        'prompt_tokens_estimated': context.tokens,
+        'prompt_eval_count': data.get('prompt_eval_count', 0),
+        'prompt_eval_ms': data.get('prompt_eval_duration', 0) / 1e6,
+        'eval_count': data.get('eval_count', 0),
+        'eval_ms': data.get('eval_duration', 0) / 1e6,
+        'coalesced': bool(data.get('coalesced')),
+    }
+    with turn_stats_lock:
+        turn_stats.append(stats)
+    if stats['coalesced']:
+        logger.info('本轮合并到相同的进行中请求，后端没有单独计算')
+        return
+    logger.info('本轮 prompt eval %d tokens（%.0f ms），生成 %d tokens（%.0f ms）',
+                stats['prompt_eval_count'], stats['prompt_eval_ms'], stats['eval_count'], stats['eval_ms'])
+
+
+# 最近 n 轮 token 统计的汇总
+def summarize_turn_stats(n=100):
+    with turn_stats_lock:
+        recent = list(turn_stats)[-n:]
+    summary = {'turns': len(recent), 'recent': recent}
+    for key in ('prompt_tokens_estimated', 'prompt_eval_count', 'prompt_eval_ms', 'eval_count', 'eval_ms'):
+        summary['avg_' + key] = sum(stats[key] for stats in recent) / len(recent) if recent else 0
+    return summary
+
+
+# 带缓存的流式生成
+def cached_stream_chat(messages, model=DEFAULT_MODEL, options=None, on_done=None) -> Iterator[str]:
+    """命中缓存时逐段回放；未命中时请求模型，完整生成结束后写入缓存"""
+    key = response_cache.key(model, messages, options)
+    cached = response_cache.get(key, options)
+    if cached is not None:
+        yield from replay(cached)
+        return
+    parts = []
+    with closing(client.stream_chat(messages, model=model, options=options, on_done=on_done)) as stream:
+        for delta in stream:
+            parts.append(delta)
+            yield delta
+    response_cache.put(key, "".join(parts), options)
+
+
+# 保存一轮对话；中途取消或出错的按 PARTIAL_ANSWER_POLICY 处理
+def save_turn(store, user_message, splitter, trace, cancelled=False, policy=None, failed=False):
+    reasoning, answer = splitter.result()
+    assistant_message = {"role": "assistant", "content": answer, "reasoning": reasoning}
+    if cancelled or failed:
+        if cancelled:
+            trace.cancel()
+        if (policy or PARTIAL_ANSWER_POLICY) != 'keep' or not answer:
+            logger.info('[%s] 生成已%s，丢弃部分回答', trace.request_id, '取消' if cancelled else '出错')
+            return
+        assistant_message['cancelled' if cancelled else 'failed'] = True
+    with trace.span('save'):
+        records = store.append(user_message, assistant_message)
+    # 只有真正写入的一轮才有推理过程 ID，调用方据此把页面上的回答与推理过程对应起来
+    trace.fields['reasoning_id'] = records[-1].get('reasoning_id')
+    memory.schedule(store)
+
+
+# 流式生成一轮对话
+def stream_turn(store, content: str, options: dict = None, trace: Trace = None,
+                keepalive: bool = False) -> Iterator[str]:
+    """逐块返回回答文本；生成结束后把用户消息和完整回复一次性写入对话日志
+
+    <think> 推理过程不返回给调用方，单独保存在回答的 reasoning 中。
+    trace 由调用方创建并结束，用来记录各阶段耗时；不传时只记录阶段指标。
+    keepalive 为 True 时推理阶段也返回空字符串，调用方借此写出心跳、及时发现客户端断开。
+    调用方提前关闭生成器时关闭到 Ollama 的连接，部分回答按 PARTIAL_ANSWER_POLICY 处理。
+    """
+    trace = trace or Trace('stream_turn')
+    with trace.span('history'):
+        conversation, offset, summary = memory.apply(store, store.messages(), store.offset())
+    user_message = {"role": "user", "content": content}
+    conversation.append(user_message)
+    with trace.span('context'):
+        context = context_builder.build(conversation, offset=offset, summary=summary)
+    logger.info('[%s] 发送上下文：%d 条消息，约 %d tokens，丢弃 %d 条旧消息',
+                trace.request_id, len(context.messages), context.tokens, context.dropped)
+
+    splitter = ReasoningSplitter()
+    failed = False
+    try:
+        with trace.span('generation'):
+            on_done = functools.partial(record_turn_stats, context, trace=trace)
+            with closing(cached_stream_chat(context.messages, options=options, on_done=on_done)) as stream:
+                for delta in stream:
+                    _, answer = splitter.feed(delta)
+                    if answer:
+                        trace.first_token()
+                        yield answer
+                    elif keepalive:
+                        yield ""
+            _, answer = splitter.finish()
+            if answer:
+                yield answer
+    except Exception as e:
+        # 错误提示只发给调用方，不写进回答，否则之后每轮的上下文和缓存键都会带上它
+        trace.fail(e)
+        failed = True
+        yield f"⚠️ 请求出错: {str(e)}"
+    except GeneratorExit:
+        save_turn(store, user_message, splitter, trace, cancelled=True)
+        raise
+
+    save_turn(store, user_message, splitter, trace, failed=failed)
@@ -0,0 +1,31 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# 模块都在仓库根目录下
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_ollama import make_server  # noqa: E402
+
+
+# 在随机端口上启动模拟的 Ollama 服务；参数同 make_server，返回的服务带有 url 属性
+@pytest.fixture
+def fake_ollama():
+    servers = []
+
+    def start(**settings):
+        # 默认的延迟比命令行启动时短，测试只需要请求之间有重叠时再显式指定
+        settings.setdefault('first_token_delay', 0.01)
+        settings.setdefault('token_delay', 0.001)
+        server = make_server(0, **settings)
+        server.url = f'http://127.0.0.1:{server.server_port}'
+        threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
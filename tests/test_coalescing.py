@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from coalescing import COALESCED_DATA, SingleFlight
+from ollama_client import BackendUnavailable, CircuitBreaker, OllamaClient
+
+
+def test_failing_leader_releases_followers_and_key():
+    flights = SingleFlight()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.1)
+        raise RuntimeError('backend down')
+
+    errors = []
+
+    def call():
+        try:
+            flights.call('key', fail)
+        except RuntimeError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=call) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    for thread in [leader] + followers:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+    assert len(errors) == 4
+    assert flights.stats()['in_flight'] == 0
+    assert flights.call('key', lambda: 'ok') == 'ok'
+
+
+def test_failing_stream_factory_does_not_poison_key():
+    flights = SingleFlight()
+
+    def broken(finish):
+        raise RuntimeError('connect failed')
+
+    with pytest.raises(RuntimeError):
+        list(flights.stream('key', broken))
+    assert flights.stats()['in_flight'] == 0
+    assert list(flights.stream('key', lambda finish: iter(['a', 'b']))) == ['a', 'b']
+
+
+def test_concurrent_streams_share_one_upstream_and_count_stats_once(fake_ollama):
+    server = fake_ollama(token_delay=0.01)
+    client = OllamaClient(server.url)
+    results, stats = [], []
+
+    def stream():
+        results.append(''.join(client.stream_chat([{'role': 'user', 'content': 'hi'}], on_done=stats.append)))
+
+    threads = [threading.Thread(target=stream) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert results == [server.RequestHandlerClass.reply] * 4
+    assert client.flights.stats()['upstream'] == 1
+    assert sum(1 for data in stats if data is COALESCED_DATA) == 3
+    assert sum(1 for data in stats if data.get('eval_count')) == 1
+
+
+def test_blocking_call_recovers_after_backend_failure(fake_ollama):
+    server = fake_ollama(fail=True, first_token_delay=0)
+    client = OllamaClient(server.url, max_retries=0, breaker=CircuitBreaker(failure_threshold=100))
+    with pytest.raises(BackendUnavailable):
+        client.generate('hi')
+    assert client.flights.stats()['in_flight'] == 0
+
+    server.RequestHandlerClass.fail = False
+    assert client.generate('hi')['response'] == server.RequestHandlerClass.reply
@@ -0,0 +1,32 @@
+import pytest
+
+from context_builder import ContextBuilder
+
+
+def conversation(turns):
+    messages = []
+    for turn in range(turns):
+        messages.append({'role': 'user', 'content': f'question {turn} ' + 'x' * 40})
+        messages.append({'role': 'assistant', 'content': f'answer {turn} ' + 'y' * 40})
+    return messages
+
+
+@pytest.mark.parametrize('align', [1, 2, 8])
+@pytest.mark.parametrize('turns', range(1, 30))
+def test_history_kept_when_earlier_messages_fit(turns, align):
+    builder = ContextBuilder(budget=100, align=align)
+    messages = conversation(turns)[:-1]
+    context = builder.build(messages)
+    assert context.tokens <= builder.budget
+    if turns > 1:
+        # 上一轮问答放得下，就不能只发送本轮提问
+        assert len(context.messages) >= 3
+        assert context.messages[-3:] == [builder.prepare(message) for message in messages[-3:]]
+
+
+def test_window_start_aligned_when_history_allows():
+    builder = ContextBuilder(budget=300, align=4)
+    messages = conversation(20)[:-1]
+    context = builder.build(messages)
+    assert context.dropped % 4 == 0
+    assert len(context.messages) >= 3
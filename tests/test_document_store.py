@@ -0,0 +1,48 @@
+import os
+
+from document_store import DocumentStore
+from ingest import ingest_file
+from session_manager import SessionManager
+
+
+def make_sessions(tmp_path):
+    store = DocumentStore(str(tmp_path / 'uploads'))
+    return SessionManager(str(tmp_path / 'chat_histories'), document_store=store)
+
+
+def upload(tmp_path, sessions, session_id, text='上传的文档内容。' * 50):
+    path = tmp_path / 'doc.txt'
+    path.write_text(text, encoding='utf-8')
+    document = ingest_file(str(path), upload_dir=sessions.document_store.upload_dir)
+    sessions.attach_document(session_id, document.doc_id)
+    return document
+
+
+def test_deleting_session_releases_and_collects_document(tmp_path):
+    sessions = make_sessions(tmp_path)
+    session_id = sessions.new_session_id()
+    document = upload(tmp_path, sessions, session_id)
+    sessions.get(session_id).append({'role': 'user', 'content': '总结一下', 'documents': [document.doc_id]})
+    assert sessions.document_store.refcount(document.doc_id) == 1
+
+    sessions.delete(session_id)
+    assert sessions.document_store.refcount(document.doc_id) == 0
+    assert not sessions.exists(session_id)
+
+    sessions.document_store.collect(grace_seconds=0)
+    assert not os.path.exists(document.directory)
+
+
+def test_shared_document_survives_until_last_reference(tmp_path):
+    sessions = make_sessions(tmp_path)
+    first, second = sessions.new_session_id(), sessions.new_session_id()
+    document = upload(tmp_path, sessions, first)
+    assert upload(tmp_path, sessions, second).doc_id == document.doc_id
+
+    sessions.delete(first)
+    sessions.document_store.collect(grace_seconds=0)
+    assert os.path.exists(document.directory)
+
+    sessions.delete(second)
+    sessions.document_store.collect(grace_seconds=0)
+    assert not os.path.exists(document.directory)
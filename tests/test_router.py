@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from async_pipeline import AsyncOllamaClient
+from ollama_client import BackendUnavailable
+from router import Backend, BackendRouter
+
+MESSAGES = [{'role': 'user', 'content': 'hi'}]
+
+
+def make_router(*servers, **kwargs):
+    backends = [Backend(server.url, client=AsyncOllamaClient(server.url, max_retries=0)) for server in servers]
+    return BackendRouter(backends=backends, **kwargs)
+
+
+async def collect(router, **kwargs):
+    return ''.join([delta async for delta in router.stream_chat(MESSAGES, **kwargs)])
+
+
+def test_least_outstanding_spreads_concurrent_requests(fake_ollama):
+    servers = [fake_ollama(token_delay=0.02), fake_ollama(token_delay=0.02)]
+
+    async def run():
+        router = make_router(*servers)
+        try:
+            replies = await asyncio.gather(*(collect(router) for _ in range(4)))
+        finally:
+            await router.aclose()
+        return router, replies
+
+    router, replies = asyncio.run(run())
+    assert replies == [servers[0].RequestHandlerClass.reply] * 4
+    assert [backend.requests for backend in router.backends] == [2, 2]
+    assert all(backend.outstanding == 0 for backend in router.backends)
+
+
+def test_latency_strategy_prefers_faster_backend(fake_ollama):
+    slow, fast = fake_ollama(first_token_delay=0.2), fake_ollama(first_token_delay=0.01)
+
+    async def run():
+        router = make_router(slow, fast, strategy='latency')
+        try:
+            for _ in range(6):
+                await collect(router)
+        finally:
+            await router.aclose()
+        return router
+
+    router = asyncio.run(run())
+    # 两个后端各试一次测出延迟，之后都选快的
+    assert [backend.requests for backend in router.backends] == [1, 5]
+
+
+def test_session_sticks_to_backend_until_overloaded(fake_ollama):
+    servers = [fake_ollama(), fake_ollama()]
+
+    async def run():
+        router = make_router(*servers, sticky_slack=2)
+        try:
+            for _ in range(4):
+                await collect(router, affinity='session-a')
+        finally:
+            await router.aclose()
+        return router
+
+    router = asyncio.run(run())
+    first, second = router.backends
+    assert sorted(backend.requests for backend in router.backends) == [0, 4]
+    sticky = first if first.requests else second
+    other = second if sticky is first else first
+    sticky.outstanding = 2
+    assert router.pick('deepseek-r1:1.5b', affinity='session-a') is sticky
+    sticky.outstanding = 3
+    assert router.pick('deepseek-r1:1.5b', affinity='session-a') is other
+
+
+def test_failover_before_first_token(fake_ollama):
+    broken, healthy = fake_ollama(fail=True), fake_ollama()
+
+    async def run():
+        router = make_router(broken, healthy)
+        try:
+            return router, await collect(router)
+        finally:
+            await router.aclose()
+
+    router, reply = asyncio.run(run())
+    assert reply == healthy.RequestHandlerClass.reply
+    assert [backend.failures for backend in router.backends] == [1, 0]
+
+
+def test_health_check_removes_and_restores_backend(fake_ollama):
+    flaky, steady = fake_ollama(), fake_ollama()
+
+    async def run():
+        router = make_router(flaky, steady)
+        try:
+            flaky.RequestHandlerClass.fail = True
+            await router.check_all()
+            assert not router.backends[0].healthy
+            assert all(router.pick('deepseek-r1:1.5b') is router.backends[1] for _ in range(3))
+
+            flaky.RequestHandlerClass.fail = False
+            await router.check_all()
+            assert router.backends[0].healthy
+            assert router.models() == ['deepseek-r1:1.5b']
+        finally:
+            await router.aclose()
+
+    asyncio.run(run())
+
+
+def test_no_backend_available(fake_ollama):
+    broken = fake_ollama(fail=True)
+
+    async def run():
+        router = make_router(broken)
+        try:
+            await collect(router)
+        finally:
+            await router.aclose()
+
+    with pytest.raises(BackendUnavailable):
+        asyncio.run(run())
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from async_pipeline import (BATCH, FILE_ANALYSIS, INTERACTIVE, AsyncOllamaClient, AsyncPipeline, FairScheduler,
+                            Preempted, QueueFull)
+from document_store import DocumentStore
+from session_manager import SessionManager
+
+
+def test_round_robin_between_users():
+    async def run():
+        scheduler = FairScheduler(max_in_flight=1, reserved=0)
+        order = []
+
+        async def request(user_id, tag):
+            async with scheduler.slot(user_id):
+                order.append(tag)
+                await asyncio.sleep(0.01)
+
+        holder = asyncio.create_task(request('x', 'x0'))
+        await asyncio.sleep(0)
+        # 用户 a 先排了三个请求，b 后到的请求不必等 a 全部完成
+        tasks = [asyncio.create_task(request('a', f'a{i}')) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request('b', 'b0')))
+        await asyncio.gather(holder, *tasks)
+        return order
+
+    assert asyncio.run(run()) == ['x0', 'a0', 'b0', 'a1', 'a2']
+
+
+def test_interactive_preempts_latest_background_slot():
+    async def run():
+        scheduler = FairScheduler(max_in_flight=2, reserved=0, limits={FILE_ANALYSIS: 2}, preempt=True)
+        entered = asyncio.Event()
+        slots = []
+
+        async def background(user_id, priority):
+            async with scheduler.slot(user_id, priority) as slot:
+                slots.append(slot)
+                if len(slots) == 2:
+                    entered.set()
+                await slot.stop.wait()
+
+        first = asyncio.create_task(background('a', FILE_ANALYSIS))
+        second = asyncio.create_task(background('b', BATCH))
+        await entered.wait()
+        async with scheduler.slot('c', INTERACTIVE):
+            stats = scheduler.stats()
+        preempted = [slot.preempted for slot in slots]
+        first.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        return preempted, stats
+
+    preempted, stats = asyncio.run(run())
+    # 批量任务优先级最低，先被抢占；文件分析继续
+    assert preempted == [False, True]
+    assert stats['preemptions'] == 1
+    assert stats['classes'][INTERACTIVE]['in_flight'] == 1
+
+
+def test_queue_limit_per_user():
+    async def run():
+        scheduler = FairScheduler(max_in_flight=1, reserved=0, max_queue_per_user=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot('a'):
+                await release.wait()
+
+        tasks = [asyncio.create_task(hold()) for _ in range(2)]
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(QueueFull):
+                async with scheduler.slot('a'):
+                    pass
+        finally:
+            release.set()
+            await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+
+
+def test_pipeline_preempts_file_analysis_for_chat(tmp_path, fake_ollama):
+    server = fake_ollama(token_delay=0.05)
+
+    async def run():
+        sessions = SessionManager(str(tmp_path / 'sessions'), document_store=DocumentStore(str(tmp_path / 'uploads')))
+        scheduler = FairScheduler(max_in_flight=1, reserved=0, preempt=True)
+        client = AsyncOllamaClient(server.url, max_retries=0)
+        pipeline = AsyncPipeline(sessions, client=client, scheduler=scheduler, cache=None)
+        analysis_session, chat_session = sessions.new_session_id(), sessions.new_session_id()
+        started = asyncio.Event()
+
+        async def analyze():
+            async for _ in pipeline.stream_turn(analysis_session, '分析文件', priority=FILE_ANALYSIS):
+                started.set()
+
+        async def chat():
+            await started.wait()
+            return ''.join([delta async for delta in pipeline.stream_turn(chat_session, '你好')])
+
+        try:
+            results = await asyncio.gather(analyze(), chat(), return_exceptions=True)
+        finally:
+            await client.aclose()
+        return results, len(sessions.get(analysis_session)), len(sessions.get(chat_session))
+
+    (analysis, answer), analysis_messages, chat_messages = asyncio.run(run())
+    assert isinstance(analysis, Preempted)
+    assert answer == '这是来自模拟 Ollama 服务的回答。'
+    # 被抢占的一轮不写入日志，稍后整体重试
+    assert (analysis_messages, chat_messages) == (0, 2)